@@ -11,7 +11,7 @@ APP_PREFIX = "BedrockAgentImpl"
 
 app = cdk.App()
 base_stack = base_infra_stack.BaseInfraStack(app, f"{APP_PREFIX}BaseInfraStack", "IoTAgent")
-agent_stack = bedrock_agent_stack.BedrockAgentStack(app, f"{APP_PREFIX}GenAIStack", data_bucket=base_stack.data_bucket, athena_db=base_stack.athena_db, athena_output_location=base_stack.athena_output_location)
+agent_stack = bedrock_agent_stack.BedrockAgentStack(app, f"{APP_PREFIX}GenAIStack", data_bucket=base_stack.data_bucket, athena_db=base_stack.athena_db, athena_output_location=base_stack.athena_output_location, athena_workgroup=base_stack.athena_workgroup, athena_result_reuse_minutes=base_stack.athena_result_reuse_minutes)
 frontend_stack.FrontendStack(app, f"{APP_PREFIX}FrontendStack", bedrock_agent_id=agent_stack.bedrock_agent_id, bedrock_agent_alias=agent_stack.bedrock_agent_alias, vpc=base_stack.vpc)
 
 app.synth()
@@ -1,30 +1,111 @@
 import boto3
 import json
+import re
 import time
 import os
 
+from rollup_rewriter import rewrite_to_rollup
+
+# Polling starts fast so short queries return quickly, then backs off
+POLL_INITIAL_SECONDS = float(os.getenv('POLL_INITIAL_SECONDS', '0.1'))
+POLL_MAX_SECONDS = float(os.getenv('POLL_MAX_SECONDS', '2'))
+POLL_BACKOFF = 1.5
+QUERY_TIMEOUT_SECONDS = float(os.getenv('QUERY_TIMEOUT_SECONDS', '240'))
+# Maximum number of rows returned to the agent, also applied as a server-side LIMIT
+MAX_RESULT_ROWS = int(os.getenv('MAX_RESULT_ROWS', '1000'))
+# Reuse results of identical queries run within this window instead of rescanning S3, 0 disables reuse
+ATHENA_RESULT_REUSE_MINUTES = int(os.getenv('ATHENA_RESULT_REUSE_MINUTES', '60'))
+# Answer eligible min/max/avg/count queries from the hourly rollup instead of the raw metrics
+ROLLUP_REWRITE_ENABLED = os.getenv('ROLLUP_REWRITE_ENABLED', 'true').lower() == 'true'
+
+LIMIT_PATTERN = re.compile(r"\blimit\s+\d+\s*$", re.IGNORECASE)
+
+athena_client = boto3.client('athena')
+
+
+def add_limit_guard(sql_query, max_rows):
+    """Append a LIMIT to SELECT queries that don't end with one"""
+    query = sql_query.strip().rstrip(';').strip()
+    if re.match(r"^(select|with)\b", query, re.IGNORECASE) and not LIMIT_PATTERN.search(query):
+        query = f"{query}\nLIMIT {max_rows}"
+    return query
+
+
+def wait_for_query(query_execution_id):
+    """Poll the query status with exponential backoff, return the finished query execution"""
+    delay = POLL_INITIAL_SECONDS
+    deadline = time.monotonic() + QUERY_TIMEOUT_SECONDS
+    while True:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+        print(query_execution['Status']['State'])
+        if query_execution['Status']['State'] in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+            return query_execution
+        if time.monotonic() + delay > deadline:
+            athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+            return {'Status': {'State': 'CANCELLED',
+                               'StateChangeReason': f'Query timed out after {QUERY_TIMEOUT_SECONDS} seconds'}}
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_SECONDS)
+
+
+def get_query_rows(query_execution_id, max_rows):
+    """Page through the query results up to max_rows data rows"""
+    columns = None
+    data = []
+    paginator = athena_client.get_paginator('get_query_results')
+    pages = paginator.paginate(
+        QueryExecutionId=query_execution_id,
+        PaginationConfig={'PageSize': min(max_rows + 1, 1000)}
+    )
+    for page in pages:
+        rows = page['ResultSet']['Rows']
+        if columns is None:
+            columns = [col_info['Name'] for col_info in page['ResultSet']['ResultSetMetadata']['ColumnInfo']]
+            # The first row of the first page holds the column headers
+            rows = rows[1:]
+        for row in rows:
+            data.append(dict(zip(columns, [value.get('VarCharValue') for value in row['Data']])))
+            if len(data) >= max_rows:
+                return data
+    return data
+
+
 def lambda_handler(event, context):
     # Extract necessary information from the input event
-    
+
     print(event)
     action_group = event['actionGroup']
     api_path = event['apiPath']
     query_parameters = event['parameters'][0]
     sql_query = query_parameters['value']
-    
+    rollup_query = rewrite_to_rollup(sql_query) if ROLLUP_REWRITE_ENABLED else None
+    if rollup_query is not None:
+        print("Answering from the hourly rollup")
+        sql_query = rollup_query
+    sql_query = add_limit_guard(sql_query, MAX_RESULT_ROWS)
+
     print(sql_query)
 
     # Specify your Athena database and output location
     database = os.getenv('ATHENA_DATABASE')  # Replace with your Athena database name
     output_location = os.getenv('ATHENA_OUTPUT_LOCATION')  # Replace with your Athena output location
-    # Create Athena client
-    athena_client = boto3.client('athena')
+    workgroup = os.getenv('ATHENA_WORKGROUP', 'primary')
 
     # Run the Athena query
+    query_options = {}
+    if ATHENA_RESULT_REUSE_MINUTES > 0:
+        query_options['ResultReuseConfiguration'] = {
+            'ResultReuseByAgeConfiguration': {
+                'Enabled': True,
+                'MaxAgeInMinutes': ATHENA_RESULT_REUSE_MINUTES
+            }
+        }
     response = athena_client.start_query_execution(
         QueryString=sql_query,
         QueryExecutionContext={'Database': database},
-        ResultConfiguration={'OutputLocation': output_location}
+        ResultConfiguration={'OutputLocation': output_location},
+        WorkGroup=workgroup,
+        **query_options
     )
 
     # Get the query execution ID
@@ -32,30 +113,30 @@ def lambda_handler(event, context):
     print(query_execution_id)
 
     # Poll for the query execution status
-    while True:
-        query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']['Status']['State']
-        print(query_status)
-        if query_status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            break
-        
-        time.sleep(5)  # Wait for 5 seconds before checking again
-
-    # Get the query results
-    results = athena_client.get_query_results(QueryExecutionId=query_execution_id)
-
-    # Extract and return the results
-    columns = [col_info['Name'] for col_info in results['ResultSet']['ResultSetMetadata']['ColumnInfo']]
-    data = [dict(zip(columns, row['Data'])) for row in results['ResultSet']['Rows'][1:]]
-    
-    print(json.dumps(results))
-    print(json.dumps(data))
+    query_execution = wait_for_query(query_execution_id)
+    status = query_execution['Status']
+    reuse_info = query_execution.get('Statistics', {}).get('ResultReuseInformation', {})
+    print(f"Result reused: {reuse_info.get('ReusedPreviousResult', False)}")
+
+    if status['State'] == 'SUCCEEDED':
+        # Extract and return the results
+        data = get_query_rows(query_execution_id, MAX_RESULT_ROWS)
+        print(f"Returning {len(data)} rows")
+        http_status_code = 200
+        body = json.dumps(data)
+    else:
+        # Let the agent see why the query failed so it can correct the SQL
+        reason = status.get('StateChangeReason', 'Unknown error')
+        print(f"Query {status['State']}: {reason}")
+        http_status_code = 400 if status['State'] == 'FAILED' else 500
+        body = json.dumps({'message': f"Query {status['State']}: {reason}"})
 
     response_body = {
         'application/json': {
-            'body': json.dumps(data)
+            'body': body
         }
     }
-    
+
     # Bedrock action group response format
     action_response = {
         "messageVersion": "1.0",
@@ -63,9 +144,9 @@ def lambda_handler(event, context):
             'actionGroup': action_group,
             'apiPath': api_path,
             'httpMethod': event['httpMethod'],
-            'httpStatusCode': 200,
+            'httpStatusCode': http_status_code,
             'responseBody': response_body
         }
     }
- 
+
     return action_response
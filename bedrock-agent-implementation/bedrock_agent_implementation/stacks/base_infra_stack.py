@@ -4,19 +4,25 @@ import aws_cdk as cdk
 from constructs import Construct
 from aws_cdk import (
     Stack,
+    Duration,
+    CustomResource,
     aws_s3 as s3,
     aws_s3_deployment as s3_deploy,
     aws_iam as iam,
     aws_glue as glue,
     aws_athena as athena,
     aws_ec2 as ec2,
-
+    aws_lambda as _lambda,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_dynamodb as dynamodb,
 )
 from aws_cdk.custom_resources import (
     AwsCustomResource,
     AwsCustomResourcePolicy,
     PhysicalResourceId,
-    AwsSdkCall
+    AwsSdkCall,
+    Provider
 )
 
 
@@ -27,7 +33,11 @@ DEVICE_INFO_PATH = "iot_device_info/"
 DEVICE_DATA_PATH = "iot_device_metrics/"
 ATHENA_DB = "iot_ops_glue_db"
 ATHENA_TABLE = "iot_device_metrics"
+ATHENA_PARQUET_TABLE = "iot_device_metrics_parquet"
+ATHENA_ROLLUP_TABLE = "iot_device_metrics_hourly"
+ATHENA_ROLLUP_VIEW = "iot_device_metrics_hourly_all"
 ATHENA_WORKGROUP = "iot_ops_athena_workgroup"
+ATHENA_RESULT_REUSE_MINUTES = 60
 REGION = cdk.Aws.REGION
 
 class BaseInfraStack(Stack):
@@ -116,9 +126,9 @@ class BaseInfraStack(Stack):
         res.node.add_dependency(deploy_metrics_data)
         res.node.add_dependency(crawler)
 
-        # set up athena workgroup
+        # set up athena workgroup, query result reuse requires Athena engine version 3
         output_location=f"s3://{data_bucket.bucket_name}/athena_query_result/"
-        athena.CfnWorkGroup(
+        workgroup = athena.CfnWorkGroup(
             self,
             "IotOpsAthenaWorkgroupId",
             name=ATHENA_WORKGROUP,
@@ -131,11 +141,78 @@ class BaseInfraStack(Stack):
                         encryption_option="SSE_S3"
                     )
                 ),
+                engine_version=athena.CfnWorkGroup.EngineVersionProperty(
+                    selected_engine_version="Athena engine version 3"
+                ),
+            ),
+        )
+
+        # held by the compaction run in progress, so the schedule and the custom resource don't overlap
+        compaction_lock_table = dynamodb.Table(
+            self, "MetricsCompactionLockTable",
+            partition_key=dynamodb.Attribute(
+                name="LockId",
+                type=dynamodb.AttributeType.STRING
             ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            time_to_live_attribute="ExpiresAt"
+        )
+
+        # compact the raw CSV into a Parquet table partitioned by device and date
+        compaction_lambda = _lambda.Function(
+            self, "MetricsCompactionLambda",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            code=_lambda.Code.from_asset(
+                os.path.join(dirname, "../../../metrics_rollup")),
+            handler='compaction.on_event',
+            timeout=Duration.seconds(900),
+            environment={
+                'ATHENA_DB': ATHENA_DB,
+                'ATHENA_WORKGROUP': ATHENA_WORKGROUP,
+                'CRAWLER_NAME': "IotOpsGlueCrawler",
+                'SOURCE_TABLE': ATHENA_TABLE,
+                'TARGET_TABLE': ATHENA_PARQUET_TABLE,
+                'TARGET_LOCATION': f"s3://{data_bucket.bucket_name}/{ATHENA_PARQUET_TABLE}/",
+                'ROLLUP_TABLE': ATHENA_ROLLUP_TABLE,
+                'ROLLUP_VIEW': ATHENA_ROLLUP_VIEW,
+                'ROLLUP_LOCATION': f"s3://{data_bucket.bucket_name}/{ATHENA_ROLLUP_TABLE}/",
+                'LOCK_TABLE': compaction_lock_table.table_name
+            },
+        )
+        compaction_lambda.role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name("AmazonAthenaFullAccess")
+        )
+        compaction_lambda.role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["glue:GetCrawler"],
+                resources=[
+                    f"arn:aws:glue:{self.region}:{self.account}:crawler/IotOpsGlueCrawler"]
+            )
         )
+        data_bucket.grant_read_write(compaction_lambda)
+        compaction_lock_table.grant_read_write_data(compaction_lambda)
+
+        compaction_provider = Provider(self, "MetricsCompactionProvider",
+                                       on_event_handler=compaction_lambda,
+                                       )
+        compaction_res = CustomResource(self, "MetricsCompaction",
+                                        service_token=compaction_provider.service_token,
+                                        properties={
+                                            "target_table": ATHENA_PARQUET_TABLE
+                                        })
+        compaction_res.node.add_dependency(res)
+        compaction_res.node.add_dependency(workgroup)
+
+        # append newly landed metrics every hour
+        events.Rule(self, "MetricsCompactionSchedule",
+                    schedule=events.Schedule.rate(Duration.hours(1)),
+                    targets=[targets.LambdaFunction(compaction_lambda)]
+                    )
 
         self.athena_output_location = output_location
         self.athena_workgroup = ATHENA_WORKGROUP
+        self.athena_result_reuse_minutes = ATHENA_RESULT_REUSE_MINUTES
         self.athena_db = ATHENA_DB
 
         # create VPC to host the opensearch and ecs app
@@ -1,4 +1,5 @@
 """BedrockAgent stack to provide a Bedrock Agent"""
+import os
 import platform
 import json
 from constructs import Construct
@@ -18,6 +19,7 @@ from aws_cdk import (
 
 from aws_cdk.custom_resources import Provider
 
+dirname = os.path.dirname(__file__)
 ACCOUNT_ID = cdk.Aws.ACCOUNT_ID
 REGION = cdk.Aws.REGION
 
@@ -36,16 +38,17 @@ OSS_COLLECTION = "bedrock-agent"
 BEDROCK_AGENT_INSTRUCTION = f"""
 As an IoT Ops agent, you handle managing and monitoring IoT devices: 
 1. looking up device info in "{KNOWLEDGE_BASE_NAME}"
-2. checking metrics from Athena "iot_ops_glue_db"."iot_device_metrics" table with columns:
+2. checking metrics from Athena "iot_ops_glue_db"."iot_device_metrics_parquet" table with columns:
     - name: oil_level type: double 
     - name: temperature type: double 
     - name: pressure type: double 
-    - name: received_at type: string 
-    - name: device_id type: bigint
+    - name: received_at type: timestamp 
+    - name: device_id type: bigint (partition)
+    - name: received_date type: date (partition)
     - name: device_name type: bigint
  When generating SQL queries, guidelines as follow:
-    For "received_at" queries, use: SELECT * FROM iot_device_metrics WHERE parse_datetime(TRIM(BOTH '"' FROM received_at), 'yyyy-MM-dd HH:mm:ss') >= current_timestamp - interval. 
-    For aggregate functions, include non-aggregated columns in GROUP BY, e.g., SELECT device_name, MAX(pressure) FROM iot_device_metrics GROUP BY device_name.
+    For "received_at" queries, use: SELECT * FROM iot_device_metrics_parquet WHERE received_at >= current_timestamp - interval '6' hour AND received_date >= current_date - interval '1' day. Always add the matching received_date filter so only the needed partitions are read.
+    For aggregate functions, include non-aggregated columns in GROUP BY, e.g., SELECT device_name, MAX(pressure) FROM iot_device_metrics_parquet GROUP BY device_name.
     group_id and group_name are integers, e.g. 1001
 3. Perform actions like start, shutdown, reboot by device ID. 
 4. Answering general questions.
@@ -57,7 +60,8 @@ class BedrockAgentStack(Stack):
 
     def __init__(self, scope: Construct, construct_id: str,
                  data_bucket: s3.Bucket, athena_db: str, 
-                 athena_output_location: str) -> None:
+                 athena_output_location: str, athena_workgroup: str,
+                 athena_result_reuse_minutes: int) -> None:
         super().__init__(scope, construct_id)
 
         # create a custom resouce execution role to have admin access
@@ -422,6 +426,18 @@ class BedrockAgentStack(Stack):
         associate_agent_res.node.add_dependency(data_source_res)
         associate_agent_res.node.add_dependency(agent_res)
 
+        # the rollup query rewriter is shared with the compaction Lambda and the langchain app
+        rollup_rewriter_layer = _lambda.LayerVersion(
+            self, "RollupRewriterLayer",
+            code=_lambda.Code.from_asset(os.path.join(dirname, "../../../metrics_rollup"),
+                                         bundling=BundlingOptions(
+                                             image=_lambda.Runtime.PYTHON_3_11.bundling_image,
+                                             command=['bash',
+                                                      '-c',
+                                                      'mkdir -p /asset-output/python && cp rollup_rewriter.py /asset-output/python/'])),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_11]
+        )
+
         # action 1 is the device metrics lambda
         action_1_lambda = _lambda.Function(
             self, "DeviceMetricsLambda",
@@ -430,9 +446,14 @@ class BedrockAgentStack(Stack):
                 'bedrock_agent_implementation/action_groups/check_device_metrics_query'),
             handler='lambda_function.lambda_handler',
             timeout=cdk.Duration.seconds(300),
+            layers=[rollup_rewriter_layer],
             environment={
                 'ATHENA_DATABASE': athena_db,
-                'ATHENA_OUTPUT_LOCATION': athena_output_location
+                'ATHENA_OUTPUT_LOCATION': athena_output_location,
+                'ATHENA_WORKGROUP': athena_workgroup,
+                'ATHENA_RESULT_REUSE_MINUTES': str(athena_result_reuse_minutes),
+                'MAX_RESULT_ROWS': "1000",
+                'QUERY_TIMEOUT_SECONDS': "240"
             },
         )
         action_1_lambda.add_permission(
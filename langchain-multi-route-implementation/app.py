@@ -17,9 +17,14 @@ DEVICE_INFO_PATH = "iot_device_info"
 DEVICE_DATA_PATH = "iot_device_metrics"
 ATHENA_DB = "mrc_glue_db"
 ATHENA_TABLE = "iot_device_metrics"
+ATHENA_PARQUET_TABLE = "iot_device_metrics_parquet"
 ATHENA_WORKGROUP = "mrc_athena_workgroup"
 OSS_COLLECTION_NAME = "mrc-oss"
 REGION = cdk.Aws.REGION
+# "local" serves retrieval from the in-process snapshot index, OpenSearch can then be
+# dropped with -c opensearch_enabled=false
+RETRIEVER_BACKEND = app.node.try_get_context("retriever_backend") or "opensearch"
+OPENSEARCH_ENABLED = str(app.node.try_get_context("opensearch_enabled") or "true").lower() == "true"
 
 base_data_stack = BaseInfraStack(
     scope=app,
@@ -36,6 +41,8 @@ sql_chain_stack = SqlChainStack(
     data_path=DEVICE_DATA_PATH,
     athena_db=ATHENA_DB,
     athena_workgroup=ATHENA_WORKGROUP,
+    athena_table=ATHENA_TABLE,
+    athena_parquet_table=ATHENA_PARQUET_TABLE,
     app_execute_role=base_data_stack.app_execute_role)
 sql_chain_stack.add_dependency(base_data_stack)
 
@@ -46,7 +53,8 @@ rag_stack = RagStack(
     data_path=DEVICE_INFO_PATH,
     oss_collection=OSS_COLLECTION_NAME,
     app_execute_role=base_data_stack.app_execute_role,
-    vpc=base_data_stack.vpc)
+    vpc=base_data_stack.vpc,
+    opensearch_enabled=OPENSEARCH_ENABLED)
 rag_stack.add_dependency(base_data_stack)
 
 action_lambda_stack = ActionLambdaStack(
@@ -58,11 +66,16 @@ app_env_vars = {
     "AWS_REGION": REGION,
     "STAGING_ATHENA_BUCKET": base_data_stack.data_bucket.bucket_name,
     "OPENSEARCH_ENDPOINT": rag_stack.opensearch_endpoint,
+    "RETRIEVER_BACKEND": RETRIEVER_BACKEND,
     "CUSTOM_CHAIN_LAMBDA": action_lambda_stack.lambda_arn,
     "ATHENA_SCHEMA": ATHENA_DB,
     "STREAMLIT_SERVER_PORT": "8501",
     "ATHENA_WORKGROUP": ATHENA_WORKGROUP,
-    "MEMORY_TABLE": base_data_stack.memory_table.table_name
+    "MEMORY_TABLE": base_data_stack.memory_table.table_name,
+    "MEMORY_ARCHIVE_TABLE": base_data_stack.memory_archive_table.table_name,
+    "EMBEDDING_CACHE_TABLE": base_data_stack.embedding_cache_table.table_name,
+    "GLUE_CRAWLER_NAME": sql_chain_stack.crawler_name,
+    "ATHENA_RESULT_REUSE_MINUTES": str(sql_chain_stack.result_reuse_minutes)
 }
 
 frontend_stack = FrontendStack(app, f"{APP_PREFIX}FrontendStack",
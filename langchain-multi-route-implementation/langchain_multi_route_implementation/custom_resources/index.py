@@ -1,16 +1,68 @@
-"""Custom resource lambda function to create OpenSearch index"""
+"""Custom resource lambda function to create OpenSearch index
+
+Documents are downloaded concurrently, split into chunks and embedded in batches
+by a bounded pool of Bedrock calls (retried with backoff when throttled). Each
+batch is written with the _bulk API as soon as it is embedded, so the whole
+corpus never has to be held in memory and indexing overlaps with embedding.
+
+The k-NN method (engine, space type, m, ef_construction, ef_search, shards) comes
+from the knn_settings resource property. Method parameters and the shard count
+can't be changed on an existing index, so the index is recreated and fully
+re-indexed when they change; ef_search is updated in place.
+
+Indexing is incremental: a manifest in S3 records each file's ETag and the ids of
+its chunks. Chunk ids are content hashes stored in the chunk_id field (vector
+search collections don't accept custom document _ids), so only new or changed
+chunks are embedded, and chunks of edited or removed files are deleted. Each
+chunk's metadata carries the device id and the sections (from the document's
+table of contents) it covers as keyword fields, so searches can be filtered to
+one device; files indexed with older metadata are re-indexed once.
+
+Every run also writes a snapshot of all chunk vectors (vectors.npy, with the texts
+and metadata in chunks.json) under SNAPSHOT_PREFIX for the app's local retriever
+backend. Vectors of the previous snapshot are reused instead of re-embedding, and
+when oss_endpoint is empty only the snapshot is written.
+"""
+import hashlib
+import io
+import json
 import os
+import random
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import BedrockEmbeddings
-from langchain.vectorstores import OpenSearchVectorSearch
-from langchain.document_loaders import DirectoryLoader, TextLoader
-from opensearchpy import RequestsHttpConnection, OpenSearch
+from langchain.document_loaders import TextLoader
+import numpy as np
+from opensearchpy import RequestsHttpConnection, OpenSearch, helpers
 from requests_aws4auth import AWS4Auth
 
-bedrockruntime = boto3.client(service_name='bedrock-runtime')
-embeddings = BedrockEmbeddings(client=bedrockruntime)
+INDEX_NAME = "docs"
+EMBEDDING_MODEL_ID = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v1')
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', '16'))
+EMBEDDING_CONCURRENCY = int(os.environ.get('EMBEDDING_CONCURRENCY', '8'))
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', '64'))
+EMBEDDING_MAX_RETRIES = 8
+BULK_MAX_CHUNK_BYTES = 5 * 1024 * 1024
+INDEX_READY_TIMEOUT_SECONDS = 120
+MANIFEST_KEY = os.environ.get('MANIFEST_KEY', 'index_manifest/docs.json')
+# Bumped when the chunk metadata changes, so files indexed before are re-indexed
+METADATA_VERSION = 2
+DEVICE_ID_PATTERN = re.compile(r"\bdevice[\s_]*(\d+)", re.IGNORECASE)
+TOC_ENTRY_PATTERN = re.compile(r"^\s*(\d+)\.\s+(.+?)\s*$")
+SNAPSHOT_PREFIX = os.environ.get('SNAPSHOT_PREFIX', 'index_snapshot/docs/')
+# Upper bound of documents returned per search when looking up ids to delete
+DELETE_SEARCH_SIZE = 10000
+DELETE_TERMS_BATCH = 500
+
+bedrockruntime = boto3.client(
+    service_name='bedrock-runtime',
+    config=Config(max_pool_connections=EMBEDDING_CONCURRENCY, retries={'max_attempts': 3, 'mode': 'standard'})
+)
+s3_client = boto3.client('s3', config=Config(max_pool_connections=DOWNLOAD_CONCURRENCY))
 
 def on_event(event, _):
     """Lambda handler"""
@@ -52,62 +104,412 @@ def get_opensearch_client(oss_endpoint, awsauth):
     return client
 
 
-def on_create(event):
-    """create new resource"""
-    props = event["ResourceProperties"]
-    print(f"create new resource with props {props}" )
-    bucket_name = props['bucket_name']
-    oss_endpoint = props['oss_endpoint']
-    data_path = props['data_path']
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    if not os.path.exists('/tmp/data'):
-        os.makedirs('/tmp/data')
-    for obj in bucket.objects.filter(Prefix=data_path):
-        filename = obj.key.split('/')[-1]
-        local_file_name = f'/tmp/data/{filename}'
-        print(local_file_name)
-        bucket.download_file(obj.key, local_file_name)
-    loader = DirectoryLoader('/tmp/data', loader_cls=TextLoader)
-    docs = loader.load()
-    print(len(docs))
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000, chunk_overlap=200, length_function=len
-    )
-    docs = text_splitter.split_documents(docs)
-    print(len(docs))
-    awsauth = get_awsauth()
-    client = get_opensearch_client(oss_endpoint, awsauth)
-    if not client.indices.exists('docs'):
-        client.indices.create(
-        'docs',
+def list_documents(bucket_name, data_path):
+    """Return {key: etag} for all objects under the prefix"""
+    etags = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=data_path):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                etags[obj['Key']] = obj['ETag']
+    return etags
+
+
+def download_documents(bucket_name, keys, local_dir):
+    """Download the given objects concurrently, return {key: local path}
+
+    Files keep their key path under local_dir, so keys with the same file name
+    under different prefixes don't overwrite each other.
+    """
+    paths = {key: os.path.join(local_dir, key) for key in keys}
+
+    def download(key):
+        os.makedirs(os.path.dirname(paths[key]), exist_ok=True)
+        s3_client.download_file(bucket_name, key, paths[key])
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        list(executor.map(download, keys))
+    return paths
+
+
+def load_manifest(bucket_name):
+    """Return the manifest of the last successful indexing, {} when there is none"""
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket_name, Key=MANIFEST_KEY)['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return {}
+        raise
+
+
+def save_manifest(bucket_name, manifest):
+    s3_client.put_object(Bucket=bucket_name, Key=MANIFEST_KEY, Body=json.dumps(manifest).encode('utf-8'),
+                         ContentType='application/json')
+
+
+def load_snapshot(bucket_name):
+    """Return {chunk_id: {text, metadata, vector}} of the latest snapshot, {} when there is none"""
+    try:
+        latest = json.loads(s3_client.get_object(Bucket=bucket_name, Key=f"{SNAPSHOT_PREFIX}latest.json")['Body'].read())
+        prefix = f"{SNAPSHOT_PREFIX}{latest['version']}/"
+        chunks = json.loads(s3_client.get_object(Bucket=bucket_name, Key=f"{prefix}chunks.json")['Body'].read())
+        vectors = np.load(io.BytesIO(s3_client.get_object(Bucket=bucket_name, Key=f"{prefix}vectors.npy")['Body'].read()))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return {}
+        raise
+    return {
+        chunk['chunk_id']: {'text': chunk['text'], 'metadata': chunk['metadata'], 'vector': vector}
+        for chunk, vector in zip(chunks, vectors)
+    }
+
+
+def save_snapshot(bucket_name, rows):
+    """Write the snapshot under a new version, then point latest.json at it and drop the previous version"""
+    try:
+        previous = json.loads(s3_client.get_object(Bucket=bucket_name, Key=f"{SNAPSHOT_PREFIX}latest.json")['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            raise
+        previous = None
+    version = str(int(time.time() * 1000))
+    prefix = f"{SNAPSHOT_PREFIX}{version}/"
+    chunk_ids = sorted(rows)
+    vectors = io.BytesIO()
+    np.save(vectors, np.asarray([rows[chunk_id]['vector'] for chunk_id in chunk_ids], dtype=np.float32))
+    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}vectors.npy", Body=vectors.getvalue())
+    chunks = [{'chunk_id': chunk_id, 'text': rows[chunk_id]['text'], 'metadata': rows[chunk_id]['metadata']}
+              for chunk_id in chunk_ids]
+    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}chunks.json", Body=json.dumps(chunks).encode('utf-8'),
+                         ContentType='application/json')
+    s3_client.put_object(Bucket=bucket_name, Key=f"{SNAPSHOT_PREFIX}latest.json",
+                         Body=json.dumps({'version': version, 'count': len(chunk_ids)}).encode('utf-8'),
+                         ContentType='application/json')
+    if previous and previous['version'] != version:
+        previous_prefix = f"{SNAPSHOT_PREFIX}{previous['version']}/"
+        s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': [
+            {'Key': f"{previous_prefix}vectors.npy"}, {'Key': f"{previous_prefix}chunks.json"}]})
+    return version
+
+
+def extract_sections(text):
+    """Return [(offset, title)] of the section headings listed in the table of contents"""
+    lines = text.splitlines(keepends=True)
+    toc_end, entries = None, []
+    for number, line in enumerate(lines):
+        if toc_end is None and line.strip().lower() == 'table of contents':
+            toc_end = number + 1
+            while toc_end < len(lines) and TOC_ENTRY_PATTERN.match(lines[toc_end]):
+                entry = TOC_ENTRY_PATTERN.match(lines[toc_end])
+                entries.append((entry.group(1), entry.group(2)))
+                toc_end += 1
+            break
+    if not entries:
+        return []
+    sections = [(0, 'Overview')]
+    offset = sum(len(line) for line in lines[:toc_end])
+    for line in lines[toc_end:]:
+        entry = TOC_ENTRY_PATTERN.match(line)
+        if entry and (entry.group(1), entry.group(2)) in entries:
+            sections.append((offset, entry.group(2)))
+        offset += len(line)
+    return sections
+
+
+def chunk_metadata(text, chunks):
+    """Add device_id and the sections each chunk overlaps to the chunk metadata"""
+    match = DEVICE_ID_PATTERN.search(text) or DEVICE_ID_PATTERN.search(os.path.basename(chunks[0].metadata['source']))
+    device_id = match.group(1) if match else None
+    sections = extract_sections(text)
+    cursor = 0
+    for chunk in chunks:
+        start = text.find(chunk.page_content, cursor)
+        if start < 0:
+            start = max(text.find(chunk.page_content), 0)
+        # chunks overlap, so the next one starts before this one ends
+        cursor = start + 1
+        end = start + len(chunk.page_content)
+        chunk.metadata['device_id'] = device_id
+        chunk.metadata['section'] = [
+            title for i, (offset, title) in enumerate(sections)
+            if offset < end and (i + 1 == len(sections) or sections[i + 1][0] > start)
+        ]
+
+
+def split_file(path, text_splitter):
+    """Split one file into chunks tagged with metadata and a deterministic content-hash chunk_id"""
+    documents = TextLoader(path).load()
+    chunks = text_splitter.split_documents(documents)
+    if chunks:
+        chunk_metadata(documents[0].page_content, chunks)
+    seen = {}
+    for chunk in chunks:
+        digest = hashlib.sha256(f"{chunk.metadata['source']}\n{chunk.page_content}".encode('utf-8')).hexdigest()
+        # identical chunks in one file get distinct ids by their occurrence
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        chunk.metadata['chunk_id'] = f"{digest}-{occurrence}"
+    return chunks
+
+
+def embed_text(text):
+    """Embed one chunk, backing off with jitter while Bedrock throttles"""
+    for attempt in range(EMBEDDING_MAX_RETRIES):
+        try:
+            response = bedrockruntime.invoke_model(
+                modelId=EMBEDDING_MODEL_ID,
+                body=json.dumps({"inputText": text}),
+                accept="application/json",
+                contentType="application/json",
+            )
+            return json.loads(response['body'].read())['embedding']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['ThrottlingException', 'ServiceUnavailableException'] \
+                    or attempt == EMBEDDING_MAX_RETRIES - 1:
+                raise
+            time.sleep(min(2 ** attempt, 20) * random.uniform(0.5, 1.0))
+
+
+def wait_for_index(client, timeout=INDEX_READY_TIMEOUT_SECONDS):
+    """Poll until a newly created index accepts searches instead of sleeping for a fixed time"""
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while time.monotonic() < deadline:
+        try:
+            if client.indices.exists(INDEX_NAME):
+                client.search(index=INDEX_NAME, body={"size": 0, "query": {"match_all": {}}})
+                return
+        except Exception as e:
+            print(f"index not ready yet: {str(e)}")
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+    raise Exception(f"Index {INDEX_NAME} not ready after {timeout} seconds")
+
+
+def find_document_ids(client, query):
+    response = client.search(index=INDEX_NAME, body={"size": DELETE_SEARCH_SIZE, "_source": False, "query": query})
+    return [hit['_id'] for hit in response['hits']['hits']]
+
+
+def delete_documents(client, ids):
+    if not ids:
+        return 0
+    actions = [{"_op_type": "delete", "_index": INDEX_NAME, "_id": doc_id} for doc_id in ids]
+    success, errors = helpers.bulk(client, actions, max_retries=3, raise_on_error=False)
+    if errors:
+        raise Exception(f"Bulk delete failed for {len(errors)} documents: {errors[:3]}")
+    return success
+
+
+def delete_chunks(client, chunk_ids):
+    """Delete the documents of the given chunk ids"""
+    chunk_ids = list(chunk_ids)
+    deleted = 0
+    for start in range(0, len(chunk_ids), DELETE_TERMS_BATCH):
+        batch = chunk_ids[start:start + DELETE_TERMS_BATCH]
+        deleted += delete_documents(client, find_document_ids(client, {"terms": {"chunk_id": batch}}))
+    return deleted
+
+
+def index_documents(client, docs, index_ids, rows):
+    """Embed the chunks missing from the snapshot rows in parallel batches and write the chunks
+    in index_ids of each batch with the _bulk API (skipped when client is None)"""
+    indexed = 0
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+        for start in range(0, len(docs), EMBEDDING_BATCH_SIZE):
+            batch = docs[start:start + EMBEDDING_BATCH_SIZE]
+            missing = [doc for doc in batch if doc.metadata['chunk_id'] not in rows]
+            for doc, vector in zip(missing, executor.map(embed_text, [doc.page_content for doc in missing])):
+                rows[doc.metadata['chunk_id']] = {'text': doc.page_content, 'vector': vector}
+            for doc in batch:
+                rows[doc.metadata['chunk_id']]['metadata'] = {
+                    key: value for key, value in doc.metadata.items() if key != 'chunk_id'}
+            if client is None:
+                continue
+            actions = [
+                {
+                    "_op_type": "index",
+                    "_index": INDEX_NAME,
+                    "vector_field": [float(value) for value in rows[doc.metadata['chunk_id']]['vector']],
+                    "text": doc.page_content,
+                    "metadata": rows[doc.metadata['chunk_id']]['metadata'],
+                    "chunk_id": doc.metadata['chunk_id'],
+                }
+                for doc in batch if doc.metadata['chunk_id'] in index_ids
+            ]
+            if not actions:
+                continue
+            success, errors = helpers.bulk(client, actions, max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+                                           max_retries=3, raise_on_error=False)
+            if errors:
+                raise Exception(f"Bulk indexing failed for {len(errors)} chunks: {errors[:3]}")
+            indexed += success
+            print(f"indexed {indexed}/{len(index_ids)} chunks")
+    return indexed
+
+
+def knn_method(knn_settings):
+    """k-NN method mapping from the resource property, whose values CloudFormation passes as strings"""
+    return {
+        "name": "hnsw",
+        "engine": knn_settings.get('engine', 'faiss'),
+        "space_type": knn_settings.get('space_type', 'l2'),
+        "parameters": {
+            "m": int(knn_settings.get('m', 16)),
+            "ef_construction": int(knn_settings.get('ef_construction', 512)),
+        },
+    }
+
+
+def index_method_matches(client, method):
+    """Whether the existing index was created with the same k-NN method"""
+    mapping = client.indices.get_mapping(index=INDEX_NAME)
+    current = mapping[INDEX_NAME]['mappings']['properties']['vector_field'].get('method')
+    if current is None:
+        return False
+    parameters = {key: int(value) for key, value in current.get('parameters', {}).items()}
+    return (current.get('engine'), current.get('space_type'), parameters) == \
+        (method['engine'], method['space_type'], method['parameters'])
+
+
+def index_settings(client):
+    """(number_of_shards, ef_search) of the existing index, None for settings it doesn't report"""
+    settings = client.indices.get_settings(index=INDEX_NAME, flat_settings=True)[INDEX_NAME]['settings']
+    shards = settings.get('index.number_of_shards')
+    ef_search = settings.get('index.knn.algo_param.ef_search')
+    return (int(shards) if shards is not None else None,
+            int(ef_search) if ef_search is not None else None)
+
+
+METADATA_MAPPING = {
+    "properties": {
+        "device_id": {
+            "type": "keyword",
+        },
+        "section": {
+            "type": "keyword",
+        },
+    }
+}
+
+
+def create_index(client, knn_settings):
+    """Create the index if needed, or recreate it when the k-NN method or shard count changed;
+    return True when created"""
+    method = knn_method(knn_settings)
+    shards = int(knn_settings.get('shards', 2))
+    ef_search = int(knn_settings.get('ef_search', 512))
+    if client.indices.exists(INDEX_NAME):
+        current_shards, current_ef_search = index_settings(client)
+        if not index_method_matches(client, method):
+            print(f"k-NN method changed to {method}, recreating index {INDEX_NAME}")
+        elif current_shards is not None and current_shards != shards:
+            print(f"number_of_shards changed from {current_shards} to {shards}, recreating index {INDEX_NAME}")
+        else:
+            if current_ef_search != ef_search:
+                print(f"ef_search changed from {current_ef_search} to {ef_search}")
+                client.indices.put_settings(index=INDEX_NAME, body={"index": {"knn.algo_param.ef_search": ef_search}})
+            # new metadata fields can be added to the existing mapping
+            client.indices.put_mapping(index=INDEX_NAME, body={"properties": {"metadata": METADATA_MAPPING}})
+            return False
+        client.indices.delete(index=INDEX_NAME)
+    client.indices.create(
+        INDEX_NAME,
         body={
             "settings": {
                 "index.knn": True,
+                "number_of_shards": shards,
+                "knn.algo_param": {
+                    "ef_search": ef_search
+                },
             },
             "mappings": {
                 "properties": {
                     "vector_field": {
                         "type": "knn_vector",
                         "dimension": 1536,
+                        "method": method,
+                    },
+                    "chunk_id": {
+                        "type": "keyword",
                     },
+                    "metadata": METADATA_MAPPING,
                 }
             }
         }
     )
-        time.sleep(60)
-    OpenSearchVectorSearch.from_documents(
-        docs,
-        embeddings,
-        opensearch_url=oss_endpoint,
-        http_auth=awsauth,
-        timeout=300,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        index_name="docs",
+    return True
+
+
+def on_create(event):
+    """create or incrementally update the index and the local snapshot"""
+    props = event["ResourceProperties"]
+    print(f"create new resource with props {props}" )
+    bucket_name = props['bucket_name']
+    oss_endpoint = props.get('oss_endpoint')
+    data_path = props['data_path']
+    started = time.monotonic()
+    if oss_endpoint:
+        awsauth = get_awsauth()
+        client = get_opensearch_client(oss_endpoint, awsauth)
+        created = create_index(client, props.get('knn_settings', {}))
+        wait_for_index(client)
+    else:
+        # snapshot only, the app retrieves from the local index
+        client, created = None, False
+
+    # A new index starts from an empty manifest
+    manifest = {} if created else load_manifest(bucket_name)
+    if client and not created and not manifest:
+        # chunks indexed before the manifest existed have no chunk_id and would be duplicated
+        deleted = delete_documents(client, find_document_ids(
+            client, {"bool": {"must_not": {"exists": {"field": "chunk_id"}}}}))
+        print(f"deleted {deleted} chunks indexed without a chunk_id")
+    rows = load_snapshot(bucket_name)
+
+    etags = list_documents(bucket_name, data_path)
+    # files whose chunks are missing from the snapshot are split again to embed them
+    changed = [key for key, etag in etags.items()
+               if manifest.get(key, {}).get('etag') != etag
+               or manifest[key].get('metadata_version') != METADATA_VERSION
+               or not set(manifest[key].get('chunks', [])).issubset(rows)]
+    removed = [key for key in manifest if key not in etags]
+    print(f"{len(etags)} files, {len(changed)} new or changed, {len(removed)} removed, {len(rows)} chunks in snapshot")
+
+    paths = download_documents(bucket_name, changed, '/tmp/data')
+    print(f"downloaded {len(paths)} files in {time.monotonic() - started:.1f}s")
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, length_function=len
     )
 
+    changed_chunks, new_chunk_ids, stale_chunk_ids = [], set(), set()
+    for key in removed:
+        stale_chunk_ids.update(manifest.pop(key)['chunks'])
+    for key in changed:
+        chunks = split_file(paths[key], text_splitter)
+        previous_ids = set(manifest.get(key, {}).get('chunks', []))
+        current_ids = [chunk.metadata['chunk_id'] for chunk in chunks]
+        # chunks indexed with older metadata are written again
+        reindex = manifest.get(key, {}).get('metadata_version') != METADATA_VERSION
+        changed_chunks.extend(chunks)
+        new_chunk_ids.update(chunk_id for chunk_id in current_ids if reindex or chunk_id not in previous_ids)
+        stale_chunk_ids.update(previous_ids - set(current_ids))
+        manifest[key] = {'etag': etags[key], 'chunks': current_ids, 'metadata_version': METADATA_VERSION}
+    print(f"{len(new_chunk_ids)} chunks to index, {len(stale_chunk_ids)} to delete")
+
+    deleted = 0
+    if client and not created:
+        # drop copies left by an earlier run that failed before saving the manifest, so upserts are idempotent
+        stale_chunk_ids.update(new_chunk_ids)
+        deleted = delete_chunks(client, stale_chunk_ids)
+    indexed = index_documents(client, changed_chunks, new_chunk_ids, rows)
+    save_manifest(bucket_name, manifest)
+    current_chunk_ids = {chunk_id for entry in manifest.values() for chunk_id in entry['chunks']}
+    version = save_snapshot(bucket_name, {chunk_id: row for chunk_id, row in rows.items()
+                                          if chunk_id in current_chunk_ids})
+    print(f"indexed {indexed} and deleted {deleted} chunks, wrote snapshot {version} "
+          f"in {time.monotonic() - started:.1f}s")
+
     physical_id = "opensearch-index"
     return {'PhysicalResourceId': physical_id}
 
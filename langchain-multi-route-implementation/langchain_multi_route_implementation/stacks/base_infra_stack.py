@@ -55,6 +55,44 @@ class BaseInfraStack(Stack):
             # For example, to use PAY_PER_REQUEST billing mode, uncomment the following line:
             # billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST
         )
+        # List a user's sessions, most recently updated first, without scanning the table
+        self.memory_table.add_global_secondary_index(
+            index_name="UserSessionsIndex",
+            partition_key=dynamodb.Attribute(
+                name="UserId",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="UpdatedAt",
+                type=dynamodb.AttributeType.STRING
+            ),
+            projection_type=dynamodb.ProjectionType.KEYS_ONLY
+        )
+
+        # Older messages moved out of the session item, one item per message in order
+        self.memory_archive_table = dynamodb.Table(
+            self, "SessionArchiveTable",
+            partition_key=dynamodb.Attribute(
+                name="SessionId",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="MessageIndex",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST
+        )
+
+        # Persistent query embedding cache, used when EMBEDDING_CACHE_BACKEND is dynamodb
+        self.embedding_cache_table = dynamodb.Table(
+            self, "EmbeddingCacheTable",
+            partition_key=dynamodb.Attribute(
+                name="EmbeddingKey",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt"
+        )
 
         # create app execute role
         app_execute_role = iam.Role(self, "AppExecuteRole",
@@ -84,7 +122,8 @@ class BaseInfraStack(Stack):
                 actions=[
                     "dynamodb:*",
                 ],
-                resources=[self.memory_table.table_arn]
+                resources=[self.memory_table.table_arn, f"{self.memory_table.table_arn}/index/*",
+                           self.memory_archive_table.table_arn, self.embedding_cache_table.table_arn]
             )  
         )
         
@@ -1,4 +1,5 @@
 """Frontend stack for hosting Streamlit with ECS and Fargate"""
+import os
 import platform
 from constructs import Construct
 import aws_cdk as cdk
@@ -14,6 +15,9 @@ from aws_cdk import (
 )
 from aws_cdk.aws_ecr_assets import DockerImageAsset
 
+dirname = os.path.dirname(__file__)
+FRONTEND_DIR = "langchain-multi-route-implementation/langchain_multi_route_implementation/streamlit_frontend"
+
 
 class FrontendStack(Stack):
     """Frontend stack for hosting Streamlit with ECS and Fargate"""
@@ -31,9 +35,13 @@ class FrontendStack(Stack):
 
         # The code that defines your stack goes here
         # Build Docker image
+        # built from the repository root, which also holds the shared metrics_rollup modules
         imageAsset = DockerImageAsset(self, "FrontendStreamlitImage",
-                                      directory=(
-                                          "langchain_multi_route_implementation/streamlit_frontend/")
+                                      directory=os.path.join(dirname, "../../.."),
+                                      file=f"{FRONTEND_DIR}/Dockerfile",
+                                      exclude=["*", f"!{FRONTEND_DIR}", "!metrics_rollup",
+                                               "**/__pycache__"],
+                                      ignore_mode=cdk.IgnoreMode.DOCKER
                                       )
 
         ecs_cluster = ecs.Cluster(self, 'StreamlitAppCluster',
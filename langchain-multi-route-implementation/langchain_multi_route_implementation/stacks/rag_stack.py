@@ -1,6 +1,8 @@
 """Rag stack to provision OpenSearch vector search"""
+import os
 import platform
 import json
+import hashlib
 from constructs import Construct
 import aws_cdk as cdk
 from aws_cdk import (
@@ -15,14 +17,40 @@ from aws_cdk import (
 )
 from aws_cdk.custom_resources import Provider
 
+dirname = os.path.dirname(__file__)
+
+# k-NN method of the docs index, pick values with scripts/benchmark_knn.py
+DEFAULT_KNN_SETTINGS = {
+    "engine": "faiss",
+    "space_type": "l2",
+    "m": 16,
+    "ef_construction": 512,
+    "ef_search": 512,
+    "shards": 2,
+}
+
+
+def directory_hash(path):
+    """Hash of the files under path, so the index custom resource updates when the documents change"""
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
 
 class RagStack(Stack):
     """Rag stack to provision OpenSearch vector search"""
 
     def __init__(self, scope: Construct, construct_id: str,
                  data_bucket_name: str, data_path: str, oss_collection: str,
-                 app_execute_role: iam.Role, vpc: ec2.Vpc) -> None:
+                 app_execute_role: iam.Role, vpc: ec2.Vpc,
+                 knn_settings: dict = None, opensearch_enabled: bool = True) -> None:
         super().__init__(scope, construct_id)
+        knn_settings = {**DEFAULT_KNN_SETTINGS, **(knn_settings or {})}
 
         # in the given vpc, create opensearch client sg and cluster sg
         opensearch_client_sg = ec2.SecurityGroup(self, "OpensearchClientSg",
@@ -61,6 +89,14 @@ class RagStack(Stack):
             handler='index.on_event',
             architecture=architecture,
             timeout=Duration.seconds(900),
+            memory_size=1024,
+            environment={
+                'DOWNLOAD_CONCURRENCY': "16",
+                'EMBEDDING_CONCURRENCY': "8",
+                'EMBEDDING_BATCH_SIZE': "64",
+                'MANIFEST_KEY': "index_manifest/docs.json",
+                'SNAPSHOT_PREFIX': "index_snapshot/docs/"
+            },
             vpc=vpc,
             vpc_subnets=ec2.SubnetSelection(
                 subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
@@ -83,6 +119,24 @@ class RagStack(Stack):
                 ]
             )
         )
+        # manifest of the indexed files and chunks, read and rewritten on every update
+        custom_res_lambda.role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:PutObject"],
+                resources=[
+                    f"arn:aws:s3:::{data_bucket_name}/index_manifest/*",
+                ]
+            )
+        )
+        # vector snapshot for the app's local retriever backend, replaced on every update
+        custom_res_lambda.role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:PutObject", "s3:DeleteObject"],
+                resources=[
+                    f"arn:aws:s3:::{data_bucket_name}/index_snapshot/*",
+                ]
+            )
+        )
         custom_res_lambda.role.add_to_policy(
             iam.PolicyStatement(
                 actions=[
@@ -94,118 +148,126 @@ class RagStack(Stack):
             )
         )
 
-        vpc_endpoint = aws_opss.CfnVpcEndpoint(self, "OpssVpcEndpoint",
-                                               name="opensearch-vpc-endpoint",  # Expected maxLength: 32
-                                               vpc_id=vpc.vpc_id,
-                                               security_group_ids=[
-                                                   opensearch_cluster_sg.security_group_id],
-                                               subnet_ids=vpc.select_subnets(
-                                                   subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS).subnet_ids
-                                               )
-        vpc_endpoint.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
-
-        network_security_policy = json.dumps([{
-            "Rules": [
-                {
-                    "Resource": [
-                        f"collection/{oss_collection}"
-                    ],
-                    "ResourceType": "dashboard"
-                },
-                {
-                    "Resource": [
-                        f"collection/{oss_collection}"
-                    ],
-                    "ResourceType": "collection"
-                }
-            ],
-            "AllowFromPublic": False,
-            "SourceVPCEs": [
-                vpc_endpoint.ref
-            ]
-        }], indent=2)
-
-        cfn_network_security_policy = aws_opss.CfnSecurityPolicy(self, "NetworkSecurityPolicy",
-                                                                 policy=network_security_policy,
-                                                                 name=f"{oss_collection}-security-policy",
-                                                                 type="network"
-                                                                 )
-        encryption_security_policy = json.dumps({
-            "Rules": [
-                {
-                    "Resource": [
-                        f"collection/{oss_collection}"
-                    ],
-                    "ResourceType": "collection"
-                }
-            ],
-            "AWSOwnedKey": True
-        }, indent=2)
-
-        cfn_encryption_security_policy = aws_opss.CfnSecurityPolicy(self, "EncryptionSecurityPolicy",
-                                                                    policy=encryption_security_policy,
-                                                                    name=f"{oss_collection}-security-policy",
-                                                                    type="encryption"
-                                                                    )
-        cfn_collection = aws_opss.CfnCollection(self, "OpssSearchCollection",
-                                                name=oss_collection,
-                                                description="Collection to be used for search using OpenSearch Serverless vector search",
-                                                type="VECTORSEARCH"
-                                                )
-        cfn_collection.add_dependency(cfn_network_security_policy)
-        cfn_collection.add_dependency(cfn_encryption_security_policy)
-
-        data_access_policy = json.dumps([
-            {
+        self.opensearch_client_sg = opensearch_client_sg
+        self.opensearch_endpoint = ""
+        custom_res_dependencies = []
+        # without OpenSearch the custom resource only writes the snapshot for the local retriever backend
+        if opensearch_enabled:
+            vpc_endpoint = aws_opss.CfnVpcEndpoint(self, "OpssVpcEndpoint",
+                                                   name="opensearch-vpc-endpoint",  # Expected maxLength: 32
+                                                   vpc_id=vpc.vpc_id,
+                                                   security_group_ids=[
+                                                       opensearch_cluster_sg.security_group_id],
+                                                   subnet_ids=vpc.select_subnets(
+                                                       subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS).subnet_ids
+                                                   )
+            vpc_endpoint.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+
+            network_security_policy = json.dumps([{
                 "Rules": [
                     {
                         "Resource": [
                             f"collection/{oss_collection}"
                         ],
-                        "Permission": [
-                            "aoss:CreateCollectionItems",
-                            "aoss:DeleteCollectionItems",
-                            "aoss:UpdateCollectionItems",
-                            "aoss:DescribeCollectionItems"
-                        ],
-                        "ResourceType": "collection"
+                        "ResourceType": "dashboard"
                     },
                     {
                         "Resource": [
-                            f"index/{oss_collection}/*"
-                        ],
-                        "Permission": [
-                            "aoss:*",
+                            f"collection/{oss_collection}"
                         ],
-                        "ResourceType": "index"
+                        "ResourceType": "collection"
                     }
                 ],
-                "Principal": [
-                    f"{custom_res_lambda.role.role_arn}",
-                    f"{app_execute_role.role_arn}"
+                "AllowFromPublic": False,
+                "SourceVPCEs": [
+                    vpc_endpoint.ref
+                ]
+            }], indent=2)
+
+            cfn_network_security_policy = aws_opss.CfnSecurityPolicy(self, "NetworkSecurityPolicy",
+                                                                     policy=network_security_policy,
+                                                                     name=f"{oss_collection}-security-policy",
+                                                                     type="network"
+                                                                     )
+            encryption_security_policy = json.dumps({
+                "Rules": [
+                    {
+                        "Resource": [
+                            f"collection/{oss_collection}"
+                        ],
+                        "ResourceType": "collection"
+                    }
                 ],
-                "Description": "data-access-rule"
-            }
-        ], indent=2)
+                "AWSOwnedKey": True
+            }, indent=2)
 
-        data_access_policy_name = f"{oss_collection}-access-policy"
-        assert len(data_access_policy_name) <= 32
+            cfn_encryption_security_policy = aws_opss.CfnSecurityPolicy(self, "EncryptionSecurityPolicy",
+                                                                        policy=encryption_security_policy,
+                                                                        name=f"{oss_collection}-security-policy",
+                                                                        type="encryption"
+                                                                        )
+            cfn_collection = aws_opss.CfnCollection(self, "OpssSearchCollection",
+                                                    name=oss_collection,
+                                                    description="Collection to be used for search using OpenSearch Serverless vector search",
+                                                    type="VECTORSEARCH"
+                                                    )
+            cfn_collection.add_dependency(cfn_network_security_policy)
+            cfn_collection.add_dependency(cfn_encryption_security_policy)
 
-        aws_opss.CfnAccessPolicy(self, "OpssDataAccessPolicy",
-                                 name=data_access_policy_name,
-                                 description="Policy for data access",
-                                 policy=data_access_policy,
-                                 type="data"
-                                 )
+            data_access_policy = json.dumps([
+                {
+                    "Rules": [
+                        {
+                            "Resource": [
+                                f"collection/{oss_collection}"
+                            ],
+                            "Permission": [
+                                "aoss:CreateCollectionItems",
+                                "aoss:DeleteCollectionItems",
+                                "aoss:UpdateCollectionItems",
+                                "aoss:DescribeCollectionItems"
+                            ],
+                            "ResourceType": "collection"
+                        },
+                        {
+                            "Resource": [
+                                f"index/{oss_collection}/*"
+                            ],
+                            "Permission": [
+                                "aoss:*",
+                            ],
+                            "ResourceType": "index"
+                        }
+                    ],
+                    "Principal": [
+                        f"{custom_res_lambda.role.role_arn}",
+                        f"{app_execute_role.role_arn}"
+                    ],
+                    "Description": "data-access-rule"
+                }
+            ], indent=2)
 
-        custom_res_lambda.role.add_to_policy(
-            iam.PolicyStatement(
-                actions=[
-                    "aoss:APIAccessAll",
-                ],
-                resources=["*"]
+            data_access_policy_name = f"{oss_collection}-access-policy"
+            assert len(data_access_policy_name) <= 32
+
+            aws_opss.CfnAccessPolicy(self, "OpssDataAccessPolicy",
+                                     name=data_access_policy_name,
+                                     description="Policy for data access",
+                                     policy=data_access_policy,
+                                     type="data"
+                                     )
+
+            custom_res_lambda.role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        "aoss:APIAccessAll",
+                    ],
+                    resources=["*"]
+                )
             )
-        )
+
+            self.opensearch_endpoint = cfn_collection.attr_collection_endpoint
+            custom_res_dependencies = [vpc_endpoint, cfn_collection]
 
         custom_res_provider = Provider(self, "CustomResProvider",
                                        on_event_handler=custom_res_lambda,
@@ -213,12 +275,11 @@ class RagStack(Stack):
 
         custom_res = CustomResource(self, "IndexOpenSearch", service_token=custom_res_provider.service_token,
                                     properties={
-                                        "oss_endpoint": cfn_collection.attr_collection_endpoint,
+                                        "oss_endpoint": self.opensearch_endpoint,
                                         "bucket_name": data_bucket_name,
-                                        "data_path": data_path
+                                        "data_path": data_path,
+                                        "data_hash": directory_hash(os.path.join(dirname, f"../../../data/{data_path}")),
+                                        "knn_settings": knn_settings
                                     })
-        custom_res.node.add_dependency(vpc_endpoint)
-        custom_res.node.add_dependency(cfn_collection)
-
-        self.opensearch_client_sg = opensearch_client_sg
-        self.opensearch_endpoint = cfn_collection.attr_collection_endpoint
+        for dependency in custom_res_dependencies:
+            custom_res.node.add_dependency(dependency)
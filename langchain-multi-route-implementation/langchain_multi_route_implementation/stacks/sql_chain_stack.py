@@ -1,20 +1,35 @@
 """SQL Chain stack to provision Athana catalog"""
+import os
 from constructs import Construct
+import aws_cdk as cdk
 from aws_cdk import (
     Stack,
+    Duration,
+    CustomResource,
     aws_iam as iam,
     aws_glue as glue,
     aws_athena as athena,
     aws_s3 as s3,
+    aws_lambda as _lambda,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_dynamodb as dynamodb,
 )
 
 from aws_cdk.custom_resources import (
     AwsCustomResource,
     AwsCustomResourcePolicy,
     PhysicalResourceId,
-    AwsSdkCall
+    AwsSdkCall,
+    Provider
 )
 
+dirname = os.path.dirname(__file__)
+
+# hourly per-device rollup maintained by the compaction Lambda, the view adds the hours not rolled up yet
+ROLLUP_TABLE = "iot_device_metrics_hourly"
+ROLLUP_VIEW = "iot_device_metrics_hourly_all"
+
 
 class SqlChainStack(Stack):
     """SQL Chain stack to provision Athana catalog"""
@@ -22,7 +37,9 @@ class SqlChainStack(Stack):
     def __init__(self, scope: Construct, construct_id: str,
                  data_bucket: s3.Bucket, data_path: str,
                  athena_db: str, athena_workgroup: str,
-                 app_execute_role: iam.Role
+                 athena_table: str, athena_parquet_table: str,
+                 app_execute_role: iam.Role,
+                 result_reuse_minutes: int = 60
                  ) -> None:
         super().__init__(scope, construct_id)
 
@@ -75,8 +92,18 @@ class SqlChainStack(Stack):
 
         res.node.add_dependency(crawler)
 
-        # set up athena workgroup
-        athena.CfnWorkGroup(
+        # allow the app to check when the crawler last ran to invalidate its schema cache
+        app_execute_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["glue:GetCrawler"],
+                resources=[
+                    f"arn:aws:glue:{self.region}:{self.account}:crawler/{self.crawler_name}"]
+            )
+        )
+
+        # set up athena workgroup, query result reuse requires Athena engine version 3
+        self.result_reuse_minutes = result_reuse_minutes
+        workgroup = athena.CfnWorkGroup(
             self,
             "MrcAthenaWorkgroupId",
             name=athena_workgroup,
@@ -89,9 +116,75 @@ class SqlChainStack(Stack):
                         encryption_option="SSE_S3"
                     )
                 ),
+                engine_version=athena.CfnWorkGroup.EngineVersionProperty(
+                    selected_engine_version="Athena engine version 3"
+                ),
+            ),
+        )
+
+        # held by the compaction run in progress, so the schedule and the custom resource don't overlap
+        compaction_lock_table = dynamodb.Table(
+            self, "MetricsCompactionLockTable",
+            partition_key=dynamodb.Attribute(
+                name="LockId",
+                type=dynamodb.AttributeType.STRING
             ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            time_to_live_attribute="ExpiresAt"
         )
 
+        # compact the raw CSV into a Parquet table partitioned by device and date
+        compaction_lambda = _lambda.Function(
+            self, "MetricsCompactionLambda",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            code=_lambda.Code.from_asset(
+                os.path.join(dirname, "../../../metrics_rollup")),
+            handler='compaction.on_event',
+            timeout=Duration.seconds(900),
+            environment={
+                'ATHENA_DB': athena_db,
+                'ATHENA_WORKGROUP': athena_workgroup,
+                'CRAWLER_NAME': self.crawler_name,
+                'SOURCE_TABLE': athena_table,
+                'TARGET_TABLE': athena_parquet_table,
+                'TARGET_LOCATION': f"s3://{data_bucket.bucket_name}/{athena_parquet_table}/",
+                'ROLLUP_TABLE': ROLLUP_TABLE,
+                'ROLLUP_VIEW': ROLLUP_VIEW,
+                'ROLLUP_LOCATION': f"s3://{data_bucket.bucket_name}/{ROLLUP_TABLE}/",
+                'LOCK_TABLE': compaction_lock_table.table_name
+            },
+        )
+        compaction_lambda.role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name("AmazonAthenaFullAccess")
+        )
+        compaction_lambda.role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["glue:GetCrawler"],
+                resources=[
+                    f"arn:aws:glue:{self.region}:{self.account}:crawler/{self.crawler_name}"]
+            )
+        )
+        data_bucket.grant_read_write(compaction_lambda)
+        compaction_lock_table.grant_read_write_data(compaction_lambda)
+
+        compaction_provider = Provider(self, "MetricsCompactionProvider",
+                                       on_event_handler=compaction_lambda,
+                                       )
+        compaction_res = CustomResource(self, "MetricsCompaction",
+                                        service_token=compaction_provider.service_token,
+                                        properties={
+                                            "target_table": athena_parquet_table
+                                        })
+        compaction_res.node.add_dependency(res)
+        compaction_res.node.add_dependency(workgroup)
+
+        # append newly landed metrics every hour
+        events.Rule(self, "MetricsCompactionSchedule",
+                    schedule=events.Schedule.rate(Duration.hours(1)),
+                    targets=[targets.LambdaFunction(compaction_lambda)]
+                    )
+
     def start_crawler(self):
         """start the glue crawler"""
         params = {
@@ -0,0 +1,78 @@
+"""Shared event loop for running chains with ainvoke/astream from Streamlit script threads
+
+The runner owns one event loop on a background thread shared by all sessions;
+blocking boto3 calls made by the chains run on a bounded thread pool set as the
+loop's default executor.
+
+run() and stream() still block the calling script thread until the chain is done,
+so a session waits for its own turn exactly as on the synchronous path. Work that
+overlaps within a turn (the router and the speculative prefetch of
+SPECULATIVE_PREFETCH_ENABLED) is gathered on the loop instead of being spread over
+threads. The pool caps the blocking calls in flight across all sessions, so it
+must be sized for the expected concurrent sessions or it queues them.
+"""
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+class AsyncRunner:
+    """Run coroutines and async iterators on a background event loop from synchronous code"""
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chain-io")
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="chain-event-loop", daemon=True)
+        self._thread.start()
+        self._lock = threading.Lock()
+        self.active = 0
+        self.completed = 0
+
+    def _track(self, delta):
+        with self._lock:
+            self.active += delta
+            if delta < 0:
+                self.completed += 1
+
+    def run(self, coroutine):
+        """Run a coroutine on the shared loop and wait for its result"""
+        async def tracked():
+            self._track(1)
+            try:
+                return await coroutine
+            finally:
+                self._track(-1)
+        return asyncio.run_coroutine_threadsafe(tracked(), self._loop).result()
+
+    def stream(self, async_iterable):
+        """Iterate an async iterable on the shared loop, yielding its items synchronously"""
+        items = queue.Queue()
+
+        async def pump():
+            self._track(1)
+            try:
+                async for item in async_iterable:
+                    items.put(item)
+            except Exception as e:
+                items.put(e)
+            finally:
+                items.put(_DONE)
+                self._track(-1)
+
+        asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def stats(self):
+        with self._lock:
+            return {"max_workers": self.max_workers, "active": self.active, "completed": self.completed}
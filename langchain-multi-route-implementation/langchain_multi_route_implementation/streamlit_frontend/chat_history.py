@@ -0,0 +1,219 @@
+"""Write-through cached, token-bounded chat history stored in DynamoDB
+
+DynamoDBChatMessageHistory issues a get_item on every access to .messages and a
+get_item plus put_item for every added message, so each RunnableWithMessageHistory
+wrapper re-reads the whole (growing) session item during a turn. This history
+reads the item once when it is first needed, keeps the messages in memory and
+writes them back in a single put_item when flushed. The item layout (SessionId,
+History) is the same as DynamoDBChatMessageHistory's, so existing chats still load.
+
+The session item only keeps a window of recent messages within a token budget.
+When a flush overflows the budget, the oldest messages are moved to the archive
+table (one item per message, sorted by MessageIndex) and folded into a rolling
+summary, which is returned ahead of the window so prompts stay a bounded size.
+
+Each session item also carries the UserId and UpdatedAt keys of the per-user
+index, so a user's chats are listed newest first with a paginated Query.
+"""
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import SystemMessage, message_to_dict, messages_from_dict, messages_to_dict
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+USER_SESSIONS_INDEX = "UserSessionsIndex"
+SESSION_NAME_FORMAT = "Chat - %a %b %d @ %H:%M:%S"
+SESSION_ID_SEPARATOR = " | "
+
+
+def estimate_tokens(messages):
+    """Rough token count, about four characters per token"""
+    return sum(len(str(message.content)) // 4 + 1 for message in messages)
+
+
+def new_session_id(now=None):
+    """Readable name of a new chat followed by a uuid4, the name alone is shared by chats started in the same second"""
+    return f"{(now or datetime.now()).strftime(SESSION_NAME_FORMAT)}{SESSION_ID_SEPARATOR}{uuid.uuid4()}"
+
+
+def session_title(session_id):
+    """Name of a chat shown in the session picker, sessions created before the uuid suffix are their own name"""
+    return session_id.split(SESSION_ID_SEPARATOR)[0]
+
+
+def list_sessions(table, user_id, limit, start_key=None):
+    """Return one page of the user's session ids, most recently updated first, and the key of the next page"""
+    query = {
+        "IndexName": USER_SESSIONS_INDEX,
+        "KeyConditionExpression": Key("UserId").eq(user_id),
+        "ScanIndexForward": False,
+        "Limit": limit,
+    }
+    if start_key:
+        query["ExclusiveStartKey"] = start_key
+    response = table.query(**query)
+    return [item["SessionId"] for item in response.get("Items", [])], response.get("LastEvaluatedKey")
+
+
+def delete_session(table, archive_table, session_id):
+    """Delete a chat session and its archived messages"""
+    table.delete_item(Key={"SessionId": session_id})
+    if archive_table is None:
+        return
+    query = {"KeyConditionExpression": Key("SessionId").eq(session_id), "ProjectionExpression": "SessionId, MessageIndex"}
+    with archive_table.batch_writer() as batch:
+        while True:
+            response = archive_table.query(**query)
+            for item in response.get("Items", []):
+                batch.delete_item(Key={"SessionId": item["SessionId"], "MessageIndex": item["MessageIndex"]})
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+class CachedChatMessageHistory(BaseChatMessageHistory):
+    """Chat history loaded once per Streamlit rerun, appended locally and flushed in one write"""
+
+    def __init__(self, table, session_id, user_id, archive_table=None, token_budget=None, summarize_fn=None,
+                 min_messages=2):
+        self.table = table
+        self.session_id = session_id
+        self.user_id = user_id
+        self.archive_table = archive_table
+        self.token_budget = token_budget
+        self.summarize_fn = summarize_fn
+        self.min_messages = min_messages
+        self.summary = ""
+        self.archived_count = 0
+        self._messages = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        # serializes flushes, which archive and summarize without holding _lock
+        self._flush_lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.summaries = 0
+
+    def _load(self):
+        if self._messages is None:
+            item = self.table.get_item(Key={"SessionId": self.session_id}).get("Item", {})
+            self.reads += 1
+            self._messages = messages_from_dict(item.get("History", []))
+            self.summary = item.get("Summary", "")
+            self.archived_count = int(item.get("ArchivedCount", 0))
+        return self._messages
+
+    @property
+    def messages(self):
+        """The rolling summary, if any, followed by the recent message window"""
+        with self._lock:
+            window = list(self._load())
+        if self.summary:
+            return [SystemMessage(content=SUMMARY_PREFIX + self.summary)] + window
+        return window
+
+    def add_messages(self, messages):
+        """Append locally, the messages are written on the next flush()"""
+        with self._lock:
+            self._messages = self._load() + list(messages)
+            self._dirty = True
+
+    def _archive_overflow(self):
+        """Move the oldest messages over the token budget to the archive and fold them into the summary
+
+        The archive write and the summary run without the lock, so readers and
+        add_messages don't wait for them, and the messages only leave the window
+        once both succeeded.
+        """
+        with self._lock:
+            window = list(self._messages)
+            archived_count, summary = self.archived_count, self.summary
+        count = 0
+        while (len(window) - count > self.min_messages
+               and estimate_tokens(window[count:]) > self.token_budget):
+            count += 1
+        if not count:
+            return
+        overflow = window[:count]
+        try:
+            with self.archive_table.batch_writer() as batch:
+                for offset, message in enumerate(overflow):
+                    batch.put_item(Item={
+                        "SessionId": self.session_id,
+                        "MessageIndex": archived_count + offset,
+                        "Message": message_to_dict(message),
+                    })
+            if self.summarize_fn is not None:
+                summary = self.summarize_fn(summary, overflow)
+        except Exception as e:
+            # the next flush archives them again under the same MessageIndex
+            print(f"WARN: Unable to archive messages of {self.session_id}, keeping them in the window: {str(e)}")
+            return
+        with self._lock:
+            if (self.archived_count != archived_count or len(self._messages) < count
+                    or any(a is not b for a, b in zip(self._messages, overflow))):
+                # the history was cleared meanwhile
+                return
+            del self._messages[:count]
+            self.archived_count += count
+            if self.summarize_fn is not None:
+                self.summary = summary
+                self.summaries += 1
+        print(f"INFO: Archived {count} messages of {self.session_id}, {archived_count + count} archived in total")
+
+    def flush(self):
+        """Write the history back with a single put_item if it changed, archiving messages over the budget"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+            if self.token_budget is not None and self.archive_table is not None:
+                self._archive_overflow()
+            with self._lock:
+                item = {
+                    "SessionId": self.session_id,
+                    "UserId": self.user_id,
+                    "UpdatedAt": datetime.now(timezone.utc).isoformat(),
+                    "History": messages_to_dict(self._messages),
+                }
+                if self.archived_count:
+                    item.update({"Summary": self.summary, "ArchivedCount": self.archived_count})
+                self.table.put_item(Item=item)
+                self.writes += 1
+                self._dirty = False
+
+    def load_archived(self):
+        """Return the archived messages of this session, oldest first"""
+        if self.archive_table is None:
+            return []
+        query = {"KeyConditionExpression": Key("SessionId").eq(self.session_id)}
+        items = []
+        while True:
+            response = self.archive_table.query(**query)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return messages_from_dict([item["Message"] for item in items])
+
+    def clear(self):
+        with self._lock:
+            delete_session(self.table, self.archive_table, self.session_id)
+            self._messages = []
+            self.summary = ""
+            self.archived_count = 0
+            self._dirty = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "reads": self.reads,
+                "writes": self.writes,
+                "summaries": self.summaries,
+                "window_messages": len(self._messages) if self._messages is not None else None,
+                "window_tokens": estimate_tokens(self._messages) if self._messages is not None else None,
+                "archived_messages": self.archived_count,
+            }
@@ -0,0 +1,117 @@
+"""Assemble retrieved chunks into a compact RAG context
+
+The retriever returns overlapping chunks (chunk_overlap=200 at ingestion) and the
+prompt used to receive the repr of the Document list, metadata included.
+compress_context drops duplicate chunks, merges chunks of the same file whose
+text overlaps into one passage, keeps only the file name as a header and stops
+at a token budget, best-ranked passages first.
+"""
+import os
+import re
+import threading
+
+MIN_OVERLAP = 20
+MAX_OVERLAP = 400
+BLANK_LINES_PATTERN = re.compile(r"[ \t]+\n")
+
+
+def estimate_tokens(text):
+    """Rough token count, about four characters per token"""
+    return len(text) // 4 + 1
+
+
+def overlap_length(left, right):
+    """Length of the longest suffix of left that is a prefix of right, 0 below MIN_OVERLAP"""
+    for length in range(min(len(left), len(right), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+def merge_text(passage, text):
+    """passage and text of the same file as one string, None when they don't overlap"""
+    if text in passage:
+        return passage
+    if passage in text:
+        return text
+    # chunks are merged in whichever order they are adjacent in the file
+    after = overlap_length(passage, text)
+    if after:
+        return passage + text[after:]
+    before = overlap_length(text, passage)
+    if before:
+        return text + passage[before:]
+    return None
+
+
+def merge_passages(documents):
+    """Return [(source, text)] in rank order, with duplicate and overlapping chunks merged"""
+    passages = []
+    for document in documents:
+        source = os.path.basename(document.metadata.get("source", "")) or "document"
+        text = BLANK_LINES_PATTERN.sub("\n", document.page_content.strip())
+        merged = None
+        for i, (passage_source, passage) in enumerate(passages):
+            merged = merge_text(passage, text) if passage_source == source else None
+            if merged is not None:
+                break
+        if merged is None:
+            passages.append((source, text))
+            continue
+        passages[i] = (source, merged)
+        # a grown passage can bridge other passages of the file, e.g. chunk 1 joining chunks 0 and 2
+        j = 0
+        while j < len(passages):
+            grown = merge_text(passages[i][1], passages[j][1]) if j != i and passages[j][0] == source else None
+            if grown is None:
+                j += 1
+                continue
+            first, second = min(i, j), max(i, j)
+            passages[first] = (source, grown)
+            del passages[second]
+            i, j = first, 0
+    return passages
+
+
+def compress_context(documents, token_budget):
+    """Return the context text for the prompt and the {before, after} token counts"""
+    before = estimate_tokens(str(documents))
+    sections, used = [], 0
+    for source, text in merge_passages(documents):
+        section = f"[{source}]\n{text}"
+        tokens = estimate_tokens(section)
+        if used + tokens > token_budget:
+            remaining = (token_budget - used) * 4
+            # cut the last passage at a line boundary
+            cut = section.rfind("\n", 0, remaining)
+            if remaining > MAX_OVERLAP and cut > 0:
+                sections.append(section[:cut])
+            break
+        sections.append(section)
+        used += tokens
+    context = "\n\n".join(sections)
+    return context, {"before": before, "after": estimate_tokens(context)}
+
+
+class ContextStats:
+    """Token counts of the RAG context before and after compression"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contexts = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def record(self, counts):
+        with self._lock:
+            self.contexts += 1
+            self.tokens_before += counts["before"]
+            self.tokens_after += counts["after"]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "contexts": self.contexts,
+                "mean_tokens_before": round(self.tokens_before / self.contexts) if self.contexts else 0,
+                "mean_tokens_after": round(self.tokens_after / self.contexts) if self.contexts else 0,
+            }
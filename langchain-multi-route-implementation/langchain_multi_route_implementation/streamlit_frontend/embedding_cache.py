@@ -0,0 +1,125 @@
+"""Bounded LRU cache for query embeddings, optionally persisted to SQLite or DynamoDB
+
+Every retrieval, fast router classification and semantic SQL cache lookup embeds
+its question with a Bedrock round trip, even when the same question was embedded
+a moment ago. CachedEmbeddings keeps recent query vectors in memory keyed on the
+model id and normalized text, and can fall back to a persistent store so the
+cache survives container restarts. Document embeddings are passed through.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from query_cache import normalize_question
+
+
+class SqliteEmbeddingStore:
+    """Embeddings persisted in a local SQLite file"""
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32).tolist() if row else None
+
+    def put(self, key, vector):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                                     (key, np.asarray(vector, dtype=np.float32).tobytes()))
+            self._connection.commit()
+
+
+class DynamoDBEmbeddingStore:
+    """Embeddings persisted in a DynamoDB table keyed on EmbeddingKey, expiring after ttl_seconds"""
+
+    def __init__(self, table, ttl_seconds=30 * 24 * 3600):
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key):
+        item = self.table.get_item(Key={"EmbeddingKey": key}).get("Item")
+        return np.frombuffer(item["Vector"].value, dtype=np.float32).tolist() if item else None
+
+    def put(self, key, vector):
+        self.table.put_item(Item={
+            "EmbeddingKey": key,
+            "Vector": np.asarray(vector, dtype=np.float32).tobytes(),
+            "ExpiresAt": int(time.time()) + self.ttl_seconds,
+        })
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper caching embed_query results with LRU eviction and an optional persistent store"""
+
+    def __init__(self, embeddings, model_id, max_entries=1024, store=None):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_id}\n{normalize_question(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def embed_query(self, text):
+        key = self._key(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+        if self.store is not None:
+            try:
+                vector = self.store.get(key)
+            except Exception as e:
+                print(f"WARN: Unable to read the embedding cache store: {str(e)}")
+            if vector is not None:
+                with self._lock:
+                    self.store_hits += 1
+                self._remember(key, vector)
+                return vector
+        vector = self.embeddings.embed_query(text)
+        with self._lock:
+            self.misses += 1
+        self._remember(key, vector)
+        if self.store is not None:
+            try:
+                self.store.put(key, vector)
+            except Exception as e:
+                print(f"WARN: Unable to write the embedding cache store: {str(e)}")
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.store_hits + self.misses
+            return {
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.store_hits) / lookups, 3) if lookups else 0,
+                "entries": len(self._entries),
+            }
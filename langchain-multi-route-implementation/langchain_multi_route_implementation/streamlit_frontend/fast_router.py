@@ -0,0 +1,169 @@
+"""Local pre-router that classifies clear-cut questions without an LLM call
+
+The router LLM is only needed when a question is ambiguous or depends on the
+chat history (e.g. "what about its pressure?"). Clear cases are classified with
+keyword rules combined with a nearest-centroid match over example questions,
+and fall back to the LLM router when the confidence is below a threshold.
+"""
+import json
+import re
+import threading
+from collections import Counter, namedtuple
+
+import numpy as np
+
+RouteDecision = namedtuple("RouteDecision", ["destination", "next_inputs", "confidence"])
+
+DEVICE_ID_PATTERN = re.compile(r"\b\d{4,}\b")
+
+# Questions referring back to the conversation need the LLM router to rewrite next_inputs
+CONTEXT_PATTERN = re.compile(
+    r"\b(it|its|it's|that|this|those|these|them|same|previous|above|again)\b")
+
+ROUTE_KEYWORDS = {
+    "lambdachain": re.compile(
+        r"\b(shut\s*down|turn\s*(on|off)|switch\s*(on|off)|restart|reboot|power\s*(on|off)|terminate|"
+        r"start\s+(up\s+)?device|stop\s+device)\b"),
+    "sql": re.compile(
+        r"\b(max|maximum|min|minimum|avg|average|mean|sum|count|highest|lowest|latest|last\s+\d+\s+(hours?|days?|minutes?)|"
+        r"oil(\s+level)?|temperature|pressure|metrics?|readings?)\b"),
+    "rag": re.compile(
+        r"\b(what do you know|tell me about|spec(ification)?s?|features?|install(ation)?|maintenance|"
+        r"troubleshoot(ing)?|warranty|safety|manual|documentation|support)\b"),
+    "physics": re.compile(
+        r"\b(physics|velocity|acceleration|momentum|newton|gravity|gravitational|thermodynamics?|entropy|"
+        r"quantum|relativity|kinetic|joule|electromagnetic|friction)\b"),
+    "default": re.compile(
+        r"^(hi|hello|hey|thanks|thank you|good (morning|afternoon|evening))\b|\bsumm(ary|arize|arise)\b"),
+}
+
+# Routes that act on a specific device need an explicit device id in the question
+DEVICE_ROUTES = {"lambdachain", "sql", "rag"}
+
+ROUTE_EXAMPLES = {
+    "lambdachain": [
+        "shutdown device 1007",
+        "turn on device 1002",
+        "restart device 1010",
+        "please turn off the engine of device 1004",
+        "reboot device 1001",
+    ],
+    "sql": [
+        "give me max metrics for device 1007",
+        "what is the max pressure for 1003",
+        "average temperature of device 1016 in the last 6 hours",
+        "minimum oil level for device 1012",
+        "show the latest readings for device 1005",
+    ],
+    "rag": [
+        "what do you know about device 1003?",
+        "what are the technical specifications of device 1008",
+        "how do I install device 1001",
+        "maintenance and troubleshooting steps for device 1006",
+        "what is the warranty for device 1009",
+    ],
+    "physics": [
+        "what is newton's second law",
+        "explain the difference between velocity and acceleration",
+        "how does thermodynamics explain heat transfer",
+        "what is kinetic energy",
+        "why does friction produce heat",
+    ],
+    "default": [
+        "hello",
+        "thank you",
+        "provide a summary of our conversation",
+        "who are you",
+        "what can you help me with",
+    ],
+}
+
+
+class FastRouter:
+    """Classify questions with keyword rules plus nearest-centroid embeddings"""
+
+    def __init__(self, embeddings=None, threshold=0.7, rule_weight=0.5, temperature=0.05):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.rule_weight = rule_weight
+        self.temperature = temperature
+        self.routes = list(ROUTE_EXAMPLES)
+        self._centroids = None
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.fallbacks = Counter()
+
+    def _get_centroids(self):
+        """Embed the example questions once and return the normalized route centroids"""
+        with self._lock:
+            if self._centroids is None:
+                centroids = []
+                for route in self.routes:
+                    vectors = np.array(self.embeddings.embed_documents(ROUTE_EXAMPLES[route]))
+                    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                    centroid = vectors.mean(axis=0)
+                    centroids.append(centroid / np.linalg.norm(centroid))
+                self._centroids = np.vstack(centroids)
+            return self._centroids
+
+    def _rule_scores(self, question):
+        matched = [route for route in self.routes if ROUTE_KEYWORDS[route].search(question)]
+        # Device actions win over the metric words they often contain ("shutdown device 1007 pressure")
+        if "lambdachain" in matched:
+            matched = ["lambdachain"]
+        # Only a single unambiguous rule match counts as evidence
+        return {matched[0]: 1.0} if len(matched) == 1 else {}
+
+    def _embedding_scores(self, question):
+        if self.embeddings is None:
+            return {}
+        vector = np.array(self.embeddings.embed_query(question))
+        similarities = self._get_centroids() @ (vector / np.linalg.norm(vector))
+        weights = np.exp((similarities - similarities.max()) / self.temperature)
+        probabilities = weights / weights.sum()
+        return dict(zip(self.routes, probabilities.tolist()))
+
+    def classify(self, question):
+        """Return the best destination for the question with a confidence between 0 and 1"""
+        text = question.lower().strip()
+        rule_scores = self._rule_scores(text)
+        embedding_scores = self._embedding_scores(text)
+        embedding_weight = 1 - self.rule_weight if embedding_scores else 0
+        rule_weight = self.rule_weight if embedding_scores else 1
+        scores = {
+            route: rule_weight * rule_scores.get(route, 0) + embedding_weight * embedding_scores.get(route, 0)
+            for route in self.routes
+        }
+        destination = max(scores, key=scores.get)
+        confidence = scores[destination]
+
+        has_device_id = DEVICE_ID_PATTERN.search(text) is not None
+        if destination in DEVICE_ROUTES and not has_device_id and "all devices" not in text:
+            confidence = 0
+        if CONTEXT_PATTERN.search(text) and not has_device_id:
+            confidence = 0
+        return RouteDecision(destination, question, confidence)
+
+    def route(self, question):
+        """Return a RouteDecision for confident classifications, None to fall back to the LLM router"""
+        decision = self.classify(question)
+        with self._lock:
+            if decision.confidence >= self.threshold:
+                self.hits[decision.destination] += 1
+                return decision
+            self.fallbacks[decision.destination] += 1
+        return None
+
+    def stats(self):
+        """Per-route hit and fallback counters"""
+        with self._lock:
+            return {
+                route: {"hits": self.hits[route], "fallbacks": self.fallbacks[route]}
+                for route in self.routes
+            }
+
+    @staticmethod
+    def to_topic(decision):
+        """Format a decision like the router LLM's markdown JSON output"""
+        body = json.dumps({"destination": decision.destination, "next_inputs": decision.next_inputs}, indent=4)
+        return f"```json\n{body}\n```"
@@ -0,0 +1,128 @@
+"""Hybrid lexical + k-NN retrieval with reciprocal rank fusion and a local reranker
+
+Pure k-NN over the device documents often ranks chunks of another device first,
+because "device 1007" and "device 1003" embed almost identically. HybridRetriever
+runs each searcher (OpenSearch BM25 and k-NN, or the local index) for a candidate
+pool, pre-filtered to the device named in the question when there is one, fuses
+the ranked lists with reciprocal rank fusion and reranks the candidates by how
+many question terms they contain, keeping only the best k chunks for the prompt.
+"""
+import re
+import threading
+from typing import Any, List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+DEVICE_ID_PATTERN = re.compile(r"\bdevice[\s_#-]*(?:id[\s:#-]*)?(\d{4,})\b", re.IGNORECASE)
+TERM_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = {"a", "an", "the", "of", "for", "to", "in", "on", "is", "are", "what", "how", "do", "does", "i",
+              "can", "and", "or", "with", "my", "me", "about", "which", "be", "should", "device"}
+RRF_K = 60
+
+
+def detect_device_id(text):
+    """Device number named in the question, e.g. "1007" for "how do I install device 1007?" """
+    match = DEVICE_ID_PATTERN.search(text or "")
+    return match.group(1) if match else None
+
+
+def terms(text):
+    return {term for term in TERM_PATTERN.findall(text.lower()) if term not in STOP_WORDS}
+
+
+def document_key(document):
+    return document.metadata.get("source"), document.page_content
+
+
+def reciprocal_rank_fusion(ranked_lists, rrf_k=RRF_K):
+    """Fuse ranked document lists, return [(document, score)] best first"""
+    scores, documents = {}, {}
+    for ranked in ranked_lists:
+        for rank, document in enumerate(ranked):
+            key = document_key(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(((documents[key], score) for key, score in scores.items()), key=lambda item: -item[1])
+
+
+def rerank(question, fused, k, term_weight=0.05):
+    """Rerank fused candidates by the share of question terms they contain"""
+    question_terms = terms(question)
+    if not question_terms:
+        return [document for document, _ in fused[:k]]
+    scored = [
+        (document, score + term_weight * len(question_terms & terms(document.page_content)) / len(question_terms))
+        for document, score in fused
+    ]
+    scored.sort(key=lambda item: -item[1])
+    return [document for document, _ in scored[:k]]
+
+
+def opensearch_searchers(client, index_name, embeddings, device_filter_fn):
+    """BM25 and k-NN searchers over the docs index; device_filter_fn maps a device id to a query filter"""
+    def to_documents(response):
+        return [Document(page_content=hit["_source"]["text"], metadata=hit["_source"].get("metadata", {}))
+                for hit in response["hits"]["hits"]]
+
+    def lexical(question, device_id, size):
+        query = {"match": {"text": question}}
+        if device_id:
+            query = {"bool": {"must": [query], "filter": [device_filter_fn(device_id)]}}
+        return to_documents(client.search(index=index_name, body={
+            "size": size, "_source": {"excludes": ["vector_field"]}, "query": query}))
+
+    def knn(question, device_id, size):
+        clause = {"vector": embeddings.embed_query(question), "k": size}
+        if device_id:
+            # filtered while searching the graph rather than after the top k were picked
+            clause["filter"] = device_filter_fn(device_id)
+        return to_documents(client.search(index=index_name, body={
+            "size": size, "_source": {"excludes": ["vector_field"]}, "query": {"knn": {"vector_field": clause}}}))
+
+    return [lexical, knn]
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuses the ranked candidates of several searchers, each called as searcher(question, device_id, size)"""
+
+    searchers: List[Any]
+    k: int = 3
+    candidates: int = 10
+    retrieval_stats: Any = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        device_id = detect_device_id(query)
+        ranked_lists = [searcher(query, device_id, self.candidates) for searcher in self.searchers]
+        if device_id and not any(ranked_lists):
+            # unknown device number, search the whole corpus
+            ranked_lists = [searcher(query, None, self.candidates) for searcher in self.searchers]
+            device_id = None
+        fused = reciprocal_rank_fusion(ranked_lists)
+        if self.retrieval_stats is not None:
+            self.retrieval_stats.record(device_id is not None, len(fused))
+        return rerank(query, fused, self.k)
+
+
+class RetrievalStats:
+    """Share of device-filtered retrievals and the mean candidate pool size"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retrievals = 0
+        self.device_filtered = 0
+        self.candidates = 0
+
+    def record(self, device_filtered, candidates):
+        with self._lock:
+            self.retrievals += 1
+            self.device_filtered += int(device_filtered)
+            self.candidates += candidates
+
+    def stats(self):
+        with self._lock:
+            return {
+                "retrievals": self.retrievals,
+                "device_filtered": self.device_filtered,
+                "mean_candidates": round(self.candidates / self.retrievals, 1) if self.retrievals else 0,
+            }
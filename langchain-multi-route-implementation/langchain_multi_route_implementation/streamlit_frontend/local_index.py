@@ -0,0 +1,133 @@
+"""In-process vector index loaded from the snapshot written by the indexing custom resource
+
+The device documents are a few hundred KB of vectors, so a `rag` turn doesn't need
+a network k-NN search: LocalVectorIndex downloads the latest snapshot
+(vectors.npy and chunks.json under index_snapshot/docs/<version>/ in the data
+bucket), memory-maps the vectors and answers with an exact NumPy L2 search, the
+same distance as the OpenSearch index, optionally restricted to one device's
+chunks. A daemon thread polls latest.json and swaps in a new snapshot when the
+documents are re-indexed.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+SOURCE_DEVICE_PATTERN = re.compile(r"device_(\d+)")
+
+
+class LocalVectorIndex:
+    """Exact L2 search over a memory-mapped snapshot, refreshed in the background"""
+
+    def __init__(self, s3_client, bucket, prefix="index_snapshot/docs/", local_dir="/tmp/local_index",
+                 refresh_seconds=300):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.local_dir = local_dir
+        self.refresh_seconds = refresh_seconds
+        # (version, vectors, squared norms, chunks, {device id: row indices}), replaced as a whole on refresh
+        self._snapshot = (None, None, None, [], {})
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.search_seconds = 0.0
+        self.refreshes = 0
+
+    def load(self):
+        """Load the latest snapshot if its version changed, return True when a new one was loaded"""
+        latest = json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=f"{self.prefix}latest.json")["Body"].read())
+        version = latest["version"]
+        current = self._snapshot[0]
+        if version == current:
+            return False
+        directory = os.path.join(self.local_dir, version)
+        os.makedirs(directory, exist_ok=True)
+        for name in ["vectors.npy", "chunks.json"]:
+            self.s3_client.download_file(self.bucket, f"{self.prefix}{version}/{name}", os.path.join(directory, name))
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "chunks.json")) as f:
+            chunks = json.load(f)
+        norms = np.einsum("ij,ij->i", vectors, vectors) if len(chunks) else None
+        device_rows = {}
+        for row, chunk in enumerate(chunks):
+            device_id = chunk["metadata"].get("device_id")
+            if not device_id:
+                # snapshots written before chunks carried a device_id
+                match = SOURCE_DEVICE_PATTERN.search(chunk["metadata"].get("source", ""))
+                device_id = match.group(1) if match else None
+            if device_id:
+                device_rows.setdefault(device_id, []).append(row)
+        device_rows = {device_id: np.asarray(rows) for device_id, rows in device_rows.items()}
+        self._snapshot = (version, vectors, norms, chunks, device_rows)
+        with self._lock:
+            self.refreshes += 1
+        if current:
+            # searches still holding the old arrays keep the unlinked files mapped
+            shutil.rmtree(os.path.join(self.local_dir, current), ignore_errors=True)
+        print(f"Loaded local index snapshot {version} with {len(chunks)} chunks")
+        return True
+
+    def start_refresh(self):
+        """Poll for new snapshots on a daemon thread"""
+        def refresh():
+            while True:
+                time.sleep(self.refresh_seconds)
+                try:
+                    self.load()
+                except Exception as e:
+                    print(f"WARN: Unable to refresh the local index: {str(e)}")
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def search(self, vector, k=4, device_id=None):
+        start = time.perf_counter()
+        _, vectors, norms, chunks, device_rows = self._snapshot
+        if not chunks:
+            return []
+        rows = None
+        if device_id:
+            rows = device_rows.get(device_id)
+            if rows is None:
+                return []
+            vectors, norms = vectors[rows], norms[rows]
+        query = np.asarray(vector, dtype=np.float32)
+        # |x - q|^2 without the |q|^2 term, which doesn't change the order
+        distances = norms - 2 * (vectors @ query)
+        k = min(k, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        if rows is not None:
+            top = rows[top]
+        documents = [Document(page_content=chunks[i]["text"], metadata=chunks[i]["metadata"]) for i in top]
+        with self._lock:
+            self.searches += 1
+            self.search_seconds += time.perf_counter() - start
+        return documents
+
+    def stats(self):
+        version, _, _, chunks, _ = self._snapshot
+        with self._lock:
+            return {
+                "version": version,
+                "chunks": len(chunks),
+                "refreshes": self.refreshes,
+                "searches": self.searches,
+                "mean_search_ms": round(1000 * self.search_seconds / self.searches, 3) if self.searches else 0,
+            }
+
+
+class LocalIndexRetriever(BaseRetriever):
+    """Retriever embedding the query and searching a LocalVectorIndex"""
+
+    index: Any
+    embeddings: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return self.index.search(self.embeddings.embed_query(query), self.k)
@@ -0,0 +1,81 @@
+"""Per-chain model selection
+
+Routing, SQL generation and the lambda JSON extraction are short classification
+or extraction tasks that a small model answers faster and cheaper; only the
+open-ended answers benefit from a larger model. ModelRegistry maps each chain
+name to a Bedrock model id and its decoding parameters, starting from
+DEFAULT_MODELS and overridden per chain with the MODEL_CONFIG JSON, e.g.
+
+    MODEL_CONFIG='{"rag": {"model_id": "anthropic.claude-3-haiku-20240307-v1:0", "max_tokens": 500}}'
+
+Chains configured with the same model and parameters share one client.
+"""
+import json
+import threading
+
+from langchain_aws import ChatBedrockConverse
+
+SMALL_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+LARGE_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+DEFAULT_MODELS = {
+    "router": {"model_id": SMALL_MODEL_ID, "max_tokens": 200, "temperature": 0},
+    "sql": {"model_id": SMALL_MODEL_ID, "max_tokens": 300, "temperature": 0},
+    "sql_result": {"model_id": SMALL_MODEL_ID, "max_tokens": 300, "temperature": 0},
+    "lambda": {"model_id": SMALL_MODEL_ID, "max_tokens": 200, "temperature": 0},
+    "lambda_summary": {"model_id": SMALL_MODEL_ID, "max_tokens": 100, "temperature": 0},
+    "summary": {"model_id": SMALL_MODEL_ID, "max_tokens": 300, "temperature": 0},
+    "rag": {"model_id": LARGE_MODEL_ID, "max_tokens": 500, "temperature": 0},
+    "physics": {"model_id": LARGE_MODEL_ID, "max_tokens": 500, "temperature": 0},
+    "general": {"model_id": LARGE_MODEL_ID, "max_tokens": 300, "temperature": 0},
+}
+
+
+def parse_model_config(value):
+    """Per-chain overrides from the MODEL_CONFIG JSON, {} when unset"""
+    if not value:
+        return {}
+    overrides = json.loads(value)
+    unknown = set(overrides) - set(DEFAULT_MODELS)
+    if unknown:
+        raise ValueError(f"Unknown chains in MODEL_CONFIG: {', '.join(sorted(unknown))}")
+    return overrides
+
+
+class ModelRegistry:
+    """Chat model and decoding parameters of each chain"""
+
+    def __init__(self, region_name, overrides=None, default_model_id=None, prompt_caching=False):
+        self.region_name = region_name
+        self.configs = {}
+        for name, config in DEFAULT_MODELS.items():
+            config = {**config, "prompt_caching": prompt_caching}
+            if default_model_id:
+                config["model_id"] = default_model_id
+            self.configs[name] = {**config, **(overrides or {}).get(name, {})}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def config(self, name):
+        return self.configs[name]
+
+    def prompt_caching(self, name):
+        """Whether the chain's prompt gets a cache point, only for models with prompt caching"""
+        return bool(self.configs[name].get("prompt_caching"))
+
+    def get(self, name):
+        """Chat model of the chain, shared between chains with the same configuration"""
+        config = self.configs[name]
+        key = (config["model_id"], config.get("max_tokens"), config.get("temperature"), config.get("top_p"))
+        with self._lock:
+            if key not in self._models:
+                kwargs = {"max_tokens": config.get("max_tokens"), "temperature": config.get("temperature")}
+                if config.get("top_p") is not None:
+                    kwargs["top_p"] = config["top_p"]
+                self._models[key] = ChatBedrockConverse(region_name=self.region_name, model=config["model_id"],
+                                                        **kwargs)
+            return self._models[key]
+
+    def describe(self):
+        """Model id per chain, for the performance stats"""
+        return {name: config["model_id"] for name, config in self.configs.items()}
@@ -0,0 +1,26 @@
+"""Pooled OpenSearch Serverless connection settings with a refreshable SigV4 signer
+
+AWS4Auth signs with the static key snapshot it was created with, so requests fail
+once the ECS task's temporary credentials rotate, and RequestsHttpConnection opens
+a new requests session per client. Urllib3AWSV4SignerAuth signs every request with
+the current frozen credentials of a botocore (refreshable) credentials object, and
+Urllib3HttpConnection keeps a keep-alive connection pool, so the TLS handshake is
+paid once per pooled connection instead of once per retrieval.
+"""
+import boto3
+from opensearchpy import Urllib3AWSV4SignerAuth, Urllib3HttpConnection
+
+
+def opensearch_connection_kwargs(region, service="aoss", pool_maxsize=16, timeout=10):
+    """Keyword arguments for OpenSearch()/OpenSearchVectorSearch() using a pooled, refreshable connection"""
+    credentials = boto3.Session().get_credentials()
+    if not credentials:
+        raise ValueError("No AWS credentials found!")
+    return {
+        "http_auth": Urllib3AWSV4SignerAuth(credentials, region, service),
+        "use_ssl": True,
+        "verify_certs": True,
+        "connection_class": Urllib3HttpConnection,
+        "pool_maxsize": pool_maxsize,
+        "timeout": timeout,
+    }
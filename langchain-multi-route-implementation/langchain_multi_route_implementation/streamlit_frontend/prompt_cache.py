@@ -0,0 +1,88 @@
+"""Cacheable static prompt prefixes for the Bedrock Converse API and their cache metrics
+
+The router, SQL generation, SQL answer and lambda prompts start with a large block
+that is identical on every call. cached_prompt puts that block in the system
+message, followed by a Converse cachePoint, and the per-turn variables in the
+human message, so Bedrock can reuse the processed prefix instead of reading it
+again. Bedrock only caches prefixes above the model's minimum token count and
+only for models that support prompt caching; shorter prefixes are sent uncached.
+PromptCacheStats reads the cache read/write token counts from each response.
+"""
+import threading
+from collections import defaultdict
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def cached_prompt(static_text, template, caching_enabled=True):
+    """Chat prompt with static_text as a cacheable system prefix and template as the human message"""
+    system = [{"type": "text", "text": static_text}]
+    if caching_enabled:
+        system.append(CACHE_POINT)
+    return ChatPromptTemplate.from_messages([SystemMessage(content=system), ("human", template)])
+
+
+def response_usage(response):
+    """(input, cache read, cache write) tokens of an LLMResult from ChatBedrockConverse"""
+    message = getattr(response.generations[0][0], "message", None)
+    usage = getattr(message, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    if details:
+        return usage.get("input_tokens", 0), details.get("cache_read", 0), details.get("cache_creation", 0)
+    # older langchain-aws versions only expose the raw Converse usage
+    raw = (getattr(message, "response_metadata", None) or {}).get("usage", {})
+    return (raw.get("inputTokens", usage.get("input_tokens", 0)),
+            raw.get("cacheReadInputTokens", 0), raw.get("cacheWriteInputTokens", 0))
+
+
+class _PromptCacheCallback(BaseCallbackHandler):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def on_llm_end(self, response, **kwargs):
+        try:
+            self.stats.record(self.name, *response_usage(response))
+        except Exception as e:
+            print(f"WARN: Unable to read the prompt cache usage: {str(e)}")
+
+
+class PromptCacheStats:
+    """Per-prompt input tokens and prompt cache reads and writes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.hits = defaultdict(int)
+        self.input_tokens = defaultdict(int)
+        self.cache_read_tokens = defaultdict(int)
+        self.cache_write_tokens = defaultdict(int)
+
+    def callback(self, name):
+        """Callback handler recording the usage of the LLM calls of one prompt"""
+        return _PromptCacheCallback(self, name)
+
+    def record(self, name, input_tokens, cache_read_tokens, cache_write_tokens):
+        with self._lock:
+            self.calls[name] += 1
+            self.hits[name] += int(cache_read_tokens > 0)
+            self.input_tokens[name] += input_tokens
+            self.cache_read_tokens[name] += cache_read_tokens
+            self.cache_write_tokens[name] += cache_write_tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    "calls": self.calls[name],
+                    "hit_rate": round(self.hits[name] / self.calls[name], 3),
+                    "input_tokens": self.input_tokens[name],
+                    "cache_read_tokens": self.cache_read_tokens[name],
+                    "cache_write_tokens": self.cache_write_tokens[name],
+                }
+                for name in self.calls
+            }
@@ -0,0 +1,141 @@
+"""Prompts of the routing, SQL, lambda and RAG chains
+
+Each cacheable prompt is a static system prefix (*_SYSTEM), identical on every
+call, and a human message template with the per-turn variables (*_TEMPLATE).
+They live here so scripts/benchmark_models.py runs the same prompts as the app.
+"""
+
+ROUTER_SYSTEM = """Given the user question below, classify it as one of the candidate prompt. You may want to modify the input considering the chat history and the contex of the question. Sometimes the user may just assume that you have the context of the covnersation and may not provide a clear input. Hence, you are being provided with the chat history for more context. Respond  with only a Markdown code snippet containing a JSON object formatted EXACTLY as specified below. Do not provide an explaination to your calssification beside the Markdown, I just need to know your decision on which destination and next_inputs
+<candidate prompt>
+physics: Good for answering questions about physics
+sql: sql: Good for quering sql from AWS Athena. User input may look like: get me max or min for device x?
+lambdachain: Good to execute actions with Amazon Lambda like shutting down a device or turning off an engine User input can be like, shutdown device x, or terminate process y, etc
+rag: Good to search knowldgebase and retriive information about devices and other related information. User question can be like: what do you know about device x?
+default: if the input is not well suited for any of the candidate prompts above. this could be used to carry on the conversation and respond to queries like provide a summay of the conversation 
+</candidate prompt>
+
+<Markdown>
+```json
+{
+    "destination": string \ name of the prompt to use 
+    "next_inputs": string \ a potentially modified version of the original input
+}
+```
+</Markdown>
+"""
+
+ROUTER_TEMPLATE = """<history> 
+{history}
+</history> 
+<question>
+{question}
+</question>
+"""
+
+SQL_SYSTEM = """
+based on the table schema in the <schema> tags of the question, ONLY write a SQL query that would answer the user's question:
+
+- Use the folllowing SQL format when are being asked to generate a SQL that is using field name received_at i.e, "Query the data for the last 6 hours". Always add the matching received_date filter so only the needed partitions are read 
+            SELECT * 
+            FROM iot_device_metrics_parquet 
+            WHERE received_at >= current_timestamp - interval '6' hour
+            AND received_date >= current_date - interval '1' day;
+- For queries using aggregate functions, ensure non-aggregated columns are included in the GROUP BY clause to avoid the "EXPRESSION_NOT_AGGREGATE" error like this below. 
+Incorrect: SELECT device_name, MAX(pressure) FROM table;
+Correct: SELECT device_name, MAX(pressure) FROM table GROUP BY device_name;
+Just generate the query and nothing else 
+
+Example: 
+Question: Give me max metrics for device 1007 
+SELECT device_name, MAX(oil_level) AS max_oil_level, MAX(temperature) AS max_temperature, MAX(pressure) AS max_pressure
+FROM iot_device_metrics_parquet 
+WHERE device_id = 1007
+GROUP BY 
+device_name;     
+"""
+
+SQL_TEMPLATE = """<schema>
+{schema}
+</schema>
+
+Question: {next_inputs}
+"""
+
+SQL_RESULT_SYSTEM = """You are an expert in heavy equipment IoT sensors data, use the table 'iot_device_metrics_parquet'
+Based on the table schema below, question, sql query, and sql response, write a natural language response that provide a solid answer to the question. Do not explain what the SQL query is actually doing
+<schema>
+    iot_device_metrics_parquet:
+        fields:
+        - name: device_name
+        type: bigint
+        - name: oil_level
+        type: double
+        - name: temperature
+        type: double
+        - name: pressure
+        type: double
+        - name: received_at
+        type: timestamp
+        - name: device_id
+        type: bigint
+        partition: true
+        - name: received_date
+        type: date
+        partition: true
+</schema>
+"""
+
+SQL_RESULT_TEMPLATE = """<Question>
+{next_inputs}
+</Question>
+
+<SQLQuery> 
+{query}
+</SQLQuery> 
+
+<SQLResponse> 
+{response}
+</SQLResponse> 
+
+"""
+
+LAMBDA_EXECUTE_SYSTEM = """
+You are a task executer 
+Your job is execute the task by triggering a Lambda function when the user say somthing like shut down a device or turn on a device, turn on the fan, etc \
+
+Use the following format:
+
+<< FORMATTING >>
+You MUST respond with a JSON object formatted EXACTLY as specified below.
+I will repeat the REQUIRED FORMAT:
+
+{
+    "Question": string \ Question here
+    "Action": string \ Only the Action to take
+    "deviceID": string \ Only the deviceID
+}
+
+REMEMBER: use only one of the following actions. 
+
+<<Actions>> 
+- Shutdowndevice: deviceID
+- turnondevice: deviceID
+- restartdevice: deviceID 
+"""
+
+LAMBDA_EXECUTE_TEMPLATE = """Here is a question:
+{next_inputs}
+"""
+
+RAG_TEMPLATE = """ 
+
+Answer the question based only on the following context:
+<context>
+{context}
+</context>
+
+<question>
+{next_inputs}
+</question>
+
+"""
@@ -0,0 +1,138 @@
+"""LRU/TTL cache for generated SQL, Athena result sets and SQL route answers
+
+Questions map to the SQL generated for them (and the final answer), keyed on the
+normalized question text and optionally matched by embedding similarity. Result
+sets are keyed on the normalized SQL text so different questions producing the
+same query share one Athena execution.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize_sql(sql):
+    """Collapse whitespace, drop the trailing semicolon and lowercase everything outside string literals"""
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(";").strip())
+    normalized = [part if part.startswith("'") else re.sub(r"\s+", " ", part.lower()) for part in parts]
+    return "".join(normalized).strip()
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question.lower()).strip(" ?.!")
+
+
+class QueryResultCache:
+    """Cache the SQL route's generated query, Athena result and answer with LRU eviction and a TTL"""
+
+    def __init__(self, max_entries=256, ttl_seconds=300, embeddings=None, similarity_threshold=0.95):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self._questions = OrderedDict()  # normalized question -> (created, vector, query, answer)
+        self._results = OrderedDict()  # normalized sql -> (created, result)
+        self._vectors = OrderedDict()  # embeddings computed on lookup, reused on store
+        self._lock = threading.Lock()
+        self.question_hits = 0
+        self.semantic_hits = 0
+        self.question_misses = 0
+        self.result_hits = 0
+        self.result_misses = 0
+
+    def _expired(self, created):
+        return time.monotonic() - created >= self.ttl_seconds
+
+    def _evict(self, entries):
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def _embed(self, key):
+        with self._lock:
+            if key in self._vectors:
+                return self._vectors[key]
+        vector = np.array(self.embeddings.embed_query(key))
+        vector /= np.linalg.norm(vector)
+        with self._lock:
+            self._vectors[key] = vector
+            self._evict(self._vectors)
+        return vector
+
+    def _semantic_match(self, key, vector):
+        """Find the most similar cached question that mentions the same device ids and numbers"""
+        numbers = set(NUMBER_PATTERN.findall(key))
+        best_key, best_similarity = None, self.similarity_threshold
+        for cached_key, (created, cached_vector, _, _) in self._questions.items():
+            if cached_vector is None or self._expired(created):
+                continue
+            if set(NUMBER_PATTERN.findall(cached_key)) != numbers:
+                continue
+            similarity = float(cached_vector @ vector)
+            if similarity >= best_similarity:
+                best_key, best_similarity = cached_key, similarity
+        return best_key
+
+    def lookup_question(self, question):
+        """Return {"query", "answer"} cached for this (or a semantically equal) question, or None"""
+        key = normalize_question(question)
+        vector = self._embed(key) if self.embeddings is not None else None
+        with self._lock:
+            entry = self._questions.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._questions.move_to_end(key)
+                self.question_hits += 1
+                return {"query": entry[2], "answer": entry[3]}
+            if vector is not None:
+                match = self._semantic_match(key, vector)
+                if match is not None:
+                    self._questions.move_to_end(match)
+                    self.semantic_hits += 1
+                    entry = self._questions[match]
+                    return {"query": entry[2], "answer": entry[3]}
+            self.question_misses += 1
+            return None
+
+    def store_question(self, question, query, answer=None):
+        key = normalize_question(question)
+        with self._lock:
+            vector = self._vectors.pop(key, None)
+            self._questions[key] = (time.monotonic(), vector, query, answer)
+            self._questions.move_to_end(key)
+            self._evict(self._questions)
+
+    def lookup_result(self, query):
+        key = normalize_sql(query)
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._results.move_to_end(key)
+                self.result_hits += 1
+                return entry[1]
+            self.result_misses += 1
+            return None
+
+    def store_result(self, query, result):
+        key = normalize_sql(query)
+        with self._lock:
+            self._results[key] = (time.monotonic(), result)
+            self._results.move_to_end(key)
+            self._evict(self._results)
+
+    def stats(self):
+        with self._lock:
+            question_lookups = self.question_hits + self.semantic_hits + self.question_misses
+            result_lookups = self.result_hits + self.result_misses
+            return {
+                "question_hits": self.question_hits,
+                "semantic_hits": self.semantic_hits,
+                "question_misses": self.question_misses,
+                "question_hit_rate": round((self.question_hits + self.semantic_hits) / question_lookups, 3) if question_lookups else 0,
+                "result_hits": self.result_hits,
+                "result_misses": self.result_misses,
+                "result_hit_rate": round(self.result_hits / result_lookups, 3) if result_lookups else 0,
+                "entries": len(self._questions) + len(self._results),
+            }
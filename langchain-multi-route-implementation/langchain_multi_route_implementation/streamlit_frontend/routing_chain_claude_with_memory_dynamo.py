@@ -4,48 +4,135 @@ import streamlit as st
 import json
 import boto3
 import os
-from datetime import datetime
+import asyncio
 
 from langchain_core.output_parsers import StrOutputParser
 
-from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_community.embeddings import BedrockEmbeddings
 from langchain_community.vectorstores import OpenSearchVectorSearch
-from opensearchpy import RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
-from langchain.llms.bedrock import Bedrock
 from sqlalchemy import create_engine
 from langchain_community.utilities.sql_database import SQLDatabase
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_message_histories import DynamoDBChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
+from fast_router import FastRouter
+from schema_cache import SchemaCache, crawler_version_fn
+from query_cache import QueryResultCache, normalize_question
+from rollup_rewriter import rewrite_to_rollup
+from speculative_prefetch import PrefetchStats, speculative_stage
+from async_runner import AsyncRunner
+from opensearch_client import opensearch_connection_kwargs
+from embedding_cache import CachedEmbeddings, DynamoDBEmbeddingStore, SqliteEmbeddingStore
+from local_index import LocalIndexRetriever, LocalVectorIndex
+from hybrid_retriever import HybridRetriever, RetrievalStats, opensearch_searchers
+from context_compression import ContextStats, compress_context
+from prompt_cache import PromptCacheStats, cached_prompt
+from model_registry import ModelRegistry, parse_model_config
+from prompts import (ROUTER_SYSTEM, ROUTER_TEMPLATE, SQL_SYSTEM, SQL_TEMPLATE, SQL_RESULT_SYSTEM, SQL_RESULT_TEMPLATE,
+                     LAMBDA_EXECUTE_SYSTEM, LAMBDA_EXECUTE_TEMPLATE, RAG_TEMPLATE)
+from chat_history import CachedChatMessageHistory, delete_session, list_sessions, new_session_id, session_title
+from user_identity import IDENTITY_MODES, UnauthenticatedError, user_id_from_headers
+
 # Check environment variables
-required_envs = ["STAGING_ATHENA_BUCKET",
-                 "OPENSEARCH_ENDPOINT", "CUSTOM_CHAIN_LAMBDA"]
+retriever_backend = os.environ.get('RETRIEVER_BACKEND', "opensearch").lower()
+required_envs = ["STAGING_ATHENA_BUCKET", "CUSTOM_CHAIN_LAMBDA"]
+# the local backend reads the index snapshot from the data bucket instead
+if retriever_backend != "local":
+    required_envs.append("OPENSEARCH_ENDPOINT")
 for env in required_envs:
     if env not in os.environ:
         raise Exception("Required environment variable {} not set".format(env))
 
-optional_envs = ["AWS_REGION", "ATHENA_SCHEMA"]
-for env in optional_envs:
-    if env not in os.environ:
-        print("WARN: Environment variable {} not set, using default value".format(env))
+optional_envs = ["AWS_REGION", "ATHENA_SCHEMA", "STREAMING_ENABLED",
+                 "FAST_ROUTER_ENABLED", "FAST_ROUTER_THRESHOLD",
+                 "GLUE_CRAWLER_NAME", "SCHEMA_CACHE_TTL_SECONDS",
+                 "SQL_CACHE_TTL_SECONDS", "SQL_CACHE_MAX_ENTRIES", "SQL_CACHE_SEMANTIC_ENABLED",
+                 "ATHENA_RESULT_REUSE_MINUTES", "ROLLUP_REWRITE_ENABLED",
+                 "SPECULATIVE_PREFETCH_ENABLED", "ASYNC_EXECUTION_ENABLED", "ASYNC_MAX_WORKERS",
+                 "MEMORY_ARCHIVE_TABLE", "MEMORY_TOKEN_BUDGET", "MEMORY_SUMMARY_ENABLED",
+                 "USER_IDENTITY", "USER_ID_HEADER", "ALB_ARN", "DEFAULT_USER_ID", "SESSION_PAGE_SIZE",
+                 "OPENSEARCH_POOL_MAXSIZE", "EMBEDDING_CACHE_MAX_ENTRIES", "EMBEDDING_CACHE_BACKEND",
+                 "EMBEDDING_CACHE_PATH", "EMBEDDING_CACHE_TABLE", "RETRIEVER_BACKEND",
+                 "LOCAL_INDEX_PREFIX", "LOCAL_INDEX_DIR", "LOCAL_INDEX_REFRESH_SECONDS",
+                 "HYBRID_RETRIEVAL_ENABLED", "RETRIEVER_TOP_K", "RETRIEVER_CANDIDATES",
+                 "RAG_CONTEXT_TOKEN_BUDGET", "LLM_MODEL_ID", "PROMPT_CACHING_ENABLED", "MODEL_CONFIG"]
+
+# Streamlit reruns the script on every interaction, report the defaults once per process
+@st.cache_resource
+def log_missing_optional_envs():
+    missing = [env for env in optional_envs if env not in os.environ]
+    if missing:
+        print("WARN: Environment variables {} not set, using default values".format(", ".join(missing)))
+
+log_missing_optional_envs()
 
 # Setup variables
 aws_region = os.environ.get('AWS_REGION', "us-west-2")
+streaming_enabled = os.environ.get('STREAMING_ENABLED', "true").lower() == "true"
+fast_router_enabled = os.environ.get('FAST_ROUTER_ENABLED', "true").lower() == "true"
+fast_router_threshold = float(os.environ.get('FAST_ROUTER_THRESHOLD', "0.7"))
+glue_crawler_name = os.environ.get('GLUE_CRAWLER_NAME')
+schema_cache_ttl_seconds = int(os.environ.get('SCHEMA_CACHE_TTL_SECONDS', "3600"))
+sql_cache_ttl_seconds = int(os.environ.get('SQL_CACHE_TTL_SECONDS', "300"))
+sql_cache_max_entries = int(os.environ.get('SQL_CACHE_MAX_ENTRIES', "256"))
+sql_cache_semantic_enabled = os.environ.get('SQL_CACHE_SEMANTIC_ENABLED', "false").lower() == "true"
+rollup_rewrite_enabled = os.environ.get('ROLLUP_REWRITE_ENABLED', "true").lower() == "true"
+speculative_prefetch_enabled = os.environ.get('SPECULATIVE_PREFETCH_ENABLED', "false").lower() == "true"
+async_execution_enabled = os.environ.get('ASYNC_EXECUTION_ENABLED', "false").lower() == "true"
+async_max_workers = int(os.environ.get('ASYNC_MAX_WORKERS', "16"))
+memory_token_budget = int(os.environ.get('MEMORY_TOKEN_BUDGET', "2000"))
+memory_summary_enabled = os.environ.get('MEMORY_SUMMARY_ENABLED', "true").lower() == "true"
+# none, alb_oidc or header, see user_identity.py
+user_identity = os.environ.get('USER_IDENTITY', "none").lower()
+if user_identity not in IDENTITY_MODES:
+    raise Exception("USER_IDENTITY must be one of {}".format(", ".join(IDENTITY_MODES)))
+user_id_header = os.environ.get('USER_ID_HEADER', "x-amzn-oidc-identity")
+alb_arn = os.environ.get('ALB_ARN')
+default_user_id = os.environ.get('DEFAULT_USER_ID', "default")
+session_page_size = int(os.environ.get('SESSION_PAGE_SIZE', "20"))
+# Sized to the number of concurrent retrievals, one pooled keep-alive connection each
+opensearch_pool_maxsize = int(os.environ.get('OPENSEARCH_POOL_MAXSIZE', str(async_max_workers)))
+embedding_cache_max_entries = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', "1024"))
+# memory, sqlite or dynamodb, the persistent backends keep the cache across container restarts
+embedding_cache_backend = os.environ.get('EMBEDDING_CACHE_BACKEND', "memory").lower()
+embedding_cache_path = os.environ.get('EMBEDDING_CACHE_PATH', "/tmp/embedding_cache.sqlite")
+embedding_cache_table = os.environ.get('EMBEDDING_CACHE_TABLE')
+# Snapshot of the docs index written by the indexing custom resource, used when RETRIEVER_BACKEND is local
+local_index_prefix = os.environ.get('LOCAL_INDEX_PREFIX', "index_snapshot/docs/")
+local_index_dir = os.environ.get('LOCAL_INDEX_DIR', "/tmp/local_index")
+local_index_refresh_seconds = int(os.environ.get('LOCAL_INDEX_REFRESH_SECONDS', "300"))
+hybrid_retrieval_enabled = os.environ.get('HYBRID_RETRIEVAL_ENABLED', "true").lower() == "true"
+retriever_top_k = int(os.environ.get('RETRIEVER_TOP_K', "3"))
+retriever_candidates = int(os.environ.get('RETRIEVER_CANDIDATES', "10"))
+rag_context_token_budget = int(os.environ.get('RAG_CONTEXT_TOKEN_BUDGET', "1000"))
+# Model id for every chain instead of the registry defaults, MODEL_CONFIG still overrides it per chain
+llm_model_id = os.environ.get('LLM_MODEL_ID')
+model_config = parse_model_config(os.environ.get('MODEL_CONFIG'))
+# Only enable it for models with prompt caching, it can also be set per chain in MODEL_CONFIG
+prompt_caching_enabled = os.environ.get('PROMPT_CACHING_ENABLED', "false").lower() == "true"
 
 # setup Bedrock agent and LLM
 bedrock = boto3.client("bedrock", aws_region)
-llm = Bedrock(
-    #    credentials_profile_name=profile_name,
-    region_name=aws_region,
-    model_id="anthropic.claude-v2:1",
-    model_kwargs={'max_tokens_to_sample': 300,
-                  'temperature': 0}
-)
+# Chat models over the Converse API, which accepts cache points in the system prompt
+@st.cache_resource
+def get_model_registry():
+    return ModelRegistry(aws_region, overrides=model_config, default_model_id=llm_model_id,
+                         prompt_caching=prompt_caching_enabled)
+
+model_registry = get_model_registry()
+
+# Prompt cache counters, cached so they accumulate for the whole process
+@st.cache_resource
+def get_prompt_cache_stats():
+    return PromptCacheStats()
+
+prompt_cache_stats = get_prompt_cache_stats()
+
+def get_llm(name):
+    """Chat model of the named chain, recording the prompt cache usage of its calls"""
+    return model_registry.get(name).with_config(callbacks=[prompt_cache_stats.callback(name)])
 
 # Create the athena connection string
 connathena = f"athena." + aws_region + ".amazonaws.com"
@@ -55,13 +142,39 @@ staging_athena_bucket = os.environ.get('STAGING_ATHENA_BUCKET')
 s3stagingathena = ''.join(["S3://", staging_athena_bucket, "/"])
 
 wkgrpathena = os.environ.get('ATHENA_WORKGROUP', 'mrc_athena_workgroup')
+# Reuse results of identical queries run within this window instead of rescanning S3, 0 disables reuse
+athena_result_reuse_minutes = int(os.environ.get('ATHENA_RESULT_REUSE_MINUTES', "60"))
 connection_string = f"awsathena+rest://{connathena}:{portathena}/{schemaathena}?s3_staging_dir={s3stagingathena}/&work_group={wkgrpathena}"
 
 
 # Create the athena  SQLAlchemy engine
-engine_athena = create_engine(connection_string, echo=False)
-dbathena = SQLDatabase(engine_athena)
-db = SQLDatabase(engine_athena)
+@st.cache_resource
+def get_engine():
+    connect_args = {}
+    if athena_result_reuse_minutes > 0:
+        connect_args = {"result_reuse_enable": True, "result_reuse_minutes": athena_result_reuse_minutes}
+    return create_engine(connection_string, echo=False, connect_args=connect_args)
+
+def build_database():
+    """SQLDatabase reflects the Glue catalog on creation, so it is rebuilt when the catalog changes"""
+    return SQLDatabase(get_engine())
+
+# Cached so the catalog is reflected once per process, queries run on the shared engine
+@st.cache_resource
+def get_database():
+    return build_database()
+
+db = get_database()
+
+# Schema cache shared by every route, invalidated when the Glue crawler runs
+@st.cache_resource
+def get_schema_cache():
+    version_fn = None
+    if glue_crawler_name:
+        version_fn = crawler_version_fn(boto3.client("glue", aws_region), glue_crawler_name)
+    return SchemaCache(db, ttl_seconds=schema_cache_ttl_seconds, version_fn=version_fn, database_fn=build_database)
+
+schema_cache = get_schema_cache()
 
 # OpenSearch Endpoint
 # Update the OpenSearch Endpoint
@@ -71,220 +184,250 @@ osendpoint = os.environ.get('OPENSEARCH_ENDPOINT')
 lambda_function_name = os.environ.get(
     'CUSTOM_CHAIN_LAMBDA')  # Update the Lambda Function Name
 
+# Query embeddings shared by the retriever, the fast router and the SQL cache, cached per process
+@st.cache_resource
+def get_embeddings():
+    bedrock_embeddings = BedrockEmbeddings(
+        region_name = aws_region
+    )
+    store = None
+    if embedding_cache_backend == "sqlite":
+        store = SqliteEmbeddingStore(embedding_cache_path)
+    elif embedding_cache_backend == "dynamodb" and embedding_cache_table:
+        store = DynamoDBEmbeddingStore(boto3.resource('dynamodb').Table(embedding_cache_table))
+    return CachedEmbeddings(bedrock_embeddings, bedrock_embeddings.model_id,
+                            max_entries=embedding_cache_max_entries, store=store)
+
+embeddings = get_embeddings()
+
+# Cached so every session shares one snapshot and refresh thread
+@st.cache_resource
+def get_local_index():
+    index = LocalVectorIndex(boto3.client('s3'), staging_athena_bucket, prefix=local_index_prefix,
+                             local_dir=local_index_dir, refresh_seconds=local_index_refresh_seconds)
+    index.load()
+    index.start_refresh()
+    return index
+
+# Hybrid retrieval counters, cached so they accumulate for the whole process
+@st.cache_resource
+def get_retrieval_stats():
+    return RetrievalStats()
+
+retrieval_stats = get_retrieval_stats()
+
 ##Define the Vector DB retriver 
+# Cached so every session shares one OpenSearch client and its connection pool
+@st.cache_resource
 def create_retriever():
+    if retriever_backend == "local":
+        index = get_local_index()
+        if hybrid_retrieval_enabled:
+            # the snapshot has no lexical index, the reranker covers exact term matches
+            searcher = lambda question, device_id, size: index.search(embeddings.embed_query(question), size, device_id)
+            return HybridRetriever(searchers=[searcher], k=retriever_top_k, candidates=retriever_candidates,
+                                   retrieval_stats=retrieval_stats)
+        return LocalIndexRetriever(index=index, embeddings=embeddings, k=retriever_top_k)
     index_name = 'docs'
     endpoint = osendpoint 
 
-    embeddings = BedrockEmbeddings(
-        region_name = aws_region
-    )
-
     vector_store = OpenSearchVectorSearch(
         index_name=index_name,
         embedding_function=embeddings,
         opensearch_url=endpoint,
-        http_auth=get_aws4_auth(),
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
+        **opensearch_connection_kwargs(aws_region, pool_maxsize=opensearch_pool_maxsize),
     )
+    if hybrid_retrieval_enabled:
+        # metadata.device_id is a keyword field set at ingestion
+        device_filter = lambda device_id: {"term": {"metadata.device_id": device_id}}
+        return HybridRetriever(searchers=opensearch_searchers(vector_store.client, index_name, embeddings, device_filter),
+                               k=retriever_top_k, candidates=retriever_candidates, retrieval_stats=retrieval_stats)
     #print(vector_store.as_retriever())
-    return vector_store.as_retriever()
-
-
-def get_aws4_auth():
-    region = aws_region
-    service = "aoss"
-
-    session = boto3.Session()
-    credentials = session.get_credentials()
+    return vector_store.as_retriever(search_kwargs={"k": retriever_top_k})
 
-    if not credentials:
-        raise ValueError("No AWS credentials found!")
-    
-    return AWS4Auth(
-        credentials.access_key,
-        credentials.secret_key,
-        region,
-        service,
-        session_token=credentials.token,
-    )
 retriever = create_retriever()
 
 
 # Setup chat history with DynamoDB
 
-# Function to prepend a prefix for filtering on the UI
-prefix = "final_answer: "
-def prepend_answer(text):
-    return f"{prefix}{text}"
-
 # DynamoDB table to store chat history
 memory_table_name = os.environ.get("MEMORY_TABLE","SessionTable")
 dynamodb = boto3.resource('dynamodb')
 memory_table = dynamodb.Table(memory_table_name)
+# Older messages beyond the token budget are moved here, the session item only keeps the recent window
+memory_archive_table_name = os.environ.get("MEMORY_ARCHIVE_TABLE")
+memory_archive_table = dynamodb.Table(memory_archive_table_name) if memory_archive_table_name else None
+
+summary_prompt = ChatPromptTemplate.from_template("""Progressively summarize the conversation between a plant technician and an AI assistant, adding onto the previous summary and returning a new summary. Keep device ids, metric values and actions taken.
+
+<summary>
+{summary}
+</summary>
+
+<new_lines>
+{new_lines}
+</new_lines>
 
-# Load previous chat sessions with a Scan operation
+New summary:""")
+
+summary_chain = summary_prompt | get_llm("summary") | StrOutputParser()
+
+def summarize_history(summary, messages):
+    """Fold the messages moved out of the window into the rolling summary"""
+    new_lines = "\n".join(f"{message.type}: {message.content}" for message in messages)
+    return summary_chain.invoke({"summary": summary, "new_lines": new_lines}).strip()
+
+def get_user_id():
+    """User id from the trusted authentication layer selected by USER_IDENTITY, stops unauthenticated requests"""
+    headers = st.context.headers if hasattr(st, "context") else {}
+    try:
+        return user_id_from_headers(headers, user_identity, aws_region, alb_arn, user_id_header, default_user_id)
+    except UnauthenticatedError as e:
+        print(f"WARN: Rejected request without a trusted user identity: {str(e)}")
+        st.error("Please sign in to use the assistant.")
+        st.stop()
+
+user_id = get_user_id()
+
+# Load the user's most recent chat sessions, one page at a time from the per-user index
 if not 'chat_history_list' in st.session_state:
-    chat_history_list = [item['SessionId'] for item in memory_table.scan(ProjectionExpression='SessionId').get('Items', [])]
-    session_name = datetime.now().strftime("Chat - %a %b %d @ %H:%M:%S")
+    chat_history_list, st.session_state['sessions_page_key'] = list_sessions(memory_table, user_id, session_page_size)
+    session_name = new_session_id()
     st.session_state['session_name'] = session_name
-    chat_history_list.append(session_name)
-    st.session_state['chat_history_list'] = chat_history_list
+    st.session_state['chat_history_list'] = [session_name] + chat_history_list
 
 # Display chat sessions in a sidebar
 with st.sidebar:
     chat_history_list = st.session_state['chat_history_list']
-    chat_history_key = st.selectbox('Choose a chat', chat_history_list, chat_history_list.index(st.session_state.session_name))
+    chat_history_key = st.selectbox('Choose a chat', chat_history_list, chat_history_list.index(st.session_state.session_name),
+                                    format_func=session_title)
+    if st.session_state.get('sessions_page_key') and st.button("Load older chats"):
+        older_sessions, st.session_state['sessions_page_key'] = list_sessions(
+            memory_table, user_id, session_page_size, st.session_state['sessions_page_key'])
+        chat_history_list.extend(session for session in older_sessions if session not in chat_history_list)
+        st.rerun()
     if st.button("Delete chat", type="primary"):
-        memory_table.delete_item(Key={ 'SessionId': chat_history_key })
+        delete_session(memory_table, memory_archive_table, chat_history_key)
         chat_history_list.remove(chat_history_key)
         st.session_state['chat_history_list'] = chat_history_list
         st.rerun()
 
-msgs = DynamoDBChatMessageHistory(table_name=memory_table_name, session_id=chat_history_key)
+# Loaded once per rerun and shared by every history wrapper, written back once per turn
+msgs = CachedChatMessageHistory(
+    memory_table, chat_history_key, user_id,
+    archive_table=memory_archive_table,
+    token_budget=memory_token_budget,
+    summarize_fn=summarize_history if memory_summary_enabled else None,
+)
 if len(msgs.messages) == 0:
-    msgs.add_ai_message(prepend_answer("How can I help you?"))
+    msgs.add_ai_message("How can I help you?")
+    msgs.flush()
 
 print(f"INFO: Using table {memory_table_name} and key {chat_history_key}, # of messages {len(msgs.messages)}")
 
 # Define the routing chain -  
-router_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("""Given the user question below, classify it as one of the candidate prompt. You may want to modify the input considering the chat history and the contex of the question. Sometimes the user may just assume that you have the context of the covnersation and may not provide a clear input. Hence, you are being provided with the chat history for more context. Respond  with only a Markdown code snippet containing a JSON object formatted EXACTLY as specified below. Do not provide an explaination to your calssification beside the Markdown, I just need to know your decision on which destination and next_inputs
-<candidate prompt>
-physics: Good for answering questions about physics
-sql: sql: Good for quering sql from AWS Athena. User input may look like: get me max or min for device x?
-lambdachain: Good to execute actions with Amazon Lambda like shutting down a device or turning off an engine User input can be like, shutdown device x, or terminate process y, etc
-rag: Good to search knowldgebase and retriive information about devices and other related information. User question can be like: what do you know about device x?
-default: if the input is not well suited for any of the candidate prompts above. this could be used to carry on the conversation and respond to queries like provide a summay of the conversation 
-</candidate prompt>
-
-<Markdown>
-```json
-{{
-    "destination": string \ name of the prompt to use 
-    "next_inputs": string \ a potentially modified version of the original input
-}}
-```
-</Markdown>
-
-<history> 
-{history}
-</history> 
-<question>
-{question}
-</question>
-""") 
-    ]
-)
+router_prompt = cached_prompt(ROUTER_SYSTEM, ROUTER_TEMPLATE, model_registry.prompt_caching("router"))
 
 
 chain = (
  router_prompt
-    | llm
+    | get_llm("router")
+    | StrOutputParser()
 )
 
+# Local pre-router, cached so the example centroids and counters live for the whole process
+@st.cache_resource
+def get_fast_router():
+    return FastRouter(embeddings=embeddings, threshold=fast_router_threshold)
+
+fast_router = get_fast_router()
+
+def fast_route(x):
+    """Skip the router LLM call for confidently classified questions"""
+    decision = fast_router.route(x["question"])
+    if decision is None:
+        return chain
+    print('Fast router:', decision)
+    return FastRouter.to_topic(decision)
+
+router_chain = RunnableLambda(fast_route) if fast_router_enabled else chain
+
 # Define all Destination chains including SQL, RAG, Lambda, SME, and default 
 
-sql_prompt = ChatPromptTemplate.from_template(
-"""
-based on the table schema below, ONLY write a SQL query that would answer the user's question:
-<schema>
-    iot_device_metrics:
-        fields:
-        - name: device_name
-        type: bigint
-        - name: oil_level
-        type: double
-        - name: temperature
-        type: double
-        - name: pressure
-        type: double
-        - name: received_at
-        type: string
-        - name: device_id
-        type: bigint
-</schema>
-
-- Use the folllowing SQL format when are being asked to generate a SQL that is using field name received_at i.e, "Query the data for the last 6 hours" 
-            SELECT * 
-            FROM iot_stream_analytics_out_iot201 
-            WHERE parse_datetime(TRIM(BOTH '"' FROM received_at), 'yyyy-MM-dd HH:mm:ss') >= current_timestamp - interval '6' hour;
-- For queries using aggregate functions, ensure non-aggregated columns are included in the GROUP BY clause to avoid the "EXPRESSION_NOT_AGGREGATE" error like this below. 
-Incorrect: SELECT device_name, MAX(pressure) FROM table;
-Correct: SELECT device_name, MAX(pressure) FROM table GROUP BY device_name;
-Just generate the query and nothing else 
-
-Example: 
-Question: Give me max metrics for device 1007 
-SELECT device_name, MAX(oil_level) AS max_oil_level, MAX(temperature) AS max_temperature, MAX(pressure) AS max_pressure
-FROM iot_device_metrics 
-WHERE device_id = 1007
-GROUP BY 
-device_name;     
-
-
-Question: {next_inputs}
-
-""" ) 
-
-sql_result_prompt = ChatPromptTemplate.from_template("""You are an expert in heavy equipment IoT sensors data, use the table 'iot_device_metrics'
-Based on the table schema below, question, sql query, and sql response, write a natural language response that provide a solid answer to the question. Do not explain what the SQL query is actually doing
-<schema>
-    iot_device_metrics:
-        fields:
-        - name: device_name
-        type: bigint
-        - name: oil_level
-        type: double
-        - name: temperature
-        type: double
-        - name: pressure
-        type: double
-        - name: received_at
-        type: string
-        - name: device_id
-        type: bigint
-</schema>
-
-<Question>
-{next_inputs}
-</Question>
-
-<SQLQuery> 
-{query}
-</SQLQuery> 
-
-<SQLResponse> 
-{response}
-</SQLResponse> 
+sql_prompt = cached_prompt(SQL_SYSTEM, SQL_TEMPLATE, model_registry.prompt_caching("sql"))
 
-""")
+sql_result_prompt = cached_prompt(SQL_RESULT_SYSTEM, SQL_RESULT_TEMPLATE, model_registry.prompt_caching("sql_result"))
 
 def get_schema(_):
-    return db.get_table_info()
+    """Table info of the raw metrics table the SQL prompt writes its queries against"""
+    return schema_cache.get_table_info(["iot_device_metrics_parquet"])
+
+# Cache for generated SQL, Athena result sets and answers, TTL bounded by the metrics data freshness
+@st.cache_resource
+def get_query_cache():
+    return QueryResultCache(
+        max_entries=sql_cache_max_entries,
+        ttl_seconds=sql_cache_ttl_seconds,
+        embeddings=embeddings if sql_cache_semantic_enabled else None,
+    )
+
+query_cache = get_query_cache()
 
 def run_query(query):
-    return db.run(query)
+    response = query_cache.lookup_result(query)
+    if response is None:
+        rollup_query = rewrite_to_rollup(query) if rollup_rewrite_enabled else None
+        if rollup_query is not None:
+            print(f"INFO: Answering from the hourly rollup: {rollup_query}")
+        response = db.run(rollup_query or query)
+        query_cache.store_result(query, response)
+    return response
 
 sql_query_chain = (
-    RunnablePassthrough.assign(schema=get_schema)
+    RunnablePassthrough.assign(schema=lambda x: x.get("schema") or get_schema(x))
     | sql_prompt
-    | llm.bind(stop=["\nSQLResult:"])
+    | get_llm("sql").bind(stop=["\nSQLResult:"])
     | StrOutputParser()
 )
 
-sql_chain = (
-    RunnablePassthrough.assign(query=sql_query_chain).assign(
-        schema=get_schema,
-        response=lambda x: db.run(x["query"]),
-    )
-    | sql_result_prompt
-    | llm
+sql_answer_chain = (
+    sql_result_prompt
+    | get_llm("sql_result")
+    | StrOutputParser()
 )
 
+def cached_sql_chain(x):
+    """Answer from the cache for repeated questions, otherwise generate and run the SQL and cache the answer"""
+    cached = query_cache.lookup_question(x["next_inputs"])
+    if cached is not None and cached["answer"] is not None:
+        print('SQL cache hit:', cached["query"])
+        yield cached["answer"]
+        return
+    query = cached["query"] if cached is not None else sql_query_chain.invoke(x)
+    chunks = []
+    for chunk in sql_answer_chain.stream({**x, "query": query, "response": run_query(query)}):
+        chunks.append(chunk)
+        yield chunk
+    query_cache.store_question(x["next_inputs"], query, "".join(chunks))
+
+async def acached_sql_chain(x):
+    """Async variant of cached_sql_chain, the blocking cache lookup and Athena query run on the executor"""
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, query_cache.lookup_question, x["next_inputs"])
+    if cached is not None and cached["answer"] is not None:
+        print('SQL cache hit:', cached["query"])
+        yield cached["answer"]
+        return
+    query = cached["query"] if cached is not None else await sql_query_chain.ainvoke(x)
+    response = await loop.run_in_executor(None, run_query, query)
+    chunks = []
+    async for chunk in sql_answer_chain.astream({**x, "query": query, "response": response}):
+        chunks.append(chunk)
+        yield chunk
+    query_cache.store_question(x["next_inputs"], query, "".join(chunks))
+
+sql_chain = RunnableLambda(cached_sql_chain, afunc=acached_sql_chain)
+
 
 lambda_client = boto3.client('lambda')  # Ensure AWS credentials are configured
 
@@ -314,37 +457,12 @@ def lambda_decision_function(llm_response):
     except json.JSONDecodeError:
         return {"error": "Failed to parse LLM response"}
 
-lambda_execute_prompt = ChatPromptTemplate.from_template( """
-You are a task executer 
-Your job is execute the task by triggering a Lambda function when the user say somthing like shut down a device or turn on a device, turn on the fan, etc \
-
-Use the following format:
-
-<< FORMATTING >>
-You MUST respond with a JSON object formatted EXACTLY as specified below.
-I will repeat the REQUIRED FORMAT:
-
-{{
-    "Question": string \ Question here
-    "Action": string \ Only the Action to take
-    "deviceID": string \ Only the deviceID
-}}
-
-REMEMBER: use only one of the following actions. 
-
-<<Actions>> 
-- Shutdowndevice: deviceID
-- turnondevice: deviceID
-- restartdevice: deviceID 
-
-Here is a question:
-{next_inputs}
- 
-""" )
+lambda_execute_prompt = cached_prompt(LAMBDA_EXECUTE_SYSTEM, LAMBDA_EXECUTE_TEMPLATE, model_registry.prompt_caching("lambda"))
 
 lambda_execute_chain = (
     lambda_execute_prompt
-    | llm
+    | get_llm("lambda")
+    | StrOutputParser()
     | RunnableLambda(lambda_decision_function)
 
 )
@@ -358,7 +476,8 @@ Provide one sentence to summarize the final decision for the user. Remember, jus
 lambda_chain = (
     {"lambda_output": lambda_execute_chain}
     | lambda_prompt
-    | llm
+    | get_llm("lambda_summary")
+    | StrOutputParser()
 )
 
 
@@ -376,37 +495,40 @@ Here is a question:
     ]
 )
 
-physics_chain_ = (
+# history is passed in by full_chain_with_memory, the only chain that records the turn
+physics_chain = (
 
     physics_prompt 
-    | llm
+    | get_llm("physics")
+    | StrOutputParser()
 )
 
-physics_chain = RunnableWithMessageHistory(
-    physics_chain_,
-    lambda session_id: msgs,  # Always return the instance created earlier
-    input_messages_key="question",
-    history_messages_key="history",
-)
+rag_prompt = ChatPromptTemplate.from_template(RAG_TEMPLATE)
 
-rag_prompt = ChatPromptTemplate.from_template(""" 
+# RAG context counters, cached so they accumulate for the whole process
+@st.cache_resource
+def get_context_stats():
+    return ContextStats()
 
-Answer the question based only on the following context:
-<context>
-{context}
-</context>
+context_stats = get_context_stats()
 
-<question>
-{next_inputs}
-</question>
+def assemble_context(x):
+    """Replace the retrieved documents with the compressed context text"""
+    context, counts = compress_context(x["context"], rag_context_token_budget)
+    context_stats.record(counts)
+    print(f"RAG context tokens: {counts['before']} retrieved, {counts['after']} after compression")
+    return {**x, "context": context}
 
-""" ) 
+rag_answer_chain = (
+    RunnableLambda(assemble_context)
+    | rag_prompt
+    | get_llm("rag")
+    | StrOutputParser()
+)
 
 rag_chain = (
     {"context": retriever, "next_inputs": RunnablePassthrough()}
-    | rag_prompt
-    | llm
-    | StrOutputParser()
+    | rag_answer_chain
 )
 
 
@@ -420,22 +542,29 @@ Answer:""")
     ]
 )
 
-general_chain_ = (
+general_chain = (
      general_prompt 
-    | llm
+    | get_llm("general")
+    | StrOutputParser()
 )
 
-general_chain = RunnableWithMessageHistory(
-    general_chain_,
-    lambda session_id: msgs,  # Always return the instance created earlier
-    input_messages_key="question",
-    history_messages_key="history",
-)
+# Speculative prefetch counters, cached so they accumulate for the whole process
+@st.cache_resource
+def get_prefetch_stats():
+    return PrefetchStats()
+
+prefetch_stats = get_prefetch_stats()
 
 # Define the routing logic based on routing chain output --> to Dest chain 
-def route(info,config):
+def select_destination(info, config):
+    """Parse the router output and return the destination chain with its input and config
+
+    config is the route lambda's child config, passing it on keeps the destination
+    chain's callbacks, tags and runs under the routing run.
+    """
     topic = info["topic"].lower()
     print('Info:', info)
+    destination = None
 
     # Attempt to parse the JSON from the topic if it's in the expected format
     try:
@@ -457,28 +586,77 @@ def route(info,config):
     except json.JSONDecodeError as e:
         print("Topic does not contain valid JSON:", e)
 
+    # Destination chains expect next_inputs, fall back to the raw question
+    info.setdefault('next_inputs', info["question"])
+
+    # Keep the speculative results the chosen route needs and discard the rest
+    prefetched_docs = None
+    prefetch = info.pop("prefetch", None)
+    if prefetch is not None:
+        used = []
+        if destination == "sql" and prefetch["sql"]["value"] is not None:
+            # the SQL prompt's {schema}, a failed prefetch leaves None and the SQL chain reads the cache itself
+            info["schema"] = prefetch["sql"]["value"]
+            used = ["sql"]
+        elif destination == "rag" and normalize_question(info["next_inputs"]) == normalize_question(info["question"]):
+            # documents were retrieved for the raw question, only valid if the router didn't rewrite it,
+            # a failed retrieval leaves None and the rag chain retrieves again
+            prefetched_docs = prefetch["rag"]["value"]
+            used = ["rag"] if prefetched_docs is not None else []
+        route_name = destination if destination in ["sql", "lambdachain", "rag", "physics"] else "general"
+        prefetch_stats.record(route_name, {branch: result["seconds"] for branch, result in prefetch.items()}, used)
+
     # Use the 'destination' value in the routing logic
-    if destination:
-        print(msgs)
-        if destination == "sql":
-            return sql_chain.invoke(info)
-        elif destination == "lambdachain":
-            return lambda_chain.invoke(info)
-        elif destination == "rag":
-            return rag_chain.invoke(info["next_inputs"])
-        elif destination == "physics":
-            return physics_chain.invoke(info, config)
-        else:
-            return general_chain.invoke(info,config)
+    if destination == "sql":
+        return sql_chain, info, config
+    elif destination == "lambdachain":
+        return lambda_chain, info, config
+    elif destination == "rag":
+        if prefetched_docs is not None:
+            return rag_answer_chain, {"context": prefetched_docs, "next_inputs": info["next_inputs"]}, config
+        return rag_chain, info["next_inputs"], config
+    elif destination == "physics":
+        return physics_chain, info, config
     else:
         # Fallback or default routing
-        return general_chain.invoke(info,config)
+        return general_chain, info, config
+
+def route(info, config):
+    destination_chain, chain_input, chain_config = select_destination(info, config)
+    return destination_chain.invoke(chain_input, chain_config)
+
+def route_stream(info, config):
+    """Streaming variant of route, yields the destination chain's tokens as they arrive"""
+    destination_chain, chain_input, chain_config = select_destination(info, config)
+    yield from destination_chain.stream(chain_input, chain_config)
+
+async def aroute(info, config):
+    destination_chain, chain_input, chain_config = select_destination(info, config)
+    return await destination_chain.ainvoke(chain_input, chain_config)
+
+async def aroute_stream(info, config):
+    """Async variant of route_stream"""
+    destination_chain, chain_input, chain_config = select_destination(info, config)
+    async for chunk in destination_chain.astream(chain_input, chain_config):
+        yield chunk
+
+# Speculative stage: retrieval for the raw question and the SQL prompt schema run alongside the router
+speculative_router_stage = speculative_stage(
+    router_chain,
+    rag=RunnableLambda(lambda x: x["question"]) | retriever,
+    sql=RunnableLambda(get_schema),
+)
+
+if speculative_prefetch_enabled:
+    router_stage = speculative_router_stage
+else:
+    router_stage = {"topic": router_chain, "question": lambda x: x["question"], "history": lambda x: x["history"]}
 
 # Define the full chain which includs the routing and all dest chains 
+# It is the only chain wrapped with the chat history, so each turn records one human and one AI message
 full_chain = (
-    {"topic": chain, "question": lambda x: x["question"]} 
-    | RunnableLambda(route) 
-    | RunnableLambda(prepend_answer)
+    router_stage
+    | RunnableLambda(route, afunc=aroute) 
 )
 
 full_chain_with_memory = RunnableWithMessageHistory(
@@ -488,19 +666,56 @@ full_chain_with_memory = RunnableWithMessageHistory(
     history_messages_key="history",
 )
 
+# Streaming chain, history is written once the stream has been fully consumed
+full_chain_stream = (
+    router_stage
+    | RunnableLambda(route_stream, afunc=aroute_stream)
+)
+
+full_chain_stream_with_memory = RunnableWithMessageHistory(
+    full_chain_stream,
+    lambda session_id: msgs,  # Always return the instance created earlier
+    input_messages_key="question",
+    history_messages_key="history",
+)
+
+# Event loop and bounded executor shared by all sessions for the async execution path
+@st.cache_resource
+def get_async_runner():
+    return AsyncRunner(max_workers=async_max_workers)
+
+def get_performance_stats():
+    """Router and cache counters for the current process"""
+    stats = {"chat_history": msgs.stats(), "schema_cache": schema_cache.stats(), "sql_cache": query_cache.stats(),
+             "embedding_cache": embeddings.stats(), "rag_context": context_stats.stats(),
+             "prompt_cache": prompt_cache_stats.stats(), "models": model_registry.describe()}
+    if retriever_backend == "local":
+        stats["local_index"] = get_local_index().stats()
+    if hybrid_retrieval_enabled:
+        stats["hybrid_retrieval"] = retrieval_stats.stats()
+    if fast_router_enabled:
+        stats["fast_router"] = fast_router.stats()
+    if speculative_prefetch_enabled:
+        stats["speculative_prefetch"] = prefetch_stats.stats()
+    if async_execution_enabled:
+        stats["async_runner"] = get_async_runner().stats()
+    return stats
+
 # Streamlit UI
-user_msg_types = ["user", "human"]
+display_msg_types = ["human", "ai"]
 def main():
     st.title("Conversational AI - Plant Technician")
-    display_msgs = []
-    for msg in msgs.messages:
-        if msg.type in user_msg_types and msg.content not in display_msgs:
-            display_msgs.append(msg.content)
+    history = msgs.messages
+    # Messages moved to the archive are only read when asked for
+    if msgs.archived_count and st.toggle(f"Show {msgs.archived_count} earlier messages"):
+        history = msgs.load_archived() + history
+    for msg in history:
+        # the rolling summary is a system message for the prompts only
+        if msg.type in display_msg_types:
             st.chat_message(msg.type).write(msg.content)
-        else:
-            if str(msg.content).startswith(prefix):
-                st.chat_message("ai").write(str(msg.content).replace(prefix, ""))
-            
+
+    with st.sidebar.expander("Performance stats"):
+        st.json(get_performance_stats())
 
     if prompt := st.chat_input():
         st.chat_message("User").write(prompt)
@@ -509,9 +724,24 @@ def main():
         session_id = "any"  # You might want to generate or retrieve an actual session ID based on your application's logic
         config = {"configurable": {"session_id": session_id}}
         
-        # Pass the same config to the full_chain invocation, ensuring that the session_id is included.
-        response = full_chain_with_memory.invoke({"question": prompt}, config)
-        st.chat_message("ai").write(response.replace(prefix, ""))
+        try:
+            if streaming_enabled:
+                # Render tokens as they arrive, history is updated when the stream completes
+                if async_execution_enabled:
+                    stream = get_async_runner().stream(full_chain_stream_with_memory.astream({"question": prompt}, config))
+                else:
+                    stream = full_chain_stream_with_memory.stream({"question": prompt}, config)
+                st.chat_message("ai").write_stream(stream)
+            else:
+                # Pass the same config to the full_chain invocation, ensuring that the session_id is included.
+                if async_execution_enabled:
+                    response = get_async_runner().run(full_chain_with_memory.ainvoke({"question": prompt}, config))
+                else:
+                    response = full_chain_with_memory.invoke({"question": prompt}, config)
+                st.chat_message("ai").write(response)
+        finally:
+            # Write the turn's messages back to DynamoDB in one put_item
+            msgs.flush()
 
 
 if __name__ == '__main__':
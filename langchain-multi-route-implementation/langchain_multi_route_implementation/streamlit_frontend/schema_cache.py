@@ -0,0 +1,111 @@
+"""TTL cache for SQLDatabase table info shared by all SQL routes
+
+SQLDatabase.get_table_info() reflects the Glue catalog through PyAthena and runs
+a sample-rows query against Athena on every call. The cache keeps the result for
+a TTL and drops it as soon as the Glue crawler starts or finishes a crawl.
+SQLDatabase reflects the catalog only once, when it is created, so a new one is
+built from database_fn on every catalog change.
+"""
+import threading
+import time
+
+
+def crawler_version_fn(glue_client, crawler_name):
+    """Return a function giving the crawler's state and last crawl, which change whenever it runs"""
+    def version():
+        crawler = glue_client.get_crawler(Name=crawler_name)['Crawler']
+        last_crawl = crawler.get('LastCrawl', {})
+        return (crawler.get('State'), str(last_crawl.get('StartTime')), last_crawl.get('Status'))
+    return version
+
+
+class SchemaCache:
+    """Cache get_table_info() results per table selection with a TTL, dropped when the catalog changes
+
+    Concurrent misses for the same tables share one refresh: the first caller
+    reflects the database outside the lock while the others wait for its result,
+    and hits on other tables are served in the meantime.
+    """
+
+    def __init__(self, database, ttl_seconds=3600, version_fn=None, version_check_seconds=60, database_fn=None):
+        self.database = database
+        self.database_fn = database_fn
+        self.ttl_seconds = ttl_seconds
+        self.version_fn = version_fn
+        self.version_check_seconds = version_check_seconds
+        self._entries = {}
+        self._loading = {}
+        self._version = None
+        self._version_checked_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        """Invalidate the cache when the catalog version changed, at most once per check interval"""
+        if self.version_fn is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._version_checked_at is not None and now - self._version_checked_at < self.version_check_seconds:
+                return
+            self._version_checked_at = now
+        try:
+            version = self.version_fn()
+        except Exception as e:
+            print(f"WARN: Unable to check the schema version, keeping cached schema: {str(e)}")
+            return
+        database = None
+        if self._version is not None and version != self._version and self.database_fn is not None:
+            try:
+                database = self.database_fn()
+            except Exception as e:
+                # keep the old version so the next check retries the rebuild
+                print(f"WARN: Unable to reflect the changed schema, keeping cached schema: {str(e)}")
+                return
+        with self._lock:
+            if self._version is not None and version != self._version:
+                print(f"INFO: Schema version changed from {self._version} to {version}, invalidating schema cache")
+                if database is not None:
+                    self.database = database
+                self._entries.clear()
+                self._generation += 1
+                self.invalidations += 1
+            self._version = version
+
+    def get_table_info(self, table_names=None):
+        """Return the cached table info, reflecting the database only on a miss"""
+        key = tuple(sorted(table_names)) if table_names else None
+        self._check_version()
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and now - entry[0] < self.ttl_seconds:
+                    self.hits += 1
+                    return entry[1]
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    database, generation = self.database, self._generation
+                    break
+            # another caller is refreshing these tables, use its result (or retry if it failed)
+            loading.wait()
+        try:
+            table_info = database.get_table_info(table_names=table_names)
+            with self._lock:
+                # a refresh that started before an invalidation must not repopulate the cache
+                if generation == self._generation:
+                    self._entries[key] = (now, table_info)
+            return table_info
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
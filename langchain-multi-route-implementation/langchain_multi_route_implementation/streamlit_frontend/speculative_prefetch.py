@@ -0,0 +1,89 @@
+"""Speculative prefetch of destination inputs while the router runs
+
+The OpenSearch retrieval for the raw question and the schema of the SQL prompt are
+started together with the router in one RunnableParallel stage. The chosen route
+keeps what it needs and the rest is discarded. Each branch is timed so the wall
+time saved (or lost) per route can be compared with running the same work serially.
+A failing prefetch branch only leaves its value empty; the route then does the
+work itself as it would without the prefetch.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from langchain_core.runnables import RunnableLambda, RunnableParallel
+
+
+def timed(runnable):
+    """Wrap a runnable so it returns {"value": output, "error": exception or None, "seconds": wall time}"""
+    def run(x, config):
+        start = time.perf_counter()
+        try:
+            value, error = runnable.invoke(x, config), None
+        except Exception as e:
+            print(f"WARN: Speculative branch failed: {str(e)}")
+            value, error = None, e
+        return {"value": value, "error": error, "seconds": time.perf_counter() - start}
+    return RunnableLambda(run)
+
+
+def speculative_stage(router, **branches):
+    """Run the router and the prefetch branches in parallel
+
+    Returns {"topic", "question", "history", "prefetch"}, where prefetch maps the
+    router and each branch to its timed result. Only a router failure fails the stage.
+    """
+    def collect(x):
+        if x["router"]["error"] is not None:
+            raise x["router"]["error"]
+        return {
+            "topic": x["router"]["value"],
+            "question": x["question"],
+            "history": x["history"],
+            "prefetch": {branch: x[branch] for branch in ["router", *branches]},
+        }
+    return RunnableParallel(
+        router=timed(router),
+        **{branch: timed(runnable) for branch, runnable in branches.items()},
+        question=lambda x: x["question"],
+        history=lambda x: x["history"],
+    ) | RunnableLambda(collect)
+
+
+class PrefetchStats:
+    """Per-route wall time saved by the speculative stage compared with serial execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = defaultdict(int)
+        self.used = defaultdict(int)
+        self.saved_seconds = defaultdict(float)
+
+    def record(self, route, timings, used):
+        """Record one turn
+
+        timings maps the parallel branches (router included) to their wall time and
+        used lists the prefetched branches the route consumed. Serially the route
+        would have waited for the router plus the used branches; in parallel it waits
+        for the slowest branch, so the saving is negative when an unused branch was
+        slower than the router.
+        """
+        serial_seconds = timings["router"] + sum(timings[branch] for branch in used)
+        saved = serial_seconds - max(timings.values())
+        with self._lock:
+            self.runs[route] += 1
+            self.used[route] += bool(used)
+            self.saved_seconds[route] += saved
+        print(f"Speculative prefetch: route {route}, used {used}, saved {saved:.3f}s")
+        return saved
+
+    def stats(self):
+        with self._lock:
+            return {
+                route: {
+                    "runs": runs,
+                    "prefetch_used": self.used[route],
+                    "avg_saved_seconds": round(self.saved_seconds[route] / runs, 3),
+                }
+                for route, runs in self.runs.items()
+            }
@@ -0,0 +1,74 @@
+"""Identity of the signed-in user, taken only from a trusted authentication layer
+
+Request headers reach the app from the client through CloudFront, so a plain
+header such as x-amzn-oidc-identity can be set by anyone. USER_IDENTITY selects
+where the user id comes from:
+
+- none: no per-user identity, every request uses DEFAULT_USER_ID
+- alb_oidc: the `sub` claim of the x-amzn-oidc-data JWT added by an ALB
+  authenticate-oidc/cognito action, after checking its ES256 signature against
+  the ALB public key of the region, its expiry and, if ALB_ARN is set, its signer
+- header: USER_ID_HEADER as is, only behind a proxy that always sets or strips it
+
+Requests without a valid identity raise UnauthenticatedError in the last two modes.
+"""
+import re
+import urllib.request
+from functools import lru_cache
+
+import jwt
+
+OIDC_DATA_HEADER = "x-amzn-oidc-data"
+ALB_PUBLIC_KEY_URL = "https://public-keys.auth.elb.{region}.amazonaws.com/{kid}"
+KID_PATTERN = re.compile(r"^[A-Za-z0-9-]+$")
+IDENTITY_MODES = ["none", "alb_oidc", "header"]
+
+
+class UnauthenticatedError(Exception):
+    """The request carries no user identity the app can trust"""
+
+
+@lru_cache(maxsize=16)
+def alb_public_key(region, kid):
+    """PEM public key the ALBs of a region sign x-amzn-oidc-data with"""
+    with urllib.request.urlopen(ALB_PUBLIC_KEY_URL.format(region=region, kid=kid), timeout=5) as response:
+        return response.read().decode("utf-8")
+
+
+def verify_alb_oidc_data(token, region, alb_arn=None):
+    """Return the claims of an x-amzn-oidc-data JWT after checking its signature, expiry and signer"""
+    # the ALB pads the base64url segments, which PyJWT rejects
+    token = ".".join(part.rstrip("=") for part in token.split("."))
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.InvalidTokenError as e:
+        raise UnauthenticatedError(f"Malformed {OIDC_DATA_HEADER}: {str(e)}")
+    if alb_arn and header.get("signer") != alb_arn:
+        raise UnauthenticatedError(f"{OIDC_DATA_HEADER} signed by {header.get('signer')}, expected {alb_arn}")
+    kid = header.get("kid", "")
+    if not KID_PATTERN.match(kid):
+        raise UnauthenticatedError(f"Invalid key id in {OIDC_DATA_HEADER}: {kid}")
+    try:
+        return jwt.decode(token, alb_public_key(region, kid), algorithms=["ES256"])
+    except jwt.InvalidTokenError as e:
+        raise UnauthenticatedError(f"Invalid {OIDC_DATA_HEADER}: {str(e)}")
+
+
+def user_id_from_headers(headers, mode, region=None, alb_arn=None, user_id_header=None, default_user_id="default"):
+    """User id of a request according to the USER_IDENTITY mode"""
+    if mode == "none":
+        return default_user_id
+    if mode == "alb_oidc":
+        token = headers.get(OIDC_DATA_HEADER)
+        if not token:
+            raise UnauthenticatedError(f"Missing {OIDC_DATA_HEADER} header")
+        user_id = verify_alb_oidc_data(token, region, alb_arn).get("sub")
+        if not user_id:
+            raise UnauthenticatedError(f"No sub claim in {OIDC_DATA_HEADER}")
+        return user_id
+    if mode == "header":
+        user_id = headers.get(user_id_header)
+        if not user_id:
+            raise UnauthenticatedError(f"Missing {user_id_header} header")
+        return user_id
+    raise ValueError(f"Unknown user identity mode {mode}, expected one of {', '.join(IDENTITY_MODES)}")
@@ -0,0 +1,114 @@
+"""Offline recall/latency benchmark for the HNSW parameters of the docs index
+
+Embeds the chunks of data/iot_device_info exactly as the indexing custom resource
+splits them, builds faiss HNSW indexes over a grid of m, ef_construction and
+ef_search values and reports recall@k against exact (flat L2) search together
+with build time and per-query latency. Use it to pick the knn_settings passed to
+RagStack (rag_stack.py) before changing the deployed index.
+
+Embeddings are cached in --cache so only the first run calls Bedrock. The corpus
+is small, so --synthetic-scale N adds N noisy copies of every chunk vector to
+estimate how recall and latency behave as the corpus grows:
+
+    pip install faiss-cpu
+    python scripts/benchmark_knn.py --m 8 16 32 --ef-construction 128 512 --ef-search 32 128 512 --synthetic-scale 100
+"""
+import argparse
+import glob
+import os
+import time
+
+import faiss
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data", "iot_device_info")
+QUERY_TEMPLATES = [
+    "What are the features of {device}?",
+    "What are the technical specifications of {device}?",
+    "How do I install {device}?",
+    "How do I use {device}?",
+    "How should {device} be maintained?",
+    "What does the warranty of {device} cover?",
+]
+
+
+def load_chunks():
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    chunks, devices = [], []
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, "*.txt"))):
+        with open(path) as f:
+            chunks.extend(splitter.split_text(f.read()))
+        devices.append(os.path.splitext(os.path.basename(path))[0].replace("_", " "))
+    return chunks, devices
+
+
+def embed(texts, region, cache_path):
+    if cache_path and os.path.exists(cache_path):
+        vectors = np.load(cache_path)
+        if len(vectors) == len(texts):
+            return vectors
+    from langchain_community.embeddings import BedrockEmbeddings
+    vectors = np.asarray(BedrockEmbeddings(region_name=region).embed_documents(texts), dtype=np.float32)
+    if cache_path:
+        np.save(cache_path, vectors)
+    return vectors
+
+
+def synthetic_scale(vectors, copies, noise, seed=0):
+    """Append noisy copies of every vector to emulate a larger corpus"""
+    if copies <= 0:
+        return vectors
+    rng = np.random.default_rng(seed)
+    scale = noise * np.linalg.norm(vectors, axis=1).mean() / np.sqrt(vectors.shape[1])
+    extra = np.repeat(vectors, copies, axis=0)
+    extra += rng.normal(0, scale, extra.shape).astype(np.float32)
+    return np.vstack([vectors, extra])
+
+
+def recall_at_k(found, truth, k):
+    return np.mean([len(set(f[:k]) & set(t[:k])) / k for f, t in zip(found, truth)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION", "us-west-2"))
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--m", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[128, 512])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--synthetic-scale", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--cache", default="/tmp/benchmark_knn_{kind}.npy")
+    args = parser.parse_args()
+
+    chunks, devices = load_chunks()
+    queries = [template.format(device=device) for device in devices for template in QUERY_TEMPLATES]
+    vectors = embed(chunks, args.region, args.cache.format(kind="chunks"))
+    query_vectors = embed(queries, args.region, args.cache.format(kind="queries"))
+    vectors = synthetic_scale(vectors, args.synthetic_scale, args.noise)
+    print(f"{len(vectors)} vectors, {len(queries)} queries, k={args.k}")
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    _, truth = flat.search(query_vectors, args.k)
+
+    print(f"{'m':>4} {'ef_con':>7} {'ef_search':>9} {'build s':>8} {'recall@k':>9} {'ms/query':>9}")
+    for m in args.m:
+        for ef_construction in args.ef_construction:
+            index = faiss.IndexHNSWFlat(vectors.shape[1], m)
+            index.hnsw.efConstruction = ef_construction
+            start = time.perf_counter()
+            index.add(vectors)
+            build_seconds = time.perf_counter() - start
+            for ef_search in args.ef_search:
+                index.hnsw.efSearch = ef_search
+                start = time.perf_counter()
+                _, found = index.search(query_vectors, args.k)
+                query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+                print(f"{m:>4} {ef_construction:>7} {ef_search:>9} {build_seconds:>8.2f} "
+                      f"{recall_at_k(found, truth, args.k):>9.3f} {query_ms:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Benchmark latency and accuracy of candidate models per chain
+
+Runs labelled cases through the app's own prompts (prompts.py) for the router,
+lambda JSON extraction, SQL generation and RAG answer chains, once per candidate
+model, and reports accuracy, p50/p95 latency and mean input/output tokens:
+
+- router: the destination in the JSON matches the expected route
+- lambda: the extracted Action and deviceID match
+- sql: the generated query contains the expected filters and aggregates
+- rag: the answer, given the device's document as context, contains the expected fact
+
+Use it to pick the per-chain models of the registry (model_registry.py, MODEL_CONFIG).
+Run it with AWS credentials that can invoke the models:
+
+    python scripts/benchmark_models.py --chains router lambda sql --repeats 3
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+FRONTEND_DIR = os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation", "streamlit_frontend")
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data", "iot_device_info")
+sys.path.insert(0, FRONTEND_DIR)
+from langchain_aws import ChatBedrockConverse  # noqa: E402
+from langchain_core.prompts import ChatPromptTemplate  # noqa: E402
+
+import prompts  # noqa: E402
+from model_registry import DEFAULT_MODELS, LARGE_MODEL_ID, SMALL_MODEL_ID  # noqa: E402
+from prompt_cache import cached_prompt  # noqa: E402
+
+JSON_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
+ROUTER_CASES = [
+    ("What is the maximum pressure for device 1003 in the last 6 hours?", "sql"),
+    ("Give me the average temperature of device 1007 today", "sql"),
+    ("Shut down device 1005", "lambdachain"),
+    ("Please restart device 1002", "lambdachain"),
+    ("What do you know about device 1008?", "rag"),
+    ("How do I install device 1000?", "rag"),
+    ("Why does oil viscosity drop at high temperatures?", "physics"),
+    ("Can you summarize our conversation so far?", "default"),
+]
+
+LAMBDA_CASES = [
+    ("Shut down device 1005", "shutdowndevice", "1005"),
+    ("Turn on device 1001", "turnondevice", "1001"),
+    ("Please restart device 1009 now", "restartdevice", "1009"),
+]
+
+SQL_CASES = [
+    ("Give me max metrics for device 1007", ["device_id = 1007", "max(temperature)", "group by"]),
+    ("What is the average pressure of device 1003 in the last 6 hours?",
+     ["device_id = 1003", "avg(pressure)", "received_at", "received_date"]),
+    ("Show the minimum oil level per device", ["min(oil_level)", "group by"]),
+]
+
+# what SQLDatabase.get_table_info() gives the app's SQL prompt, without the sample rows
+SQL_SCHEMA = """CREATE EXTERNAL TABLE iot_device_metrics_parquet (
+	device_name BIGINT,
+	oil_level DOUBLE,
+	temperature DOUBLE,
+	pressure DOUBLE,
+	received_at TIMESTAMP,
+	device_id BIGINT,
+	received_date DATE
+)"""
+
+RAG_CASES = [
+    ("What is the humidity range of device 1004?", "device_1004.txt", "0% to 100%"),
+    ("What battery life does device 1008 have?", "device_1008.txt", "10"),
+    ("What is the VOC range of device 1001?", "device_1001.txt", "2000 ppm"),
+    ("What does device 1007 monitor?", "device_1007.txt", "dissolved oxygen"),
+]
+
+
+def parse_json(text):
+    match = JSON_PATTERN.search(text)
+    return json.loads(match.group(0)) if match else {}
+
+
+def normalize_sql(text):
+    text = re.sub(r"\s*=\s*", " = ", re.sub(r"\s+", " ", text.lower()))
+    return text.replace("( ", "(").replace(" )", ")")
+
+
+def chain_cases(name):
+    """(prompt, [(input, check)]) of a chain, check maps the answer text to True/False"""
+    if name == "router":
+        prompt = cached_prompt(prompts.ROUTER_SYSTEM, prompts.ROUTER_TEMPLATE, False)
+        return prompt, [({"question": question, "history": ""},
+                         lambda text, expected=expected: parse_json(text).get("destination", "").lower() == expected)
+                        for question, expected in ROUTER_CASES]
+    if name == "lambda":
+        prompt = cached_prompt(prompts.LAMBDA_EXECUTE_SYSTEM, prompts.LAMBDA_EXECUTE_TEMPLATE, False)
+
+        def check(text, action, device_id):
+            decision = parse_json(text)
+            return str(decision.get("Action", "")).lower() == action and str(decision.get("deviceID", "")) == device_id
+        return prompt, [({"next_inputs": question}, lambda text, a=action, d=device_id: check(text, a, d))
+                        for question, action, device_id in LAMBDA_CASES]
+    if name == "sql":
+        prompt = cached_prompt(prompts.SQL_SYSTEM, prompts.SQL_TEMPLATE, False)
+        return prompt, [({"next_inputs": question, "schema": SQL_SCHEMA},
+                         lambda text, parts=parts: all(part in normalize_sql(text) for part in parts))
+                        for question, parts in SQL_CASES]
+    if name == "rag":
+        prompt = ChatPromptTemplate.from_template(prompts.RAG_TEMPLATE)
+        cases = []
+        for question, file_name, fact in RAG_CASES:
+            with open(os.path.join(DATA_DIR, file_name)) as f:
+                context = f"[{file_name}]\n{f.read()}"
+            cases.append(({"next_inputs": question, "context": context},
+                          lambda text, fact=fact: fact.lower() in text.lower()))
+        return prompt, cases
+    raise ValueError(f"Unknown chain {name}")
+
+
+def run(chain_name, model_id, region, repeats):
+    prompt, cases = chain_cases(chain_name)
+    config = DEFAULT_MODELS[chain_name]
+    llm = ChatBedrockConverse(region_name=region, model=model_id, max_tokens=config["max_tokens"],
+                              temperature=config["temperature"])
+    latencies, correct, input_tokens, output_tokens = [], 0, [], []
+    for _ in range(repeats):
+        for chain_input, check in cases:
+            start = time.perf_counter()
+            message = (prompt | llm).invoke(chain_input)
+            latencies.append(time.perf_counter() - start)
+            correct += int(check(message.content if isinstance(message.content, str) else str(message.content)))
+            usage = message.usage_metadata or {}
+            input_tokens.append(usage.get("input_tokens", 0))
+            output_tokens.append(usage.get("output_tokens", 0))
+    latencies.sort()
+    print(f"{chain_name:>7} {model_id:>45} {correct / len(latencies):>9.2f} "
+          f"{latencies[len(latencies) // 2]:>7.2f} {latencies[int(0.95 * (len(latencies) - 1))]:>7.2f} "
+          f"{statistics.mean(input_tokens):>7.0f} {statistics.mean(output_tokens):>7.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION", "us-west-2"))
+    parser.add_argument("--chains", nargs="+", default=["router", "lambda", "sql", "rag"],
+                        choices=["router", "lambda", "sql", "rag"])
+    parser.add_argument("--models", nargs="+", default=[SMALL_MODEL_ID, LARGE_MODEL_ID, "anthropic.claude-v2:1"])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'chain':>7} {'model':>45} {'accuracy':>9} {'p50 s':>7} {'p95 s':>7} {'in tok':>7} {'out tok':>7}")
+    for chain_name in args.chains:
+        for model_id in args.models:
+            try:
+                run(chain_name, model_id, args.region, args.repeats)
+            except Exception as e:
+                print(f"{chain_name:>7} {model_id:>45} failed: {str(e)}")
+
+
+if __name__ == "__main__":
+    main()
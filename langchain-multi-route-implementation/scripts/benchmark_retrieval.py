@@ -0,0 +1,79 @@
+"""Micro-benchmark k-NN retrieval latency against the OpenSearch Serverless collection
+
+Compares three ways of sending the same small k-NN query:
+
+- legacy: a new AWS4Auth + RequestsHttpConnection client per query, as the app did
+  when it rebuilt the retriever on every Streamlit rerun
+- legacy-reused: one AWS4Auth + RequestsHttpConnection client for all queries
+- pooled: one client with Urllib3AWSV4SignerAuth and a keep-alive urllib3 pool,
+  as the app does now (opensearch_client.py)
+
+The query vector is embedded once up front so only the OpenSearch round trip is
+measured. Run it with AWS credentials that can access the collection:
+
+    python scripts/benchmark_retrieval.py --endpoint https://<id>.<region>.aoss.amazonaws.com --queries 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import boto3
+from opensearchpy import OpenSearch, RequestsHttpConnection
+from requests_aws4auth import AWS4Auth
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation", "streamlit_frontend"))
+from opensearch_client import opensearch_connection_kwargs  # noqa: E402
+
+QUESTION = "How do I replace the oil filter on a hydraulic pump?"
+
+
+def legacy_client(endpoint, region):
+    credentials = boto3.Session().get_credentials()
+    auth = AWS4Auth(credentials.access_key, credentials.secret_key, region, "aoss", session_token=credentials.token)
+    return OpenSearch(endpoint, http_auth=auth, use_ssl=True, verify_certs=True, connection_class=RequestsHttpConnection)
+
+
+def pooled_client(endpoint, region):
+    return OpenSearch(endpoint, **opensearch_connection_kwargs(region))
+
+
+def knn_query(vector, k):
+    return {"size": k, "query": {"knn": {"vector_field": {"vector": vector, "k": k}}}}
+
+
+def run(name, client_fn, queries, index, body):
+    latencies = []
+    client = None
+    for _ in range(queries):
+        start = time.perf_counter()
+        if client is None or name == "legacy":
+            client = client_fn()
+        client.search(index=index, body=body)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print(f"{name:>14}: mean {statistics.mean(latencies):7.1f} ms  p50 {latencies[len(latencies) // 2]:7.1f} ms  "
+          f"p95 {latencies[int(0.95 * (len(latencies) - 1))]:7.1f} ms  min {latencies[0]:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--endpoint", default=os.environ.get("OPENSEARCH_ENDPOINT"))
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION", "us-west-2"))
+    parser.add_argument("--index", default="docs")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+
+    from langchain_community.embeddings import BedrockEmbeddings
+    vector = BedrockEmbeddings(region_name=args.region).embed_query(QUESTION)
+    body = knn_query(vector, args.k)
+
+    run("legacy", lambda: legacy_client(args.endpoint, args.region), args.queries, args.index, body)
+    run("legacy-reused", lambda: legacy_client(args.endpoint, args.region), args.queries, args.index, body)
+    run("pooled", lambda: pooled_client(args.endpoint, args.region), args.queries, args.index, body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Load test the Streamlit frontend with concurrent chat sessions in one process
+
+Each simulated session runs the app script with Streamlit's AppTest harness on
+its own thread, like the Streamlit server does for browser sessions, and sends
+a series of questions. The test is run once with the synchronous chains and once
+with ASYNC_EXECUTION_ENABLED, and reports per-turn latency and throughput for each
+session count. "Sessions per task" is the largest session count whose p95 turn
+latency stays within --latency-slo.
+
+Run it with the same environment variables as the ECS task (see app_env_vars in
+app.py) and AWS credentials for the deployed stacks:
+
+    python scripts/load_test.py --sessions 1 4 8 16 --turns 3
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+import boto3
+from streamlit.testing.v1 import AppTest
+
+FRONTEND_DIR = os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation", "streamlit_frontend")
+APP_SCRIPT = os.path.join(FRONTEND_DIR, "routing_chain_claude_with_memory_dynamo.py")
+
+QUESTIONS = [
+    "What is the maximum pressure for device 1003 in the last 6 hours?",
+    "How do I replace the oil filter on a hydraulic pump?",
+    "What is the average temperature of device 1007 today?",
+    "Why does oil viscosity drop at high temperatures?",
+    "Show the minimum oil level of device 1012 yesterday",
+]
+
+
+def run_session(session_name, turns, latencies, errors):
+    """Open one chat session and ask `turns` questions, recording each turn's latency"""
+    app = AppTest.from_file(APP_SCRIPT, default_timeout=300)
+    app.session_state["session_name"] = session_name
+    app.session_state["chat_history_list"] = [session_name]
+    app.run()
+    for turn in range(turns):
+        start = time.perf_counter()
+        app.chat_input[0].set_value(QUESTIONS[turn % len(QUESTIONS)]).run()
+        elapsed = time.perf_counter() - start
+        if app.exception:
+            errors.append(str(app.exception[0].message))
+        else:
+            latencies.append(elapsed)
+
+
+def run_level(mode, sessions, turns):
+    """Run `sessions` concurrent sessions and return (latencies, errors, wall seconds, session names)"""
+    latencies, errors = [], []
+    names = [f"Load test - {mode} - {sessions} - {i} - {uuid.uuid4().hex[:8]}" for i in range(sessions)]
+    threads = [threading.Thread(target=run_session, args=(name, turns, latencies, errors)) for name in names]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - start, names
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def delete_sessions(names):
+    from chat_history import delete_session
+    dynamodb = boto3.resource("dynamodb")
+    table = dynamodb.Table(os.environ.get("MEMORY_TABLE", "SessionTable"))
+    archive_table_name = os.environ.get("MEMORY_ARCHIVE_TABLE")
+    archive_table = dynamodb.Table(archive_table_name) if archive_table_name else None
+    for name in names:
+        delete_session(table, archive_table, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--turns", type=int, default=3, help="questions asked per session")
+    parser.add_argument("--modes", nargs="+", choices=["sync", "async"], default=["sync", "async"])
+    parser.add_argument("--latency-slo", type=float, default=15.0, help="p95 turn latency target in seconds")
+    parser.add_argument("--keep-sessions", action="store_true", help="keep the load test chats in DynamoDB")
+    args = parser.parse_args()
+
+    sys.path.insert(0, FRONTEND_DIR)
+    results = []
+    for mode in args.modes:
+        # the app reads its configuration on every script run
+        os.environ["ASYNC_EXECUTION_ENABLED"] = "true" if mode == "async" else "false"
+        for sessions in args.sessions:
+            latencies, errors, wall, names = run_level(mode, sessions, args.turns)
+            if not args.keep_sessions:
+                delete_sessions(names)
+            row = {
+                "mode": mode,
+                "sessions": sessions,
+                "turns": len(latencies),
+                "errors": len(errors),
+                "p50": statistics.median(latencies) if latencies else float("nan"),
+                "p95": percentile(latencies, 0.95) if latencies else float("nan"),
+                "turns_per_minute": 60 * len(latencies) / wall,
+            }
+            results.append(row)
+            print(f"{mode:>5} sessions={sessions:<3} turns={row['turns']:<4} errors={row['errors']:<3} "
+                  f"p50={row['p50']:.2f}s p95={row['p95']:.2f}s throughput={row['turns_per_minute']:.1f} turns/min")
+            for error in errors[:3]:
+                print(f"      error: {error}")
+
+    print(f"\nSessions per task with p95 <= {args.latency_slo}s:")
+    for mode in args.modes:
+        within_slo = [row["sessions"] for row in results
+                      if row["mode"] == mode and not row["errors"] and row["p95"] <= args.latency_slo]
+        print(f"  {mode}: {max(within_slo) if within_slo else 0}")
+
+
+if __name__ == "__main__":
+    main()
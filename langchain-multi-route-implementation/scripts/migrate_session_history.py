@@ -0,0 +1,119 @@
+"""Migrate chat session items written by earlier versions of the app
+
+The physics and general chains used to record the turn through their own
+RunnableWithMessageHistory on top of the full chain's, so those turns were stored
+twice: once with the bare answer and once with the "final_answer: " prefix the UI
+filtered on. This script rewrites each legacy session item to one human and one
+AI message per turn: duplicated human messages and unprefixed AI messages are
+dropped and the prefix is removed. Sessions without prefixed messages are left
+untouched, so the script can be run more than once.
+
+Sessions without the UserId/UpdatedAt keys of the UserSessionsIndex are backfilled
+so they show up in the session picker: they are assigned to --user-id and keep
+their stored UpdatedAt. Items written before UpdatedAt existed have no timestamp,
+so they are dated from the session name ("Chat - Mon Jan 01 @ 12:00:00"), in the
+latest year, up to now, whose calendar has that weekday on that date. Names that
+don't parse get the migration time.
+
+    python scripts/migrate_session_history.py --table <MEMORY_TABLE> [--user-id default] [--dry-run]
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timezone
+
+import boto3
+
+LEGACY_PREFIX = "final_answer: "
+SESSION_NAME_FORMAT = "Chat - %a %b %d @ %H:%M:%S"
+
+
+def compact_history(history):
+    """Return the compacted History list, or None when the session isn't in the legacy format"""
+    if not any(message["type"] == "ai" and str(message["data"]["content"]).startswith(LEGACY_PREFIX)
+               for message in history):
+        return None
+    compacted = []
+    for message in history:
+        content = str(message["data"]["content"])
+        if message["type"] == "ai":
+            # answers recorded by the nested wrappers were stored without the prefix
+            if not content.startswith(LEGACY_PREFIX):
+                continue
+            message = {**message, "data": {**message["data"], "content": content[len(LEGACY_PREFIX):]}}
+        elif message["type"] == "human" and compacted and compacted[-1]["type"] == "human" \
+                and compacted[-1]["data"]["content"] == content:
+            continue
+        compacted.append(message)
+    return compacted
+
+
+def session_updated_at(session_id, now):
+    """Best-effort creation time of a legacy session without UpdatedAt, from its generated name
+
+    The name has no year, the weekday picks the year (the calendar repeats every 28 years).
+    """
+    for year in range(now.year, now.year - 28, -1):
+        try:
+            created = datetime.strptime(f"{year} {session_id}", f"%Y {SESSION_NAME_FORMAT}").replace(tzinfo=timezone.utc)
+        except ValueError:
+            # not a generated name, or Feb 29 in a non-leap year
+            continue
+        # strptime ignores the weekday, so check it round-trips
+        if created <= now and created.strftime(SESSION_NAME_FORMAT) == session_id:
+            return created.isoformat()
+    return now.isoformat()
+
+
+def scan_sessions(table):
+    query = {}
+    while True:
+        response = table.scan(**query)
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--table", default=os.environ.get("MEMORY_TABLE", "SessionTable"))
+    parser.add_argument("--user-id", default="default", help="owner of sessions without a UserId")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+
+    table = boto3.resource("dynamodb").Table(args.table)
+    now = datetime.now(timezone.utc)
+    sessions = compacted_sessions = backfilled = bytes_before = bytes_after = 0
+    for item in scan_sessions(table):
+        sessions += 1
+        updates = {}
+        history = item.get("History", [])
+        compacted = compact_history(history)
+        if compacted is not None:
+            before, after = len(json.dumps(history, default=str)), len(json.dumps(compacted, default=str))
+            bytes_before += before
+            bytes_after += after
+            compacted_sessions += 1
+            updates["History"] = compacted
+            print(f"{item['SessionId']}: {len(history)} -> {len(compacted)} messages, {before} -> {after} bytes")
+        if "UserId" not in item or "UpdatedAt" not in item:
+            backfilled += 1
+            updates["UserId"] = item.get("UserId", args.user_id)
+            updates["UpdatedAt"] = item.get("UpdatedAt") or session_updated_at(item["SessionId"], now)
+            print(f"{item['SessionId']}: user {updates['UserId']}, updated at {updates['UpdatedAt']}")
+        if updates and not args.dry_run:
+            table.update_item(
+                Key={"SessionId": item["SessionId"]},
+                UpdateExpression="SET " + ", ".join(f"#{name} = :{name}" for name in updates),
+                ExpressionAttributeNames={f"#{name}": name for name in updates},
+                ExpressionAttributeValues={f":{name}": value for name, value in updates.items()},
+            )
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{action} {sessions} sessions: {compacted_sessions} compacted (history {bytes_before} -> {bytes_after} bytes), "
+          f"{backfilled} backfilled")
+
+
+if __name__ == "__main__":
+    main()
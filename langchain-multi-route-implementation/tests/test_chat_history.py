@@ -0,0 +1,88 @@
+"""Session ids and archiving the overflow of the cached chat history"""
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("langchain_core")
+from langchain_core.messages import AIMessage, HumanMessage  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation",
+                                "streamlit_frontend"))
+from chat_history import CachedChatMessageHistory, new_session_id, session_title  # noqa: E402
+
+
+class FakeTable:
+    """get_item/put_item/batch_writer of a DynamoDB table resource, keeping the items in a list"""
+
+    def __init__(self, fail_writes=False):
+        self.items = []
+        self.fail_writes = fail_writes
+
+    def get_item(self, Key):
+        return {}
+
+    def put_item(self, Item):
+        self.items.append(Item)
+
+    def batch_writer(self):
+        table = self
+
+        class Batch:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def put_item(self, Item):
+                if table.fail_writes:
+                    raise ConnectionError("throttled")
+                table.put_item(Item)
+        return Batch()
+
+
+def history(archive_table, summarize_fn):
+    messages = CachedChatMessageHistory(FakeTable(), "session", "user", archive_table=archive_table,
+                                        token_budget=60, summarize_fn=summarize_fn)
+    for i in range(3):
+        messages.add_messages([HumanMessage(content=f"question {i} " * 10), AIMessage(content=f"answer {i} " * 10)])
+    return messages
+
+
+def test_overflow_is_archived_and_summarized_outside_the_lock():
+    archive = FakeTable()
+
+    def summarize(summary, overflow):
+        assert not messages._lock.locked()
+        return f"{len(overflow)} messages"
+    messages = history(archive, summarize)
+
+    messages.flush()
+
+    assert [item["MessageIndex"] for item in archive.items] == [0, 1, 2, 3]
+    assert messages.archived_count == 4
+    assert messages.summary == "4 messages"
+    assert [message.content for message in messages.messages[1:]] == ["question 2 " * 10, "answer 2 " * 10]
+
+
+def test_failed_archive_write_keeps_the_messages():
+    messages = history(FakeTable(fail_writes=True), lambda summary, overflow: "summary")
+
+    messages.flush()
+
+    assert messages.archived_count == 0
+    assert messages.summary == ""
+    assert len(messages.messages) == 6
+    assert len(messages.table.items[-1]["History"]) == 6
+
+
+def test_sessions_started_in_the_same_second_get_distinct_ids():
+    now = datetime(2026, 10, 18, 9, 30, 0)
+    first, second = new_session_id(now), new_session_id(now)
+
+    assert first != second
+    assert session_title(first) == session_title(second) == "Chat - Sun Oct 18 @ 09:30:00"
+    assert session_title("Chat - Mon Jan 01 @ 12:00:00") == "Chat - Mon Jan 01 @ 12:00:00"
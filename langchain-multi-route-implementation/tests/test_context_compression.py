@@ -0,0 +1,38 @@
+"""Merging overlapping chunks into passages"""
+import os
+import sys
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation",
+                                "streamlit_frontend"))
+from context_compression import merge_passages  # noqa: E402
+
+Document = namedtuple("Document", ["page_content", "metadata"])
+
+TEXT = "\n".join(f"Line {i}: device 1001 operating range and maintenance notes." for i in range(40))
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def chunks(text, source):
+    """Fixed-size chunks overlapping like the ingestion splitter's"""
+    starts = range(0, len(text) - CHUNK_OVERLAP, CHUNK_SIZE - CHUNK_OVERLAP)
+    return [Document(text[start:start + CHUNK_SIZE], {"source": source}) for start in starts]
+
+
+def test_middle_chunk_ranked_last_joins_the_passages_it_bridges():
+    documents = chunks(TEXT, "/tmp/docs/device_1001.txt")
+    assert len(documents) == 3
+
+    passages = merge_passages([documents[0], documents[2], documents[1]])
+
+    assert passages == [("device_1001.txt", TEXT)]
+
+
+def test_chunks_of_other_files_stay_separate():
+    first, second = chunks(TEXT, "device_1001.txt"), chunks(TEXT, "device_1002.txt")
+
+    passages = merge_passages([first[0], second[0], first[1]])
+
+    assert [source for source, _ in passages] == ["device_1001.txt", "device_1002.txt"]
+    assert passages[0][1] == TEXT[:CHUNK_SIZE + CHUNK_SIZE - CHUNK_OVERLAP]
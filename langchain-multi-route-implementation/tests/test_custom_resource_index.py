@@ -0,0 +1,110 @@
+"""create_index of the indexing custom resource against an in-memory indices client"""
+import importlib.util
+import os
+
+import pytest
+
+for module in ["boto3", "numpy", "langchain", "opensearchpy", "requests_aws4auth"]:
+    pytest.importorskip(module)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation",
+                          "custom_resources", "index.py")
+spec = importlib.util.spec_from_file_location("custom_resource_index", INDEX_PATH)
+index = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(index)
+
+KNN_SETTINGS = {"engine": "faiss", "space_type": "l2", "m": "16", "ef_construction": "512",
+                "ef_search": "512", "shards": "2"}
+
+
+class FakeIndices:
+    """The indices API calls create_index makes, storing one index like OpenSearch reports it"""
+
+    def __init__(self):
+        self.index = None
+        self.calls = []
+
+    def exists(self, name):
+        return self.index is not None
+
+    def create(self, name, body):
+        self.calls.append("create")
+        settings = body["settings"]
+        self.index = {
+            "settings": {
+                "index.number_of_shards": str(settings["number_of_shards"]),
+                "index.knn.algo_param.ef_search": str(settings["knn.algo_param"]["ef_search"]),
+            },
+            "method": body["mappings"]["properties"]["vector_field"]["method"],
+        }
+
+    def delete(self, index):
+        self.calls.append("delete")
+        self.index = None
+
+    def get_mapping(self, index):
+        return {index: {"mappings": {"properties": {"vector_field": {"method": self.index["method"]}}}}}
+
+    def get_settings(self, index, flat_settings):
+        return {index: {"settings": dict(self.index["settings"])}}
+
+    def put_settings(self, index, body):
+        self.calls.append("put_settings")
+        self.index["settings"]["index.knn.algo_param.ef_search"] = str(body["index"]["knn.algo_param.ef_search"])
+
+    def put_mapping(self, index, body):
+        self.calls.append("put_mapping")
+
+
+class FakeClient:
+    def __init__(self):
+        self.indices = FakeIndices()
+
+
+@pytest.fixture
+def client():
+    client = FakeClient()
+    assert index.create_index(client, KNN_SETTINGS)
+    client.indices.calls.clear()
+    return client
+
+
+def test_unchanged_settings_keep_index(client):
+    assert not index.create_index(client, KNN_SETTINGS)
+    assert client.indices.calls == ["put_mapping"]
+
+
+def test_ef_search_change_updates_existing_index(client):
+    assert not index.create_index(client, {**KNN_SETTINGS, "ef_search": "128"})
+    assert "put_settings" in client.indices.calls
+    assert "delete" not in client.indices.calls
+    assert client.indices.index["settings"]["index.knn.algo_param.ef_search"] == "128"
+
+
+def test_shard_change_recreates_index(client):
+    assert index.create_index(client, {**KNN_SETTINGS, "shards": "4"})
+    assert client.indices.calls[:2] == ["delete", "create"]
+    assert client.indices.index["settings"]["index.number_of_shards"] == "4"
+
+
+def test_method_change_recreates_index(client):
+    assert index.create_index(client, {**KNN_SETTINGS, "m": "32"})
+    assert client.indices.calls[:2] == ["delete", "create"]
+
+
+def test_same_file_name_under_different_prefixes_downloads_both(tmp_path, monkeypatch):
+    class FakeS3:
+        def download_file(self, bucket, key, path):
+            with open(path, "w") as f:
+                f.write(key)
+
+    monkeypatch.setattr(index, "s3_client", FakeS3())
+    keys = ["iot_device_info/line_a/device_1001.txt", "iot_device_info/line_b/device_1001.txt"]
+
+    paths = index.download_documents("bucket", keys, str(tmp_path))
+
+    assert len(set(paths.values())) == 2
+    for key, path in paths.items():
+        with open(path) as f:
+            assert f.read() == key
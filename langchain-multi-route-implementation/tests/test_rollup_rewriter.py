@@ -0,0 +1,38 @@
+"""Rewriting aggregate queries to the hourly rollup view"""
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "metrics_rollup"))
+from rollup_rewriter import rewrite_to_rollup  # noqa: E402
+
+
+def test_avg_divides_by_non_null_count():
+    rewritten = rewrite_to_rollup(
+        "SELECT device_id, AVG(temperature) AS avg_temperature FROM iot_device_metrics_parquet "
+        "WHERE device_id = 1001 GROUP BY device_id")
+    assert "SUM(sum_temperature) / SUM(count_temperature) AS avg_temperature" in rewritten
+    assert "row_count" not in rewritten
+
+
+def test_count_of_metric_and_rows():
+    rewritten = rewrite_to_rollup("SELECT COUNT(pressure), COUNT(*) FROM iot_device_metrics_parquet")
+    assert rewritten.startswith(
+        "SELECT COALESCE(SUM(count_pressure), 0), COALESCE(SUM(row_count), 0)\nFROM iot_device_metrics_hourly_all")
+
+
+def test_count_over_empty_range_is_zero():
+    query = ("SELECT COUNT(*) AS readings, COUNT(pressure) AS pressure_readings FROM iot_device_metrics_parquet "
+             "WHERE device_id = 1001 AND received_date BETWEEN '2030-01-01' AND '2030-01-02'")
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE iot_device_metrics_parquet (device_id, pressure, received_date)")
+    db.execute("INSERT INTO iot_device_metrics_parquet VALUES (1001, 30.5, '2024-01-01')")
+    db.execute("CREATE TABLE iot_device_metrics_hourly_all (device_id, row_count, count_pressure, received_date)")
+    db.execute("INSERT INTO iot_device_metrics_hourly_all VALUES (1001, 1, 1, '2024-01-01')")
+
+    assert db.execute(rewrite_to_rollup(query)).fetchall() == db.execute(query).fetchall() == [(0, 0)]
+
+
+def test_ineligible_filter_runs_unchanged():
+    assert rewrite_to_rollup(
+        "SELECT MAX(temperature) FROM iot_device_metrics_parquet WHERE received_at > now() - interval '1' hour") is None
@@ -0,0 +1,73 @@
+"""Single-flight refreshes of the schema cache"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation",
+                                "streamlit_frontend"))
+from schema_cache import SchemaCache  # noqa: E402
+
+
+class SlowDatabase:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.calls = 0
+
+    def get_table_info(self, table_names=None):
+        self.calls += 1
+        time.sleep(self.seconds)
+        return f"CREATE TABLE {table_names or 'all'}"
+
+
+def test_concurrent_misses_share_one_refresh():
+    database = SlowDatabase(0.2)
+    cache = SchemaCache(database)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_table_info())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert database.calls == 1
+    assert results == ["CREATE TABLE all"] * 5
+    assert cache.stats() == {"hits": 4, "misses": 1, "invalidations": 0}
+
+
+def test_refresh_does_not_block_other_tables():
+    database = SlowDatabase(0.5)
+    cache = SchemaCache(database)
+    database.seconds = 0
+    cache.get_table_info(["iot_device_metrics_parquet"])
+    database.seconds = 0.5
+
+    refresh = threading.Thread(target=cache.get_table_info)
+    refresh.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    assert cache.get_table_info(["iot_device_metrics_parquet"]) == "CREATE TABLE ['iot_device_metrics_parquet']"
+    assert time.monotonic() - start < 0.2
+    refresh.join()
+
+
+def test_catalog_change_invalidates():
+    versions = iter(["v1", "v2"])
+    database = SlowDatabase(0)
+    cache = SchemaCache(database, version_fn=lambda: next(versions), version_check_seconds=0)
+    cache.get_table_info()
+    cache.get_table_info()
+
+    assert database.calls == 2
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_catalog_change_rebuilds_database():
+    versions = iter(["v1", "v2"])
+    old, new = SlowDatabase(0), SlowDatabase(0)
+    new.get_table_info = lambda table_names=None: "CREATE TABLE with new column"
+    cache = SchemaCache(old, version_fn=lambda: next(versions), version_check_seconds=0, database_fn=lambda: new)
+
+    assert cache.get_table_info() == "CREATE TABLE all"
+    assert cache.get_table_info() == "CREATE TABLE with new column"
+    assert cache.database is new
@@ -0,0 +1,42 @@
+"""Error isolation of the speculative router stage"""
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("langchain_core")
+from langchain_core.runnables import RunnableLambda  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation",
+                                "streamlit_frontend"))
+from speculative_prefetch import speculative_stage  # noqa: E402
+
+SQL_ROUTE = "```json\n" + json.dumps({"destination": "sql", "next_inputs": "max pressure of device 1003"}) + "\n```"
+
+
+def failing_retriever(question):
+    raise ConnectionError("OpenSearch unavailable")
+
+
+def test_failing_retriever_still_routes_sql_question():
+    stage = speculative_stage(RunnableLambda(lambda x: SQL_ROUTE),
+                              rag=RunnableLambda(lambda x: x["question"]) | RunnableLambda(failing_retriever),
+                              sql=RunnableLambda(lambda x: "CREATE TABLE iot_device_metrics_parquet (...)"))
+
+    result = stage.invoke({"question": "What is the max pressure of device 1003?", "history": ""})
+
+    assert result["topic"] == SQL_ROUTE
+    assert result["prefetch"]["rag"]["value"] is None
+    assert isinstance(result["prefetch"]["rag"]["error"], ConnectionError)
+    assert result["prefetch"]["sql"]["error"] is None
+    assert set(result["prefetch"]) == {"router", "rag", "sql"}
+
+
+def test_router_failure_fails_the_stage():
+    def failing_router(x):
+        raise ValueError("throttled")
+
+    stage = speculative_stage(RunnableLambda(failing_router), rag=RunnableLambda(lambda x: []))
+    with pytest.raises(ValueError):
+        stage.invoke({"question": "hello", "history": ""})
@@ -0,0 +1,75 @@
+"""User identity from the ALB's signed x-amzn-oidc-data header"""
+import base64
+import json
+import os
+import sys
+import time
+
+import pytest
+
+jwt = pytest.importorskip("jwt")
+pytest.importorskip("cryptography")
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "langchain_multi_route_implementation",
+                                "streamlit_frontend"))
+import user_identity  # noqa: E402
+from user_identity import UnauthenticatedError, user_id_from_headers  # noqa: E402
+
+ALB_ARN = "arn:aws:elasticloadbalancing:us-west-2:123456789012:loadbalancer/app/streamlit/50dc6c495c0c9188"
+KID = "5f6e3d2c-1b0a-4c9d-8e7f-6a5b4c3d2e1f"
+PRIVATE_KEY = ec.generate_private_key(ec.SECP256R1())
+PUBLIC_KEY = PRIVATE_KEY.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode("utf-8")
+
+
+@pytest.fixture(autouse=True)
+def alb_public_key(monkeypatch):
+    monkeypatch.setattr(user_identity, "alb_public_key", lambda region, kid: PUBLIC_KEY if kid == KID else None)
+
+
+def alb_token(claims, signer=ALB_ARN, key=PRIVATE_KEY):
+    """A token like the ALB's, whose base64url segments keep their padding"""
+    token = jwt.encode({"exp": int(time.time()) + 60, **claims}, key, algorithm="ES256",
+                       headers={"kid": KID, "signer": signer})
+    return ".".join(part + "=" * (-len(part) % 4) for part in token.split("."))
+
+
+def alb_user_id(headers, alb_arn=ALB_ARN):
+    return user_id_from_headers(headers, "alb_oidc", "us-west-2", alb_arn)
+
+
+def test_verified_sub_is_the_user_id():
+    headers = {"x-amzn-oidc-data": alb_token({"sub": "user-1"}), "x-amzn-oidc-identity": "user-2"}
+    assert alb_user_id(headers) == "user-1"
+
+
+@pytest.mark.parametrize("headers", [
+    {},
+    {"x-amzn-oidc-identity": "user-2"},
+    {"x-amzn-oidc-data": alb_token({"sub": "user-1"}, key=ec.generate_private_key(ec.SECP256R1()))},
+    {"x-amzn-oidc-data": alb_token({"sub": "user-1"}, signer=ALB_ARN.replace("streamlit", "other"))},
+    {"x-amzn-oidc-data": alb_token({"sub": "user-1", "exp": int(time.time()) - 60})},
+    {"x-amzn-oidc-data": "not-a-token"},
+])
+def test_missing_or_forged_identity_is_rejected(headers):
+    with pytest.raises(UnauthenticatedError):
+        alb_user_id(headers)
+
+
+def test_forged_unsigned_token_is_rejected():
+    header = base64.urlsafe_b64encode(json.dumps({"alg": "none", "kid": KID, "signer": ALB_ARN}).encode()).decode()
+    payload = base64.urlsafe_b64encode(json.dumps({"sub": "user-1"}).encode()).decode()
+    with pytest.raises(UnauthenticatedError):
+        alb_user_id({"x-amzn-oidc-data": f"{header}.{payload}."})
+
+
+def test_header_mode_requires_the_header():
+    assert user_id_from_headers({"x-user": "user-1"}, "header", user_id_header="x-user") == "user-1"
+    with pytest.raises(UnauthenticatedError):
+        user_id_from_headers({}, "header", user_id_header="x-user")
+
+
+def test_none_mode_ignores_client_headers():
+    assert user_id_from_headers({"x-amzn-oidc-identity": "user-2"}, "none", default_user_id="default") == "default"
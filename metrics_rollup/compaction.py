@@ -0,0 +1,317 @@
+"""Lambda function to compact the raw device metrics CSV into a partitioned Parquet table
+
+Runs as a custom resource once the Glue crawler has catalogued the raw CSV, and
+on a schedule afterwards to pick up newly landed rows incrementally. Each run also
+maintains the hourly per-device rollup used for min/max/avg questions.
+
+Both tables are rebuilt a (device_id, received_date) partition at a time: every
+partition with rows less than LATE_ARRIVAL_HOURS older than the high-water mark
+is rewritten, so rows that land late are still compacted and rolled up. A
+DynamoDB lock keeps the scheduled run and the custom resource from running
+at the same time.
+"""
+import os
+import time
+from collections import defaultdict
+import boto3
+
+from rollup_rewriter import METRICS
+
+athena_client = boto3.client('athena')
+glue_client = boto3.client('glue')
+s3_client = boto3.client('s3')
+dynamodb_client = boto3.client('dynamodb')
+
+ATHENA_DB = os.environ['ATHENA_DB']
+ATHENA_WORKGROUP = os.environ['ATHENA_WORKGROUP']
+CRAWLER_NAME = os.environ['CRAWLER_NAME']
+SOURCE_TABLE = os.environ['SOURCE_TABLE']
+TARGET_TABLE = os.environ['TARGET_TABLE']
+TARGET_LOCATION = os.environ['TARGET_LOCATION']
+ROLLUP_TABLE = os.environ['ROLLUP_TABLE']
+ROLLUP_VIEW = os.environ['ROLLUP_VIEW']
+ROLLUP_LOCATION = os.environ['ROLLUP_LOCATION']
+LOCK_TABLE = os.environ['LOCK_TABLE']
+LATE_ARRIVAL_HOURS = int(os.environ.get('LATE_ARRIVAL_HOURS', '24'))
+
+# Athena writes at most 100 partitions per CTAS or INSERT INTO query
+MAX_PARTITIONS_PER_QUERY = 100
+CRAWLER_TIMEOUT_SECONDS = 600
+# a lock outlives the Lambda timeout of the run holding it at most
+LOCK_SECONDS = 900
+LOCK_WAIT_SECONDS = 240
+
+RECEIVED_AT = "CAST(parse_datetime(TRIM(BOTH '\"' FROM received_at), 'yyyy-MM-dd HH:mm:ss') AS timestamp)"
+
+ROLLUP_PREFIXES = ['min', 'max', 'sum', 'count']
+ROLLUP_COLUMNS = ", ".join(f"{prefix}({metric}) AS {prefix}_{metric}" for metric in METRICS for prefix in ROLLUP_PREFIXES)
+
+
+def on_event(event, context):
+    """Lambda handler for the custom resource and the scheduled compaction"""
+    print(event)
+    request_type = event.get('RequestType')
+    if request_type is None:
+        # scheduled run, the next one picks up the rows if another run holds the lock
+        return locked_run(context.aws_request_id, 0) or {'skipped': True}
+    if request_type in ['Create', 'Update']:
+        wait_for_crawler()
+        locked_run(context.aws_request_id, LOCK_WAIT_SECONDS)
+        return {'PhysicalResourceId': f"compaction-{TARGET_TABLE}"}
+    if request_type == 'Delete':
+        # the table is removed together with the Glue database
+        return {'PhysicalResourceId': event["PhysicalResourceId"]}
+    raise Exception(f"Invalid request type: {request_type}")
+
+
+def locked_run(owner, wait_seconds):
+    """Compact and roll up while holding the lock, None when it stays held for wait_seconds"""
+    if not acquire_lock(owner, wait_seconds):
+        print("compaction lock held by another run, skipping")
+        return None
+    try:
+        return {**compact(), **rollup()}
+    finally:
+        release_lock(owner)
+
+
+def acquire_lock(owner, wait_seconds):
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        now = int(time.time())
+        try:
+            dynamodb_client.put_item(
+                TableName=LOCK_TABLE,
+                Item={'LockId': {'S': TARGET_TABLE}, 'LockOwner': {'S': owner},
+                      'ExpiresAt': {'N': str(now + LOCK_SECONDS)}},
+                # an expired lock was left by a run that timed out
+                ConditionExpression='attribute_not_exists(LockId) OR ExpiresAt < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}}
+            )
+            return True
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(10)
+
+
+def release_lock(owner):
+    try:
+        dynamodb_client.delete_item(
+            TableName=LOCK_TABLE,
+            Key={'LockId': {'S': TARGET_TABLE}},
+            ConditionExpression='LockOwner = :owner',
+            ExpressionAttributeValues={':owner': {'S': owner}}
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        print("compaction lock expired before the run finished")
+
+
+def wait_for_crawler():
+    """Wait until the crawler started at deployment has catalogued the source table"""
+    deadline = time.monotonic() + CRAWLER_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        crawler = glue_client.get_crawler(Name=CRAWLER_NAME)['Crawler']
+        last_crawl = crawler.get('LastCrawl', {})
+        print(f"crawler state {crawler['State']}, last crawl {last_crawl.get('Status')}")
+        if crawler['State'] == 'READY' and last_crawl.get('Status') == 'SUCCEEDED':
+            glue_client.get_table(DatabaseName=ATHENA_DB, Name=SOURCE_TABLE)
+            return
+        if crawler['State'] == 'READY' and last_crawl.get('Status') in ['FAILED', 'CANCELLED']:
+            raise Exception(f"Crawler {CRAWLER_NAME} {last_crawl['Status']}: {last_crawl.get('ErrorMessage')}")
+        time.sleep(10)
+    raise Exception(f"Crawler {CRAWLER_NAME} did not finish within {CRAWLER_TIMEOUT_SECONDS} seconds")
+
+
+def run_query(sql):
+    """Run an Athena query and wait for it to finish"""
+    print(sql)
+    query_execution_id = athena_client.start_query_execution(
+        QueryString=sql,
+        QueryExecutionContext={'Database': ATHENA_DB},
+        WorkGroup=ATHENA_WORKGROUP
+    )['QueryExecutionId']
+    delay = 0.2
+    while True:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+        state = query_execution['Status']['State']
+        if state == 'SUCCEEDED':
+            print(f"scanned {query_execution['Statistics'].get('DataScannedInBytes', 0)} bytes")
+            return query_execution_id
+        if state in ['FAILED', 'CANCELLED']:
+            raise Exception(f"Query {state}: {query_execution['Status'].get('StateChangeReason')}")
+        time.sleep(delay)
+        delay = min(delay * 1.5, 5)
+
+
+def fetch_rows(sql):
+    """Run a query and return its rows as lists of strings, without the header row"""
+    query_execution_id = run_query(sql)
+    rows = []
+    paginator = athena_client.get_paginator('get_query_results')
+    for page in paginator.paginate(QueryExecutionId=query_execution_id):
+        rows.extend([[value.get('VarCharValue') for value in row['Data']] for row in page['ResultSet']['Rows']])
+    return rows[1:]
+
+
+def create_target_table():
+    run_query(f"""
+        CREATE EXTERNAL TABLE IF NOT EXISTS {TARGET_TABLE} (
+            device_name bigint,
+            oil_level double,
+            temperature double,
+            pressure double,
+            received_at timestamp
+        )
+        PARTITIONED BY (device_id bigint, received_date date)
+        STORED AS PARQUET
+        LOCATION '{TARGET_LOCATION}'
+        TBLPROPERTIES ('parquet.compression'='SNAPPY')
+    """)
+
+
+def partition_batches(partitions):
+    """Group (received_date, device_id) pairs into batches of at most MAX_PARTITIONS_PER_QUERY"""
+    devices_by_date = defaultdict(list)
+    for received_date, device_id in partitions:
+        devices_by_date[received_date].append(device_id)
+
+    batches = [[]]
+    for received_date, device_ids in sorted(devices_by_date.items()):
+        for device_id in device_ids:
+            if len(batches[-1]) == MAX_PARTITIONS_PER_QUERY:
+                batches.append([])
+            batches[-1].append((received_date, device_id))
+    return [batch for batch in batches if batch]
+
+
+def partition_filter(batch, date_column):
+    """Return a predicate selecting the partitions of one batch"""
+    batch_dates = defaultdict(list)
+    for received_date, device_id in batch:
+        batch_dates[received_date].append(device_id)
+    return " OR ".join(
+        f"({date_column} = DATE '{received_date}' AND device_id IN ({', '.join(device_ids)}))"
+        for received_date, device_ids in batch_dates.items()
+    )
+
+
+def delete_objects(location, path=""):
+    """Delete the data files under an S3 table location"""
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{path}"):
+        objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+
+def delete_partitions(location, batch):
+    """Delete the data files of a batch of partitions before they are written again"""
+    for received_date, device_id in batch:
+        delete_objects(location, f"device_id={device_id}/received_date={received_date}/")
+
+
+def compact():
+    """Rewrite the partitions with source rows in the late-arrival window, in batches of at most 100 partitions"""
+    create_target_table()
+    watermark = fetch_rows(f"SELECT CAST(max(received_at) AS varchar) FROM {TARGET_TABLE}")[0][0]
+    print(f"compacted up to {watermark}")
+    recent_rows = (f"ts > TIMESTAMP '{watermark}' - interval '{LATE_ARRIVAL_HOURS}' hour"
+                   if watermark else "TRUE")
+    source = f"(SELECT *, {RECEIVED_AT} AS ts FROM {SOURCE_TABLE})"
+
+    partitions = fetch_rows(
+        f"SELECT DISTINCT CAST(date(ts) AS varchar), CAST(device_id AS varchar) FROM {source} WHERE {recent_rows}")
+    for batch in partition_batches(partitions):
+        delete_partitions(TARGET_LOCATION, batch)
+        run_query(f"""
+            INSERT INTO {TARGET_TABLE}
+            SELECT device_name, oil_level, temperature, pressure, ts AS received_at, device_id, date(ts) AS received_date
+            FROM {source}
+            WHERE {partition_filter(batch, 'date(ts)')}
+        """)
+    print(f"compacted {len(partitions)} partitions")
+    return {'partitions': len(partitions)}
+
+
+def create_rollup_table():
+    """Create the rollup table, rebuilding it from scratch when it lacks any of the metric columns"""
+    metric_columns = [f"{prefix}_{metric}" for metric in METRICS for prefix in ROLLUP_PREFIXES]
+    try:
+        columns = glue_client.get_table(DatabaseName=ATHENA_DB, Name=ROLLUP_TABLE)['Table']['StorageDescriptor']['Columns']
+        missing = set(metric_columns) - {column['Name'] for column in columns}
+        if missing:
+            print(f"rollup table lacks {', '.join(sorted(missing))}, rebuilding it")
+            run_query(f"DROP TABLE IF EXISTS {ROLLUP_TABLE}")
+            delete_objects(ROLLUP_LOCATION)
+    except glue_client.exceptions.EntityNotFoundException:
+        pass
+    column_types = ",\n".join(
+        f"{prefix}_{metric} {'bigint' if prefix == 'count' else 'double'}"
+        for metric in METRICS for prefix in ROLLUP_PREFIXES)
+    run_query(f"""
+        CREATE EXTERNAL TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+            device_name bigint,
+            hour_start timestamp,
+            row_count bigint,
+            {column_types}
+        )
+        PARTITIONED BY (device_id bigint, received_date date)
+        STORED AS PARQUET
+        LOCATION '{ROLLUP_LOCATION}'
+        TBLPROPERTIES ('parquet.compression'='SNAPPY')
+    """)
+
+
+def rollup():
+    """Aggregate the complete hours of the partitions in the late-arrival window, then refresh the rollup view
+
+    The view adds the hours not rolled up yet straight from the Parquet table, so
+    queries against it return the same answers as the full table.
+    """
+    create_rollup_table()
+    rolled_up_to = fetch_rows(
+        f"SELECT CAST(max(hour_start) + interval '1' hour AS varchar) FROM {ROLLUP_TABLE}")[0][0]
+    last_hour = fetch_rows(f"SELECT CAST(date_trunc('hour', max(received_at)) AS varchar) FROM {TARGET_TABLE}")[0][0]
+    print(f"rolled up to {rolled_up_to}, last hour {last_hour}")
+
+    hours = 0
+    if last_hour is not None:
+        # only complete hours are rolled up, the current hour keeps receiving rows
+        complete_hours = f"received_at < TIMESTAMP '{last_hour}'"
+        recent_hours = complete_hours
+        if rolled_up_to:
+            recent_hours += f" AND received_at >= TIMESTAMP '{rolled_up_to}' - interval '{LATE_ARRIVAL_HOURS}' hour"
+        partitions = fetch_rows(
+            f"SELECT DISTINCT CAST(received_date AS varchar), CAST(device_id AS varchar) FROM {TARGET_TABLE} WHERE {recent_hours}")
+        for batch in partition_batches(partitions):
+            delete_partitions(ROLLUP_LOCATION, batch)
+            run_query(f"""
+                INSERT INTO {ROLLUP_TABLE}
+                SELECT device_name, date_trunc('hour', received_at) AS hour_start, count(*) AS row_count, {ROLLUP_COLUMNS},
+                    device_id, received_date
+                FROM {TARGET_TABLE}
+                WHERE {complete_hours} AND ({partition_filter(batch, 'received_date')})
+                GROUP BY device_id, received_date, device_name, date_trunc('hour', received_at)
+            """)
+        hours = len(partitions)
+
+    # literal bounds let Athena prune the Parquet partitions the rollup already covers
+    not_rolled_up = (f"WHERE received_date >= DATE '{last_hour[:10]}' AND received_at >= TIMESTAMP '{last_hour}'"
+                     if last_hour else "")
+
+    metric_columns = ", ".join(f"{prefix}_{metric}" for metric in METRICS for prefix in ROLLUP_PREFIXES)
+    run_query(f"""
+        CREATE OR REPLACE VIEW {ROLLUP_VIEW} AS
+        SELECT device_name, hour_start, row_count, {metric_columns}, device_id, received_date
+        FROM {ROLLUP_TABLE}
+        UNION ALL
+        SELECT device_name, date_trunc('hour', received_at) AS hour_start, count(*) AS row_count, {ROLLUP_COLUMNS},
+            device_id, received_date
+        FROM {TARGET_TABLE}
+        {not_rolled_up}
+        GROUP BY device_id, received_date, device_name, date_trunc('hour', received_at)
+    """)
+    print(f"rolled up {hours} partitions")
+    return {'rollup_partitions': hours}
@@ -0,0 +1,118 @@
+"""Rewrite eligible aggregate queries on the device metrics table to the hourly rollup view
+
+Only simple single-table queries are rewritten: the selected columns must be
+device_name/device_id or MIN/MAX/AVG/SUM/COUNT over a metric (or COUNT(*)),
+filters may only use the device and received_date columns, and grouping may only
+use the device columns. Anything else is returned as None and runs unchanged.
+
+Shared by the Streamlit app and the Bedrock agent's action group; METRICS also
+defines the rollup columns written by compaction.py.
+"""
+import re
+
+SOURCE_TABLE = "iot_device_metrics_parquet"
+ROLLUP_VIEW = "iot_device_metrics_hourly_all"
+
+# each metric has min_, max_, sum_ and count_ (non-null rows) columns in the rollup
+METRICS = ["oil_level", "temperature", "pressure"]
+DEVICE_COLUMNS = {"device_name", "device_id"}
+
+QUERY_PATTERN = re.compile(
+    r"^\s*select\s+(?P<select>.+?)\s+from\s+(?P<table>[\w\".]+)"
+    r"(?:\s+where\s+(?P<where>.+?))?"
+    r"(?:\s+group\s+by\s+(?P<group>.+?))?"
+    r"(?:\s+order\s+by\s+(?P<order>[^()]+?))?"
+    r"(?:\s+limit\s+(?P<limit>\d+))?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL)
+AGGREGATE_PATTERN = re.compile(
+    r"^(?P<func>min|max|avg|sum|count)\s*\(\s*(?P<arg>\*|\w+)\s*\)(?P<alias>\s+as\s+\w+)?$", re.IGNORECASE)
+COLUMN_PATTERN = re.compile(r"^(?P<column>\w+)(?P<alias>\s+as\s+\w+)?$", re.IGNORECASE)
+DEVICE_FILTER_PATTERN = re.compile(
+    r"^(device_id|device_name)\s*(=\s*'?\d+'?|in\s*\(\s*'?\d+'?(\s*,\s*'?\d+'?)*\s*\))$", re.IGNORECASE)
+DATE_FILTER_PATTERN = re.compile(
+    r"^received_date\s*(>=|<=|=|>|<)\s*[\w\s'\-+()]+$|"
+    r"^received_date\s+between\s+[\w\s'\-+()]+\s+and\s+[\w\s'\-+()]+$", re.IGNORECASE)
+
+
+def split_top_level(text, separator=","):
+    """Split on a separator outside of parentheses"""
+    parts, depth, current = [], 0, ""
+    for char in text:
+        depth += char == "("
+        depth -= char == ")"
+        if char == separator and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += char
+    parts.append(current.strip())
+    return parts
+
+
+def rewrite_select_item(item):
+    """Map one select item to the rollup columns, return None when it can't be answered from the rollup"""
+    aggregate = AGGREGATE_PATTERN.match(item)
+    if aggregate:
+        func, arg, alias = aggregate.group("func").lower(), aggregate.group("arg").lower(), aggregate.group("alias") or ""
+        # COUNT is 0 over no rows where SUM is NULL
+        if func == "count" and arg == "*":
+            return f"COALESCE(SUM(row_count), 0){alias}"
+        if arg not in METRICS:
+            return None
+        if func == "count":
+            return f"COALESCE(SUM(count_{arg}), 0){alias}"
+        if func == "avg":
+            # AVG ignores NULLs, so divide by the non-null count rather than row_count
+            return f"SUM(sum_{arg}) / SUM(count_{arg}){alias}"
+        return f"{func.upper()}({func}_{arg}){alias}"
+    column = COLUMN_PATTERN.match(item)
+    if column and column.group("column").lower() in DEVICE_COLUMNS:
+        return item
+    return None
+
+
+def split_conditions(where):
+    """Split a WHERE clause on AND, keeping BETWEEN ... AND ... together"""
+    conditions = []
+    for part in re.split(r"\s+and\s+", where.strip(), flags=re.IGNORECASE):
+        previous = conditions[-1] if conditions else ""
+        if re.search(r"\bbetween\b", previous, re.IGNORECASE) and not re.search(r"\band\b", previous, re.IGNORECASE):
+            conditions[-1] = f"{previous} AND {part}"
+        else:
+            conditions.append(part)
+    return conditions
+
+
+def filters_eligible(where):
+    """Filters must be ANDed device or received_date predicates, which the rollup keeps exactly"""
+    if re.search(r"\b(or|not|select)\b", where, re.IGNORECASE):
+        return False
+    return all(DEVICE_FILTER_PATTERN.match(condition) or DATE_FILTER_PATTERN.match(condition)
+               for condition in split_conditions(where))
+
+
+def rewrite_to_rollup(sql):
+    """Return the query rewritten to read the hourly rollup view, or None when it isn't eligible"""
+    match = QUERY_PATTERN.match(sql)
+    if not match:
+        return None
+    table = match.group("table").replace('"', "").split(".")[-1].lower()
+    if table != SOURCE_TABLE:
+        return None
+
+    select_items = split_top_level(match.group("select"))
+    rewritten_items = [rewrite_select_item(item) for item in select_items]
+    if None in rewritten_items or not any(AGGREGATE_PATTERN.match(item) for item in select_items):
+        return None
+    if match.group("where") and not filters_eligible(match.group("where")):
+        return None
+    if match.group("group"):
+        group_columns = {column.lower() for column in split_top_level(match.group("group"))}
+        if not group_columns <= DEVICE_COLUMNS:
+            return None
+
+    rewritten = f"SELECT {', '.join(rewritten_items)}\nFROM {ROLLUP_VIEW}"
+    for clause, group in [("WHERE", "where"), ("GROUP BY", "group"), ("ORDER BY", "order"), ("LIMIT", "limit")]:
+        if match.group(group):
+            rewritten += f"\n{clause} {match.group(group).strip()}"
+    return rewritten